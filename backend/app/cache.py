@@ -1,100 +1,101 @@
 """
 缓存系统，优先使用Redis，Redis不可用时回退到内存缓存
+
+按命名空间（key 的第一段，如 stats / user / creds / quota）分代：
+实际存储的 key 为 "{命名空间}:g{代数}:{其余部分}"，代数保存在计数器 "cache:gen:{命名空间}" 中。
+清除一个命名空间只需把代数加 1（一次 INCR），旧 key 不再被读到，由 TTL 自然过期，
+不需要 KEYS/SCAN 枚举和逐个删除。
+
+多 worker（workers > 1）且 Redis 不可用时不缓存：内存缓存只在本进程内，
+其他 worker 清除缓存（如禁用用户、修改配额）后本 worker 无法得知，会读到最长 1 小时的旧数据。
 """
 
+import hashlib
 import time
-from typing import Any, Optional
+from typing import Any, Dict, Optional, Tuple
 from functools import wraps
 
+from app.config import settings
 # 导入Redis服务
 from app.services.redis_service import redis_service
 
+# 本进程缓存命名空间代数的时间（秒）：其他 worker 清除缓存后，最多这么久本 worker 读到新代数
+GENERATION_TTL = 1.0
+
+
 class SimpleCache:
-    """缓存系统，优先使用Redis，Redis不可用时回退到内存缓存"""
-    
+    """缓存系统，优先使用Redis，Redis不可用时回退到内存缓存（由 redis_service 处理）"""
+
     def __init__(self):
-        # 内存缓存作为备选
-        self._memory_cache = {}
-        self._memory_expires = {}
-    
-    def get(self, key: str) -> Optional[Any]:
-        """获取缓存值，优先从Redis获取"""
-        # 1. 尝试从Redis获取
+        # 命名空间 -> (代数, 读取时间)
+        self._generations: Dict[str, Tuple[int, float]] = {}
+
+    @staticmethod
+    def _enabled() -> bool:
+        """单 worker 或 Redis 已连接时才缓存（多 worker 的内存缓存无法跨进程失效）"""
+        return settings.workers <= 1 or redis_service.connected
+
+    @staticmethod
+    def _namespace(key: str) -> str:
+        return key.split(":", 1)[0]
+
+    async def _generation(self, namespace: str) -> int:
+        cached = self._generations.get(namespace)
+        now = time.monotonic()
+        if cached and now - cached[1] < GENERATION_TTL:
+            return cached[0]
+        value = await redis_service.get(f"cache:gen:{namespace}")
+        generation = int(value) if value else 0
+        self._generations[namespace] = (generation, now)
+        return generation
+
+    async def _versioned_key(self, key: str) -> str:
+        namespace, _, rest = key.partition(":")
+        return f"{namespace}:g{await self._generation(namespace)}:{rest}"
+
+    async def get(self, key: str) -> Optional[Any]:
+        """获取缓存值"""
+        if not self._enabled():
+            return None
         try:
-            result = redis_service.get_json(key)
-            if result is not None:
-                return result
+            return await redis_service.get_json(await self._versioned_key(key))
         except Exception as e:
-            print(f"⚠️ Redis get 失败: {e}")
-        
-        # 2. 尝试从内存缓存获取
-        if key not in self._memory_cache:
-            return None
-        if key in self._memory_expires and time.time() > self._memory_expires[key]:
-            del self._memory_cache[key]
-            del self._memory_expires[key]
+            print(f"⚠️ 缓存读取失败: {e}")
             return None
-        return self._memory_cache[key]
-    
-    def set(self, key: str, value: Any, ttl: int = 60):
-        """设置缓存值，优先保存到Redis"""
-        # 1. 保存到Redis
+
+    async def set(self, key: str, value: Any, ttl: int = 60):
+        """设置缓存值（必须带 TTL：清除缓存后旧代的 key 靠 TTL 过期）"""
+        if not self._enabled():
+            return
         try:
-            redis_service.set_json(key, value, expire=ttl)
+            await redis_service.set_json(await self._versioned_key(key), value, expire=ttl)
         except Exception as e:
-            print(f"⚠️ Redis set 失败: {e}")
-            # 2. 保存到内存缓存作为备选
-            self._memory_cache[key] = value
-            self._memory_expires[key] = time.time() + ttl
-    
-    def delete(self, key: str):
+            print(f"⚠️ 缓存写入失败: {e}")
+
+    async def delete(self, key: str):
         """删除缓存"""
-        # 1. 从Redis删除
-        try:
-            redis_service.delete(key)
-        except Exception as e:
-            print(f"⚠️ Redis delete 失败: {e}")
-        
-        # 2. 从内存缓存删除
-        self._memory_cache.pop(key, None)
-        self._memory_expires.pop(key, None)
-    
-    def clear(self):
-        """清空所有缓存"""
-        # 1. 清空Redis缓存（通过前缀匹配删除）
         try:
-            keys = redis_service.get_keys("*")
-            for key in keys:
-                redis_service.delete(key)
+            await redis_service.delete(await self._versioned_key(key))
         except Exception as e:
-            print(f"⚠️ Redis clear 失败: {e}")
-        
-        # 2. 清空内存缓存
-        self._memory_cache.clear()
-        self._memory_expires.clear()
-    
-    def clear_prefix(self, prefix: str):
-        """清除指定前缀的缓存"""
-        # 1. 清除Redis中指定前缀的缓存
-        try:
-            keys = redis_service.get_keys(f"{prefix}*")
-            for key in keys:
-                redis_service.delete(key)
-        except Exception as e:
-            print(f"⚠️ Redis clear_prefix 失败: {e}")
-        
-        # 2. 清除内存缓存中指定前缀的缓存
-        keys_to_delete = [k for k in self._memory_cache if k.startswith(prefix)]
-        for key in keys_to_delete:
-            self._memory_cache.pop(key, None)
-            self._memory_expires.pop(key, None)
+            print(f"⚠️ 缓存删除失败: {e}")
+
+    async def clear_prefix(self, prefix: str):
+        """清除指定命名空间的缓存（代数加 1）"""
+        namespace = self._namespace(prefix)
+        generation = await redis_service.incr(f"cache:gen:{namespace}")
+        self._generations[namespace] = (generation, time.monotonic())
+
+    async def clear(self):
+        """清空所有命名空间的缓存"""
+        for prefix in CACHE_KEYS.values():
+            await self.clear_prefix(prefix)
 
 
 # 全局缓存实例
 cache = SimpleCache()
 
 
-# 缓存 key 前缀
+# 缓存 key 前缀（即命名空间）
 CACHE_KEYS = {
     "stats": "stats:",           # 统计数据缓存
     "user": "user:",             # 用户信息缓存
@@ -103,6 +104,11 @@ CACHE_KEYS = {
 }
 
 
+def _is_key_part(value: Any) -> bool:
+    """只有简单类型的参数参与缓存 key（数据库会话、当前用户等依赖注入对象不参与）"""
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
 def cached(prefix: str, ttl: int = 30):
     """
     缓存装饰器
@@ -114,32 +120,28 @@ def cached(prefix: str, ttl: int = 30):
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            # 生成缓存 key
-            key = f"{prefix}:{func.__name__}:{hash(str(args) + str(kwargs))}"
-            
+            # 生成缓存 key（各 worker 一致，可共享 Redis 中的缓存）
+            parts = [repr(arg) for arg in args if _is_key_part(arg)]
+            parts += [f"{k}={v!r}" for k, v in sorted(kwargs.items()) if _is_key_part(v)]
+            digest = hashlib.md5("|".join(parts).encode()).hexdigest()[:16]
+            key = f"{prefix}:{func.__name__}:{digest}"
+
             # 尝试从缓存获取
-            result = cache.get(key)
+            result = await cache.get(key)
             if result is not None:
-                # 检查缓存结果是否为协程对象，如果是则重新执行函数
-                if callable(getattr(result, "__await__", None)):
-                    # 清除无效的协程对象缓存
-                    cache.delete(key)
-                else:
-                    return result
-            
+                return result
+
             # 执行函数并缓存结果
             result = await func(*args, **kwargs)
-            # 确保缓存的结果不是协程对象
-            if not callable(getattr(result, "__await__", None)):
-                cache.set(key, result, ttl)
+            await cache.set(key, result, ttl)
             return result
         return wrapper
     return decorator
 
 
-def invalidate_cache(prefix: str = None):
-    """清除缓存"""
+async def invalidate_cache(prefix: str = None):
+    """清除缓存（只递增命名空间代数，不枚举 key）"""
     if prefix:
-        cache.clear_prefix(prefix)
+        await cache.clear_prefix(prefix)
     else:
-        cache.clear()
+        await cache.clear()
@@ -1,5 +1,7 @@
+from pydantic import Field, field_validator
 from pydantic_settings import BaseSettings
 from typing import Optional
+import copy
 import os
 import shutil
 
@@ -11,9 +13,23 @@ if not os.path.exists(_env_path) and os.path.exists(_env_example_path):
     print("✅ 已自动创建 .env 配置文件")
 
 
+# 上游超时策略默认值（秒），见 Settings.upstream_deadlines
+DEFAULT_UPSTREAM_DEADLINES = {
+    "flash": {"connect": 10, "first_byte": 90, "idle": 45},
+    "pro": {"connect": 10, "first_byte": 180, "idle": 60},
+    "30": {"connect": 10, "first_byte": 240, "idle": 90},
+    "image": {"connect": 10, "first_byte": 300, "idle": 120},
+    "claude": {"connect": 10, "first_byte": 180, "idle": 90},
+}
+
+
 class Settings(BaseSettings):
     # 数据库
     database_url: str = "sqlite+aiosqlite:///./data/gemini_proxy.db"
+    # SQLite 连接池（仅 SQLite 生效）
+    sqlite_pool_size: int = 5  # 读连接池大小，0=旧模式（每次新建连接，不启用写队列）
+    sqlite_write_batch_size: int = 50  # 写队列每个事务最多合并的写操作数
+    usage_flush_interval: float = 5.0  # API Key / 凭证使用计数先在内存累加，每隔多少秒批量写入数据库
     
     # Redis 配置
     redis_enabled: bool = True
@@ -21,6 +37,8 @@ class Settings(BaseSettings):
     redis_password: str = ""
     redis_db: int = 0
     redis_key_prefix: str = "catiecli:"
+    redis_max_connections: int = 50  # 连接池最大连接数
+    redis_pool_timeout: float = 5.0  # 连接池用完时等待空闲连接的最长时间（秒）
     # Redis 集群模式配置
     redis_cluster: bool = False  # 是否启用集群模式
     redis_cluster_nodes: list = []  # 集群节点列表，如 ["redis://node1:6379", "redis://node2:6379"]
@@ -37,6 +55,9 @@ class Settings(BaseSettings):
     # 服务
     host: str = "0.0.0.0"
     port: int = 5001  # 默认端口，Zeabur 会自动设置为 8080
+    workers: int = 1  # uvicorn worker 进程数（>1 时由选出的主 worker 执行维护任务）
+    config_sync_interval: float = 1.0  # 检查配置版本号的间隔（秒），其他 worker 保存的配置在此时间内生效
+    leader_lock_ttl: int = 30  # 主 worker 锁的有效期（秒），主 worker 退出后最多这么久由其他 worker 接管
     
     # Gemini
     gemini_api_base: str = "https://generativelanguage.googleapis.com"
@@ -81,6 +102,41 @@ class Settings(BaseSettings):
     
     # 错误重试
     error_retry_count: int = 3  # 报错时切换凭证重试次数
+
+    # 心跳间隔（秒）：上游完成后立即输出，不再等满一个间隔
+    fake_stream_heartbeat_interval: float = 2.0       # 假流式 SSE 心跳间隔
+    fake_non_stream_heartbeat_interval: float = 15.0  # 假非流（返回 JSON）空格心跳间隔
+
+    # 上游超时策略（秒），按模型家族区分，超时后切换凭证重试（见 app/utils/deadline.py）
+    # connect=建立连接, first_byte=首字节（非流式为整个响应）, idle=流式分块最大间隔
+    # 环境变量只需写要改的项，按家族、按项合并到默认值上: UPSTREAM_DEADLINES='{"pro": {"first_byte": 240}}'
+    upstream_deadlines: dict = Field(default_factory=lambda: copy.deepcopy(DEFAULT_UPSTREAM_DEADLINES))
+
+    @field_validator("upstream_deadlines")
+    @classmethod
+    def _merge_upstream_deadlines(cls, value: dict) -> dict:
+        """把配置的超时按家族、按项合并到默认值上（新家族以 flash 为基础）"""
+        merged = {family: dict(deadline) for family, deadline in DEFAULT_UPSTREAM_DEADLINES.items()}
+        for family, deadline in (value or {}).items():
+            base = merged.get(family) or dict(DEFAULT_UPSTREAM_DEADLINES["flash"])
+            base.update(deadline or {})
+            merged[family] = base
+        return merged
+
+    # 上游熔断（按 上游地址 + 模型家族，见 app/services/circuit_breaker.py）
+    circuit_breaker_enabled: bool = True
+    circuit_breaker_window: int = 60              # 统计窗口（秒）
+    circuit_breaker_min_requests: int = 10        # 窗口内至少这么多请求才判断失败率
+    circuit_breaker_failure_rate: float = 0.5     # 失败率达到此值时熔断（只统计 5xx/超时/连接错误）
+    circuit_breaker_open_seconds: int = 30        # 熔断持续时间，之后放行探测请求
+    circuit_breaker_max_open_seconds: int = 300   # 探测连续失败时熔断时间翻倍的上限
+    circuit_breaker_half_open_probes: int = 1     # 半开状态同时放行的探测请求数
+
+    # 响应缓存：按 API Key 开启，或请求头 X-Response-Cache: on 单次开启（适合 temperature=0 的评测/批量任务）
+    # 有 Redis 时存 Redis（多 worker 共享），否则存进程内存
+    response_cache_ttl: int = 3600           # 缓存有效期（秒）
+    response_cache_max_entries: int = 1000   # 内存缓存最多条目数
+    response_cache_max_entry_kb: int = 256   # 单条响应超过此大小（KB）不缓存
     
     # CD 机制（冷却时间，单位：秒）
     cd_flash: int = 0   # Flash 模型组 CD（0=无CD）
@@ -106,6 +162,11 @@ class Settings(BaseSettings):
     
     # 日志保留
     log_retention_days: int = 7  # 日志保留天数（0=永久保留）
+    # 维护任务（清理过期日志/图片）分批限速，避免清理时影响代理请求
+    maintenance_batch_size: int = 5000  # 每批删除的日志行数
+    maintenance_file_batch_size: int = 500  # 每批删除的图片文件数
+    maintenance_batch_pause: float = 0.5  # 两批之间至少暂停的秒数
+    maintenance_duty_cycle: float = 0.2  # 清理最多占用的时间比例（0-1），批次越慢暂停越久
     
     # 公告
     announcement_enabled: bool = False
@@ -146,6 +207,12 @@ You are Antigravity, a powerful agentic AI coding assistant designed by the Goog
     # Antigravity 速率限制 (RPM)
     antigravity_base_rpm: int = 5                  # 未上传凭证的用户 RPM
     antigravity_contributor_rpm: int = 10          # 上传凭证的用户 RPM
+    # Antigravity 模型列表缓存（秒），过期后先返回旧列表并在后台刷新
+    antigravity_models_cache_ttl: int = 600
+    # Antigravity 生成图片的本地存储（static/images，文件名为内容哈希）
+    image_retention_hours: int = 72        # 图片保留时间（小时，0=不按时间清理）
+    image_storage_max_mb: int = 2048       # 图片总大小上限（MB，0=不限制），超出时删除最旧的
+    image_thumbnails: bool = False         # 是否生成缩略图（需要安装 Pillow）
     
     # Discord OAuth (可选，用于 Discord 登录/注册)
     discord_client_id: str = ""
@@ -202,6 +269,80 @@ PERSISTENT_CONFIG_KEYS = [
 ]
 
 
+# 配置版本号（SystemConfig 中的一行）：每次保存配置时加 1，各 worker 发现版本号变化后重新加载
+CONFIG_VERSION_KEY = "config_version"
+# 配置变更通知频道（有 Redis 时保存后立即通知各 worker，否则靠定时检查版本号）
+CONFIG_CHANNEL = "config:changed"
+
+
+class ConfigSnapshot:
+    """
+    可持久化配置的只读快照
+
+    热路径（限速、选凭证、重试）在一次请求开始时取一次快照，之后只读快照：
+    同一请求内看到的配置一致，配置变更时整体替换快照，不会读到改了一半的配置。
+    """
+    __slots__ = tuple(PERSISTENT_CONFIG_KEYS)
+
+    def __init__(self, source):
+        for key in self.__slots__:
+            object.__setattr__(self, key, getattr(source, key))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("ConfigSnapshot 是只读的")
+
+
+_snapshot = ConfigSnapshot(settings)
+# 本 worker 已加载的配置版本号
+_config_version = 0
+
+
+def config_snapshot() -> ConfigSnapshot:
+    """当前配置快照（只是取一个引用，开销可忽略）"""
+    return _snapshot
+
+
+def refresh_config_snapshot() -> None:
+    """settings 被修改后重建快照"""
+    global _snapshot
+    _snapshot = ConfigSnapshot(settings)
+
+
+def _convert_config_value(key: str, value: str):
+    """数据库中的字符串 -> settings 中对应的类型"""
+    attr_type = type(getattr(settings, key))
+    if attr_type == bool:
+        return value.lower() in ('true', '1', 'yes')
+    if attr_type == int:
+        return int(value)
+    if attr_type == float:
+        return float(value)
+    return value
+
+
+def _apply_config_rows(configs, log_prefix: str) -> list:
+    """把数据库中的配置应用到 settings，返回值有变化的配置项"""
+    global _config_version
+    changed = []
+    for config in configs:
+        if config.key == CONFIG_VERSION_KEY:
+            _config_version = int(config.value or 0)
+            continue
+        if not hasattr(settings, config.key):
+            continue
+        try:
+            value = _convert_config_value(config.key, config.value)
+        except (TypeError, ValueError):
+            print(f"[Config] ⚠️ 忽略无效配置: {config.key} = {config.value}")
+            continue
+        if getattr(settings, config.key) != value:
+            setattr(settings, config.key, value)
+            changed.append(config.key)
+            print(f"[Config] {log_prefix}: {config.key} = {value}")
+    refresh_config_snapshot()
+    return changed
+
+
 async def load_config_from_db():
     """从数据库加载配置"""
     from app.database import async_session
@@ -210,35 +351,113 @@ async def load_config_from_db():
     
     async with async_session() as db:
         result = await db.execute(select(SystemConfig))
-        configs = result.scalars().all()
-        
-        for config in configs:
-            if hasattr(settings, config.key):
-                value = config.value
-                # 类型转换
-                attr_type = type(getattr(settings, config.key))
-                if attr_type == bool:
-                    value = value.lower() in ('true', '1', 'yes')
-                elif attr_type == int:
-                    value = int(value)
-                setattr(settings, config.key, value)
-                print(f"[Config] 从数据库加载: {config.key} = {value}")
+        _apply_config_rows(result.scalars().all(), "从数据库加载")
+
+
+async def bump_config_version(db) -> int:
+    """
+    配置版本号加 1（在调用方的事务中，随配置一起提交），提交后调用 publish_config_change 通知其他 worker
+    """
+    from app.models.user import SystemConfig
+    from sqlalchemy import select, update, cast, Integer, String
+    
+    result = await db.execute(
+        update(SystemConfig)
+        .where(SystemConfig.key == CONFIG_VERSION_KEY)
+        .values(value=cast(cast(SystemConfig.value, Integer) + 1, String))
+    )
+    if result.rowcount == 0:
+        db.add(SystemConfig(key=CONFIG_VERSION_KEY, value="1"))
+        await db.flush()
+    return int(await db.scalar(select(SystemConfig.value).where(SystemConfig.key == CONFIG_VERSION_KEY)))
+
+
+async def publish_config_change(version: int, keys: list) -> None:
+    """
+    提交后调用：通知各 worker 配置已变更（没有 Redis 时各 worker 靠定时检查版本号发现）
+
+    本 worker 在修改前已是最新版本时直接记为已加载该版本，定时检查不再重复加载；
+    中间有其他 worker 的修改时保持不变，由下次检查完整重新加载
+    """
+    global _config_version
+    import json
+    from app.services.redis_service import redis_service
+    
+    if version == _config_version + 1:
+        _config_version = version
+    await redis_service.publish(CONFIG_CHANNEL, json.dumps({"version": version, "keys": keys}))
+
+
+async def save_configs_to_db(values: dict):
+    """
+    在一个事务中保存多个配置，提交后应用到本 worker 的 settings，并通知其他 worker 重新加载
+
+    修改配置都应通过这里（不要直接给 settings 赋值），否则其他 worker 不会收到变更
+    """
+    from app.database import async_session
+    from app.models.user import SystemConfig
+    from sqlalchemy import select
+    
+    if not values:
+        return
+    async with async_session() as db:
+        result = await db.execute(select(SystemConfig).where(SystemConfig.key.in_(list(values))))
+        existing = {config.key: config for config in result.scalars().all()}
+        for key, value in values.items():
+            if key in existing:
+                existing[key].value = str(value)
+            else:
+                db.add(SystemConfig(key=key, value=str(value)))
+        version = await bump_config_version(db)
+        await db.commit()
+    
+    for key, value in values.items():
+        setattr(settings, key, value)
+    refresh_config_snapshot()
+    await publish_config_change(version, list(values))
 
 
 async def save_config_to_db(key: str, value):
     """保存单个配置到数据库"""
+    await save_configs_to_db({key: value})
+
+
+async def reload_config_if_changed() -> bool:
+    """配置版本号变化时重新加载配置和自定义错误消息规则，返回是否重新加载"""
     from app.database import async_session
     from app.models.user import SystemConfig
     from sqlalchemy import select
     
     async with async_session() as db:
-        result = await db.execute(select(SystemConfig).where(SystemConfig.key == key))
-        config = result.scalar_one_or_none()
-        
-        if config:
-            config.value = str(value)
-        else:
-            config = SystemConfig(key=key, value=str(value))
-            db.add(config)
+        version = await db.scalar(select(SystemConfig.value).where(SystemConfig.key == CONFIG_VERSION_KEY))
+        if int(version or 0) == _config_version:
+            return False
+        result = await db.execute(select(SystemConfig))
+        changed = _apply_config_rows(result.scalars().all(), "配置已更新")
         
-        await db.commit()
+        from app.services.error_message_service import reload_custom_error_messages
+        await reload_custom_error_messages(db)
+    print(f"[Config] 🔄 已加载配置版本 v{_config_version}，变化的配置项: {', '.join(changed) or '无'}", flush=True)
+    return True
+
+
+async def watch_config_changes():
+    """
+    后台任务：定时检查配置版本号（一次单行查询），有 Redis 时收到变更通知立即检查
+    其他 worker / 节点保存的配置在 config_sync_interval 秒内生效，无需重启
+    """
+    import asyncio
+    from app.services.redis_service import redis_service
+    
+    changed = asyncio.Event()
+    redis_service.subscribe(CONFIG_CHANNEL, lambda message: changed.set())
+    while True:
+        try:
+            await asyncio.wait_for(changed.wait(), timeout=settings.config_sync_interval)
+        except asyncio.TimeoutError:
+            pass
+        changed.clear()
+        try:
+            await reload_config_if_changed()
+        except Exception as e:
+            print(f"[Config] ⚠️ 检查配置版本失败: {e}", flush=True)
@@ -1,7 +1,13 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.pool import NullPool, QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy import event, text, select, insert, inspect, Table, Column, Integer, String, DateTime
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+from datetime import datetime
 from app.config import settings
+import asyncio
+import time
 import os
 import logging
 
@@ -15,8 +21,62 @@ is_postgres = "postgresql" in settings.database_url or "postgres" in settings.da
 if is_sqlite:
     os.makedirs("data", exist_ok=True)
 
+# SQLite 连接池 + 单写队列模式（sqlite_pool_size=0 时使用旧的 NullPool 模式）
+sqlite_pooled = is_sqlite and settings.sqlite_pool_size > 0
+
+# 等待写锁的最长时间（秒），与 SQLite busy_timeout 一致
+WRITE_LOCK_TIMEOUT = 60
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新建的 SQLite 连接都设置 WAL 和忙等待（PRAGMA 是连接级别的）"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={WRITE_LOCK_TIMEOUT * 1000}")
+    cursor.close()
+
+
 # 根据数据库类型配置引擎
-if is_sqlite:
+writer_engine = None
+if sqlite_pooled:
+    # SQLite 连接池：请求处理使用的连接（WAL 模式下读不阻塞写）
+    engine = create_async_engine(
+        settings.database_url,
+        echo=False,
+        connect_args={
+            "timeout": WRITE_LOCK_TIMEOUT,
+            "check_same_thread": False
+        },
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=settings.sqlite_pool_size,
+        max_overflow=settings.sqlite_pool_size,
+    )
+    event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+    # 写队列专用的单个连接：事务以 BEGIN IMMEDIATE 开始（一开始就拿到写锁），支持 SAVEPOINT
+    writer_engine = create_async_engine(
+        settings.database_url,
+        echo=False,
+        connect_args={
+            "timeout": WRITE_LOCK_TIMEOUT,
+            "check_same_thread": False
+        },
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+    )
+
+    @event.listens_for(writer_engine.sync_engine, "connect")
+    def _writer_connect(dbapi_connection, connection_record):
+        _set_sqlite_pragmas(dbapi_connection, connection_record)
+        # 关闭驱动自带的事务处理，由下面的 begin 事件显式开始事务
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(writer_engine.sync_engine, "begin")
+    def _writer_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+elif is_sqlite:
     # SQLite 配置
     engine = create_async_engine(
         settings.database_url, 
@@ -37,7 +97,98 @@ else:
         pool_pre_ping=True,
     )
 
-async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# 进程内写锁：SQLite 同一时间只允许一个写事务，进程内的写操作在这里排队，
+# 而不是在 SQLite 的 busy_timeout 里轮询等待（多 worker 之间仍靠 busy_timeout）
+_write_lock = asyncio.Lock()
+
+
+def _is_write_statement(statement) -> bool:
+    if getattr(statement, "is_dml", False):
+        return True
+    if isinstance(statement, TextClause):
+        return statement.text.lstrip()[:7].upper().startswith(("INSERT", "UPDATE", "DELETE", "REPLACE"))
+    return False
+
+
+class SQLiteSession(AsyncSession):
+    """SQLite 会话：第一次真正写数据库（flush / DML）前获取进程内写锁，提交、回滚或关闭时释放"""
+
+    _holds_write_lock = False
+
+    def _has_pending(self) -> bool:
+        sync_session = self.sync_session
+        return bool(sync_session.new or sync_session.deleted or sync_session.dirty)
+
+    async def _acquire_write_lock(self):
+        if self._holds_write_lock:
+            return
+        try:
+            await asyncio.wait_for(_write_lock.acquire(), timeout=WRITE_LOCK_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"database is locked: 等待写锁超过 {WRITE_LOCK_TIMEOUT} 秒")
+        self._holds_write_lock = True
+
+    def _release_write_lock(self):
+        if self._holds_write_lock:
+            self._holds_write_lock = False
+            _write_lock.release()
+
+    async def _before_statement(self, statement=None):
+        if self._holds_write_lock:
+            return
+        # 语句本身是写操作，或执行前会自动 flush 待写入的修改
+        if (statement is not None and _is_write_statement(statement)) or (self.autoflush and self._has_pending()):
+            await self._acquire_write_lock()
+
+    async def execute(self, statement, *args, **kwargs):
+        await self._before_statement(statement)
+        return await super().execute(statement, *args, **kwargs)
+
+    async def scalar(self, statement, *args, **kwargs):
+        await self._before_statement(statement)
+        return await super().scalar(statement, *args, **kwargs)
+
+    async def scalars(self, statement, *args, **kwargs):
+        await self._before_statement(statement)
+        return await super().scalars(statement, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        await self._before_statement()
+        return await super().get(*args, **kwargs)
+
+    async def merge(self, *args, **kwargs):
+        await self._before_statement()
+        return await super().merge(*args, **kwargs)
+
+    async def flush(self, objects=None):
+        if self._has_pending():
+            await self._acquire_write_lock()
+        await super().flush(objects)
+
+    async def commit(self):
+        if self._has_pending():
+            await self._acquire_write_lock()
+        try:
+            await super().commit()
+        finally:
+            self._release_write_lock()
+
+    async def rollback(self):
+        try:
+            await super().rollback()
+        finally:
+            self._release_write_lock()
+
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            self._release_write_lock()
+
+
+async_session = async_sessionmaker(
+    engine, class_=SQLiteSession if sqlite_pooled else AsyncSession, expire_on_commit=False
+)
 
 Base = declarative_base()
 
@@ -45,6 +196,222 @@ async def get_db():
     async with async_session() as session:
         yield session
 
+
+class DatabaseWriter:
+    """
+    单写队列：后台写操作（日志、计数）放入队列，由一个任务通过专用写连接执行，
+    队列中积压的多个写操作合并为一个事务提交（每个写操作在自己的 SAVEPOINT 中，失败只回滚自己）。
+
+    非 SQLite 连接池模式下直接使用独立会话执行并提交。
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._session_factory = None
+        self.stats = {"jobs": 0, "transactions": 0, "failed": 0}
+
+    def _start(self):
+        self._queue = asyncio.Queue()
+        self._session_factory = async_sessionmaker(writer_engine, expire_on_commit=False)
+        self._task = asyncio.create_task(self._worker())
+
+    async def run(self, job: Callable[[AsyncSession], Awaitable[Any]]) -> Any:
+        """
+        执行写操作并等待提交完成
+
+        Args:
+            job: async def job(session)，只做数据库读写，不要自行 commit
+
+        Returns:
+            job 的返回值（事务提交后才返回）
+        """
+        if not sqlite_pooled:
+            async with async_session() as session:
+                result = await job(session)
+                await session.commit()
+                return result
+
+        if self._task is None or self._task.done():
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((job, future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            batch: List[Tuple[Callable, asyncio.Future]] = [await self._queue.get()]
+            while len(batch) < settings.sqlite_write_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._run_batch(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[DB Writer] ❌ 批量写入失败: {e}", flush=True)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _run_batch(self, batch: List[Tuple[Callable, asyncio.Future]]):
+        results = []
+        # 与 SQLiteSession 相同的超时：等待写锁超时时整批失败（由 _worker 设置到各 future 上）
+        try:
+            await asyncio.wait_for(_write_lock.acquire(), timeout=WRITE_LOCK_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"database is locked: 等待写锁超过 {WRITE_LOCK_TIMEOUT} 秒")
+        try:
+            async with self._session_factory() as session:
+                for job, future in batch:
+                    try:
+                        async with session.begin_nested():
+                            results.append((future, await job(session), None))
+                    except Exception as e:
+                        self.stats["failed"] += 1
+                        results.append((future, None, e))
+                await session.commit()
+        finally:
+            _write_lock.release()
+        self.stats["jobs"] += len(batch)
+        self.stats["transactions"] += 1
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def get_stats(self) -> dict:
+        return {
+            "mode": "queue" if sqlite_pooled else "direct",
+            "queued": self._queue.qsize() if self._queue else 0,
+            **self.stats,
+        }
+
+
+# 全局写队列
+db_writer = DatabaseWriter()
+
+# 已执行的结构迁移版本
+schema_migrations = Table(
+    "schema_migrations",
+    Base.metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String(200), nullable=False),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+# 历史版本新增的列（新数据库由 create_all 直接建好，这些语句会因列已存在而跳过）
+_SQLITE_ADD_COLUMNS = [
+    "ALTER TABLE usage_logs ADD COLUMN credential_id INTEGER REFERENCES credentials(id)",
+    "ALTER TABLE users ADD COLUMN bonus_quota INTEGER DEFAULT 0",
+    "ALTER TABLE credentials ADD COLUMN client_id TEXT",
+    "ALTER TABLE credentials ADD COLUMN client_secret TEXT",
+    "ALTER TABLE users ADD COLUMN quota_flash INTEGER DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN quota_25pro INTEGER DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN quota_30pro INTEGER DEFAULT 0",
+    "ALTER TABLE credentials ADD COLUMN account_type VARCHAR(20) DEFAULT 'free'",
+    "ALTER TABLE credentials ADD COLUMN last_used_flash DATETIME",
+    "ALTER TABLE credentials ADD COLUMN last_used_pro DATETIME",
+    "ALTER TABLE credentials ADD COLUMN last_used_30 DATETIME",
+    "ALTER TABLE usage_logs ADD COLUMN cd_seconds INTEGER",
+    "ALTER TABLE usage_logs ADD COLUMN error_message TEXT",
+    "ALTER TABLE usage_logs ADD COLUMN request_body TEXT",
+    "ALTER TABLE usage_logs ADD COLUMN client_ip VARCHAR(50)",
+    "ALTER TABLE usage_logs ADD COLUMN user_agent VARCHAR(500)",
+    # 错误分类字段（新增）
+    "ALTER TABLE usage_logs ADD COLUMN error_type VARCHAR(50)",
+    "ALTER TABLE usage_logs ADD COLUMN error_code VARCHAR(100)",
+    "ALTER TABLE usage_logs ADD COLUMN credential_email VARCHAR(100)",
+    # Antigravity 支持（新增）
+    "ALTER TABLE credentials ADD COLUMN api_type VARCHAR(20) DEFAULT 'geminicli'",
+    "ALTER TABLE credentials ADD COLUMN credential_type VARCHAR(20) DEFAULT 'oauth'",
+    "ALTER TABLE credentials ADD COLUMN model_tier VARCHAR(20)",
+    "ALTER TABLE credentials ADD COLUMN model_cooldowns TEXT",
+    # Antigravity 用户配额
+    "ALTER TABLE users ADD COLUMN quota_antigravity INTEGER DEFAULT 100",
+    "ALTER TABLE users ADD COLUMN used_antigravity INTEGER DEFAULT 0",
+    # 凭证备注
+    "ALTER TABLE credentials ADD COLUMN note VARCHAR(500)",
+    # 重试次数统计
+    "ALTER TABLE usage_logs ADD COLUMN retry_count INTEGER DEFAULT 0",
+    # 响应缓存
+    "ALTER TABLE api_keys ADD COLUMN response_cache BOOLEAN DEFAULT 0",
+    "ALTER TABLE usage_logs ADD COLUMN cache_hit BOOLEAN DEFAULT 0",
+]
+
+_POSTGRES_ADD_COLUMNS = [
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS credential_id INTEGER REFERENCES credentials(id)",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS bonus_quota INTEGER DEFAULT 0",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS client_id TEXT",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS client_secret TEXT",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_flash INTEGER DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_25pro INTEGER DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_30pro INTEGER DEFAULT 0",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS account_type VARCHAR(20) DEFAULT 'free'",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS last_used_flash TIMESTAMP",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS last_used_pro TIMESTAMP",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS last_used_30 TIMESTAMP",
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS cd_seconds INTEGER",
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS error_message TEXT",
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS request_body TEXT",
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS client_ip VARCHAR(50)",
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS user_agent VARCHAR(500)",
+    # 错误分类字段（新增）
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS error_type VARCHAR(50)",
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS error_code VARCHAR(100)",
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS credential_email VARCHAR(100)",
+    # Antigravity 支持（新增）
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS api_type VARCHAR(20) DEFAULT 'geminicli'",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS credential_type VARCHAR(20) DEFAULT 'oauth'",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS model_tier VARCHAR(20)",
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS model_cooldowns TEXT",
+    # Antigravity 用户配额
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_antigravity INTEGER DEFAULT 100",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS used_antigravity INTEGER DEFAULT 0",
+    # 凭证备注
+    "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS note VARCHAR(500)",
+    # 重试次数统计
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS retry_count INTEGER DEFAULT 0",
+    # 响应缓存
+    "ALTER TABLE api_keys ADD COLUMN IF NOT EXISTS response_cache BOOLEAN DEFAULT FALSE",
+    "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN DEFAULT FALSE",
+]
+
+# 查询优化索引
+_INDEXES = [
+        "CREATE INDEX IF NOT EXISTS idx_usage_logs_created_at ON usage_logs(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_usage_logs_user_id ON usage_logs(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_usage_logs_status_code ON usage_logs(status_code)",
+        "CREATE INDEX IF NOT EXISTS idx_usage_logs_user_created ON usage_logs(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_credentials_is_active ON credentials(is_active)",
+        "CREATE INDEX IF NOT EXISTS idx_credentials_is_public ON credentials(is_public)",
+        "CREATE INDEX IF NOT EXISTS idx_credentials_user_id ON credentials(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_api_keys_user_id ON api_keys(user_id)",
+        # 错误分类索引（新增）
+        "CREATE INDEX IF NOT EXISTS idx_usage_logs_error_type ON usage_logs(error_type)",
+        "CREATE INDEX IF NOT EXISTS idx_usage_logs_date_error ON usage_logs(created_at, error_type)",
+        # Antigravity 索引（新增）
+        "CREATE INDEX IF NOT EXISTS idx_credentials_api_type ON credentials(api_type)",
+]
+
+# 数据修复：将 api_type 为空或 NULL 的凭证更新为 geminicli（排除 antigravity）
+# 这是为了修复历史数据中未设置 api_type 的凭证
+_FIX_API_TYPE = "UPDATE credentials SET api_type = 'geminicli' WHERE api_type IS NULL OR api_type = ''"
+
+# 结构迁移：(版本号, 说明, SQLite 语句, PostgreSQL 语句)
+# 每个版本只执行一次，执行记录保存在 schema_migrations 表；新的迁移追加到末尾，不要修改已发布的版本
+SCHEMA_MIGRATIONS: List[Tuple[int, str, List[str], List[str]]] = [
+    (1, "补充历史版本新增的列", _SQLITE_ADD_COLUMNS, _POSTGRES_ADD_COLUMNS),
+    (2, "创建查询索引", _INDEXES, _INDEXES),
+    (3, "修复 api_type 为空的凭证", [_FIX_API_TYPE], [_FIX_API_TYPE]),
+]
+
+# PostgreSQL 迁移锁（pg_advisory_xact_lock 的键），多 worker 同时启动时只有一个执行迁移
+_MIGRATION_LOCK_KEY = 20240917
+
+
 async def init_db(skip_migration_check: bool = False):
     # 自动迁移检测：如果配置了 PostgreSQL 且存在 SQLite 数据库文件，自动迁移
     if is_postgres and not skip_migration_check:
@@ -69,133 +436,72 @@ async def init_db(skip_migration_check: bool = False):
                 logger.error("请检查配置或手动迁移数据")
                 raise
 
-    async with engine.begin() as conn:
-        # SQLite 特有优化
-        if is_sqlite:
-            from sqlalchemy import text
+    # SQLite 特有优化（连接池模式下每个连接建立时已设置）
+    if is_sqlite and not sqlite_pooled:
+        async with engine.begin() as conn:
             await conn.execute(text("PRAGMA journal_mode=WAL"))
             await conn.execute(text("PRAGMA synchronous=NORMAL"))
             await conn.execute(text("PRAGMA busy_timeout=60000"))
-        
-        await conn.run_sync(Base.metadata.create_all)
-        
-        # 数据库迁移：添加新列（如果不存在）
-        from sqlalchemy import text
-        
+    
+    await run_schema_migrations()
+
+
+def _schema_status(sync_conn) -> Tuple[set, bool]:
+    """(已执行的版本, 是否所有表都已存在)"""
+    tables = set(inspect(sync_conn).get_table_names())
+    if schema_migrations.name not in tables:
+        return set(), False
+    versions = set(sync_conn.execute(select(schema_migrations.c.version)).scalars().all())
+    return versions, all(table in tables for table in Base.metadata.tables)
+
+
+async def run_schema_migrations():
+    """
+    建表并执行尚未执行的结构迁移
+
+    已是最新时只查询表名和迁移记录；否则在一个事务中建表、执行所有待执行的版本并记录，
+    执行前先拿到写锁（SQLite: BEGIN IMMEDIATE，PostgreSQL: advisory lock），
+    其他同时启动的 worker 等待后重新检查，不会重复执行，也不会同时建表。
+    """
+    start = time.perf_counter()
+    latest = SCHEMA_MIGRATIONS[-1][0]
+
+    async with engine.connect() as conn:
+        applied, tables_ready = await conn.run_sync(_schema_status)
+    if tables_ready and all(version in applied for version, *_ in SCHEMA_MIGRATIONS):
+        print(f"[DB Migration] ✅ 数据库结构已是最新 (v{latest})，耗时 {(time.perf_counter() - start) * 1000:.0f}ms", flush=True)
+        return
+
+    async with engine.connect() as conn:
         if is_sqlite:
-            # SQLite 迁移
-            migrations = [
-                "ALTER TABLE usage_logs ADD COLUMN credential_id INTEGER REFERENCES credentials(id)",
-                "ALTER TABLE users ADD COLUMN bonus_quota INTEGER DEFAULT 0",
-                "ALTER TABLE credentials ADD COLUMN client_id TEXT",
-                "ALTER TABLE credentials ADD COLUMN client_secret TEXT",
-                "ALTER TABLE users ADD COLUMN quota_flash INTEGER DEFAULT 0",
-                "ALTER TABLE users ADD COLUMN quota_25pro INTEGER DEFAULT 0",
-                "ALTER TABLE users ADD COLUMN quota_30pro INTEGER DEFAULT 0",
-                "ALTER TABLE credentials ADD COLUMN account_type VARCHAR(20) DEFAULT 'free'",
-                "ALTER TABLE credentials ADD COLUMN last_used_flash DATETIME",
-                "ALTER TABLE credentials ADD COLUMN last_used_pro DATETIME",
-                "ALTER TABLE credentials ADD COLUMN last_used_30 DATETIME",
-                "ALTER TABLE usage_logs ADD COLUMN cd_seconds INTEGER",
-                "ALTER TABLE usage_logs ADD COLUMN error_message TEXT",
-                "ALTER TABLE usage_logs ADD COLUMN request_body TEXT",
-                "ALTER TABLE usage_logs ADD COLUMN client_ip VARCHAR(50)",
-                "ALTER TABLE usage_logs ADD COLUMN user_agent VARCHAR(500)",
-                # 错误分类字段（新增）
-                "ALTER TABLE usage_logs ADD COLUMN error_type VARCHAR(50)",
-                "ALTER TABLE usage_logs ADD COLUMN error_code VARCHAR(100)",
-                "ALTER TABLE usage_logs ADD COLUMN credential_email VARCHAR(100)",
-                # Antigravity 支持（新增）
-                "ALTER TABLE credentials ADD COLUMN api_type VARCHAR(20) DEFAULT 'geminicli'",
-                "ALTER TABLE credentials ADD COLUMN credential_type VARCHAR(20) DEFAULT 'oauth'",
-                "ALTER TABLE credentials ADD COLUMN model_tier VARCHAR(20)",
-                "ALTER TABLE credentials ADD COLUMN model_cooldowns TEXT",
-                # Antigravity 用户配额
-                "ALTER TABLE users ADD COLUMN quota_antigravity INTEGER DEFAULT 100",
-                "ALTER TABLE users ADD COLUMN used_antigravity INTEGER DEFAULT 0",
-                # 凭证备注
-                "ALTER TABLE credentials ADD COLUMN note VARCHAR(500)",
-                # 重试次数统计
-                "ALTER TABLE usage_logs ADD COLUMN retry_count INTEGER DEFAULT 0",
-            ]
+            await conn.exec_driver_sql("BEGIN IMMEDIATE")
         else:
-            # PostgreSQL 迁移（使用 IF NOT EXISTS 语法）
-            migrations = [
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS credential_id INTEGER REFERENCES credentials(id)",
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS bonus_quota INTEGER DEFAULT 0",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS client_id TEXT",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS client_secret TEXT",
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_flash INTEGER DEFAULT 0",
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_25pro INTEGER DEFAULT 0",
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_30pro INTEGER DEFAULT 0",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS account_type VARCHAR(20) DEFAULT 'free'",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS last_used_flash TIMESTAMP",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS last_used_pro TIMESTAMP",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS last_used_30 TIMESTAMP",
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS cd_seconds INTEGER",
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS error_message TEXT",
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS request_body TEXT",
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS client_ip VARCHAR(50)",
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS user_agent VARCHAR(500)",
-                # 错误分类字段（新增）
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS error_type VARCHAR(50)",
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS error_code VARCHAR(100)",
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS credential_email VARCHAR(100)",
-                # Antigravity 支持（新增）
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS api_type VARCHAR(20) DEFAULT 'geminicli'",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS credential_type VARCHAR(20) DEFAULT 'oauth'",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS model_tier VARCHAR(20)",
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS model_cooldowns TEXT",
-                # Antigravity 用户配额
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_antigravity INTEGER DEFAULT 100",
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS used_antigravity INTEGER DEFAULT 0",
-                # 凭证备注
-                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS note VARCHAR(500)",
-                # 重试次数统计
-                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS retry_count INTEGER DEFAULT 0",
-            ]
-        
-        for sql in migrations:
-            try:
-                await conn.execute(text(sql))
-                print(f"[DB Migration] ✅ {sql[:50]}...")
-            except Exception as e:
-                if "duplicate column" not in str(e).lower() and "already exists" not in str(e).lower():
-                    pass  # 列已存在，忽略
-        
-        # 创建索引优化查询性能
-        indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_usage_logs_created_at ON usage_logs(created_at)",
-            "CREATE INDEX IF NOT EXISTS idx_usage_logs_user_id ON usage_logs(user_id)",
-            "CREATE INDEX IF NOT EXISTS idx_usage_logs_status_code ON usage_logs(status_code)",
-            "CREATE INDEX IF NOT EXISTS idx_usage_logs_user_created ON usage_logs(user_id, created_at)",
-            "CREATE INDEX IF NOT EXISTS idx_credentials_is_active ON credentials(is_active)",
-            "CREATE INDEX IF NOT EXISTS idx_credentials_is_public ON credentials(is_public)",
-            "CREATE INDEX IF NOT EXISTS idx_credentials_user_id ON credentials(user_id)",
-            "CREATE INDEX IF NOT EXISTS idx_api_keys_user_id ON api_keys(user_id)",
-            # 错误分类索引（新增）
-            "CREATE INDEX IF NOT EXISTS idx_usage_logs_error_type ON usage_logs(error_type)",
-            "CREATE INDEX IF NOT EXISTS idx_usage_logs_date_error ON usage_logs(created_at, error_type)",
-            # Antigravity 索引（新增）
-            "CREATE INDEX IF NOT EXISTS idx_credentials_api_type ON credentials(api_type)",
-        ]
-        
-        for sql in indexes:
-            try:
-                await conn.execute(text(sql))
-                print(f"[DB Index] ✅ {sql[30:70]}...")
-            except Exception as e:
-                pass  # 索引已存在，忽略
-        
-        # 数据修复：将 api_type 为空或 NULL 的凭证更新为 geminicli（排除 antigravity）
-        # 这是为了修复历史数据中未设置 api_type 的凭证
-        try:
-            if is_sqlite:
-                fix_sql = "UPDATE credentials SET api_type = 'geminicli' WHERE api_type IS NULL OR api_type = ''"
-            else:
-                fix_sql = "UPDATE credentials SET api_type = 'geminicli' WHERE api_type IS NULL OR api_type = ''"
-            result = await conn.execute(text(fix_sql))
-            if result.rowcount > 0:
-                print(f"[DB Fix] ✅ 已修复 {result.rowcount} 个凭证的 api_type 字段")
-        except Exception as e:
-            print(f"[DB Fix] ⚠️ 修复 api_type 失败: {e}")
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+
+        # 拿到锁后再建表、重新检查（可能已被其他 worker 执行）
+        await conn.run_sync(Base.metadata.create_all)
+        applied, _ = await conn.run_sync(_schema_status)
+        executed = []
+        for version, name, sqlite_statements, postgres_statements in SCHEMA_MIGRATIONS:
+            if version in applied:
+                continue
+            version_start = time.perf_counter()
+            for sql in sqlite_statements if is_sqlite else postgres_statements:
+                try:
+                    await conn.execute(text(sql))
+                except Exception as e:
+                    # SQLite 不支持 ADD COLUMN IF NOT EXISTS：列已存在时跳过
+                    if is_sqlite and ("duplicate column" in str(e).lower() or "already exists" in str(e).lower()):
+                        continue
+                    print(f"[DB Migration] ❌ v{version} {name} 失败: {sql[:80]}: {e}", flush=True)
+                    raise
+            await conn.execute(insert(schema_migrations).values(version=version, name=name, applied_at=datetime.utcnow()))
+            executed.append(version)
+            print(f"[DB Migration] ✅ v{version} {name} ({(time.perf_counter() - version_start) * 1000:.0f}ms)", flush=True)
+        await conn.commit()
+
+    elapsed = (time.perf_counter() - start) * 1000
+    if executed:
+        print(f"[DB Migration] ✅ 已执行 {len(executed)} 个迁移，当前版本 v{latest}，耗时 {elapsed:.0f}ms", flush=True)
+    else:
+        print(f"[DB Migration] ✅ 迁移已由其他进程完成 (v{latest})，耗时 {elapsed:.0f}ms", flush=True)
@@ -8,50 +8,35 @@ import os
 from app.database import init_db, async_session
 from app.models.user import User
 from app.services.auth import get_password_hash
-from app.config import settings, load_config_from_db
+from app.config import settings, load_config_from_db, watch_config_changes
 from app.routers import auth, proxy, admin, oauth, ws, manage, error_config
 from app.routers.test import router as test_router
 from app.routers import antigravity_proxy, antigravity_manage, antigravity_oauth
 from app.middleware.url_normalize import URLNormalizeMiddleware
+from app.middleware.circuit_probe import CircuitProbeMiddleware
 from sqlalchemy import select
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     import asyncio
-    from datetime import datetime, timedelta
-    from sqlalchemy import delete
-    from app.models.user import UsageLog
     from app.services.redis_service import redis_service
     from app.cache import invalidate_cache
     
-    # 启动时初始化
+    # 启动时初始化（多 worker 同时启动时只有一个执行迁移，其他 worker 在迁移锁上等待迁移完成）
     await init_db()
     
     # 初始化Redis连接
     await redis_service.init_redis()
     
-    # 清除所有缓存，确保没有旧的协程对象
-    invalidate_cache()
-    print("✅ 已清除所有缓存")
+    # 订阅 WebSocket 事件频道（多 worker 时管理员能看到所有 worker 的日志）
+    from app.services.websocket import manager as ws_manager
+    if ws_manager.start_pubsub():
+        print(f"✅ WebSocket 事件通过 Redis 广播 (worker={ws_manager.worker_id})")
     
-    # 自动添加缺失的数据库列（简单迁移）
-    try:
-        async with async_session() as db:
-            from sqlalchemy import text
-            # 检查并添加 retry_count 列
-            try:
-                await db.execute(text("SELECT retry_count FROM usage_logs LIMIT 1"))
-            except Exception:
-                print("🔄 正在添加 retry_count 列...")
-                try:
-                    await db.execute(text("ALTER TABLE usage_logs ADD COLUMN retry_count INTEGER DEFAULT 0"))
-                    await db.commit()
-                    print("✅ 成功添加 retry_count 列")
-                except Exception as e:
-                    print(f"⚠️ 添加 retry_count 列失败（可能已存在）: {e}")
-    except Exception as e:
-        print(f"⚠️ 数据库迁移检查失败: {e}")
+    # 清除所有缓存（各命名空间代数加 1，旧 key 由 TTL 过期）
+    await invalidate_cache()
+    print("✅ 已清除所有缓存")
     
     # 从数据库加载持久化配置
     try:
@@ -60,69 +45,81 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"⚠️ 加载配置失败: {e}")
     
-    # 创建或更新管理员账号，确保只有配置的用户名是管理员
-    async with async_session() as db:
-        # 先把其他管理员降级为普通用户
-        other_admins = await db.execute(
-            select(User).where(User.is_admin == True, User.username != settings.admin_username)
-        )
-        for other in other_admins.scalars().all():
-            other.is_admin = False
-            print(f"⚠️ 降级旧管理员: {other.username}")
-        
-        # 创建或更新配置的管理员
-        result = await db.execute(select(User).where(User.username == settings.admin_username))
-        admin_user = result.scalar_one_or_none()
-        if not admin_user:
-            admin_user = User(
-                username=settings.admin_username,
-                hashed_password=get_password_hash(settings.admin_password),
-                is_admin=True,
-                daily_quota=999999
+    # 编译自定义错误消息规则（之后的匹配不访问数据库）
+    try:
+        from app.services.error_message_service import reload_custom_error_messages
+        async with async_session() as db:
+            await reload_custom_error_messages(db)
+    except Exception as e:
+        print(f"⚠️ 加载自定义错误消息规则失败: {e}")
+    
+    # 监听配置变更：其他 worker / 节点保存的配置和错误消息规则无需重启即可生效
+    config_watch_task = asyncio.create_task(watch_config_changes())
+    
+    # API Key / 凭证使用计数先在内存累加，定时批量写入（每个 worker 各自写自己的增量）
+    from app.services.usage_buffer import usage_buffer
+    usage_buffer.start()
+    
+    # 创建或更新管理员账号，确保只有配置的用户名是管理员（只在主 worker 上执行）
+    async def sync_admin_account():
+        async with async_session() as db:
+            # 先把其他管理员降级为普通用户
+            other_admins = await db.execute(
+                select(User).where(User.is_admin == True, User.username != settings.admin_username)
             )
-            db.add(admin_user)
-            print(f"✅ 创建管理员账号: {settings.admin_username}")
-        else:
-            # 更新管理员密码（确保 .env 修改后生效）
-            admin_user.hashed_password = get_password_hash(settings.admin_password)
-            admin_user.is_admin = True
-            print(f"✅ 已同步管理员账号: {settings.admin_username}")
+            for other in other_admins.scalars().all():
+                other.is_admin = False
+                print(f"⚠️ 降级旧管理员: {other.username}")
+        
+            # 创建或更新配置的管理员
+            result = await db.execute(select(User).where(User.username == settings.admin_username))
+            admin_user = result.scalar_one_or_none()
+            if not admin_user:
+                admin_user = User(
+                    username=settings.admin_username,
+                    hashed_password=get_password_hash(settings.admin_password),
+                    is_admin=True,
+                    daily_quota=999999
+                )
+                db.add(admin_user)
+                print(f"✅ 创建管理员账号: {settings.admin_username}")
+            else:
+                # 更新管理员密码（确保 .env 修改后生效）
+                admin_user.hashed_password = get_password_hash(settings.admin_password)
+                admin_user.is_admin = True
+                print(f"✅ 已同步管理员账号: {settings.admin_username}")
         
-        await db.commit()
-    
-    # 定时清理过期日志的后台任务
-    async def cleanup_old_logs():
-        while True:
-            try:
-                retention_days = settings.log_retention_days
-                if retention_days > 0:
-                    cutoff_date = datetime.utcnow() - timedelta(days=retention_days)
-                    async with async_session() as db:
-                        result = await db.execute(
-                            delete(UsageLog).where(UsageLog.created_at < cutoff_date)
-                        )
-                        deleted_count = result.rowcount
-                        await db.commit()
-                        if deleted_count > 0:
-                            print(f"🗑️ 自动清理了 {deleted_count} 条过期日志（{retention_days}天前）")
-            except Exception as e:
-                print(f"⚠️ 日志清理失败: {e}")
-            
-            # 每24小时执行一次
-            await asyncio.sleep(86400)
-    
-    # 启动后台清理任务
-    cleanup_task = asyncio.create_task(cleanup_old_logs())
-    print("✅ 已启动日志自动清理任务")
+            await db.commit()
+    
+    # 维护任务：分批、限速清理过期日志 / 生成图片（只在主 worker 上）和已完成的后台任务状态（每个 worker）
+    from app.services.maintenance import maintenance, expired_log_batches
+    from app.services.image_storage import ImageStorage
+    from app.routers.manage import prune_background_tasks
+    maintenance.add_task("cleanup_old_logs", expired_log_batches, interval=3600)
+    maintenance.add_task("cleanup_old_images", ImageStorage.cleanup_batches, interval=3600,
+                         batch_size=settings.maintenance_file_batch_size)
+    maintenance.add_task("prune_background_tasks", prune_background_tasks, interval=600, leader_only=False)
+    maintenance.start()
+    
+    # 选主：多 worker 时只有主 worker 同步管理员账号、执行后台清理任务，主 worker 退出后由其他 worker 接管
+    from app.services.leader import leader
+    leader.add_once_job("sync_admin_account", sync_admin_account)
+    if await leader.start():
+        print("✅ 已启动日志自动清理任务")
     
     yield
     
-    # 关闭时取消后台任务
-    cleanup_task.cancel()
+    # 关闭时停止后台任务并释放主 worker 锁
+    config_watch_task.cancel()
     try:
-        await cleanup_task
+        await config_watch_task
     except asyncio.CancelledError:
         pass
+    await leader.stop()
+    await maintenance.stop()
+    
+    # 写入缓冲中剩余的使用计数
+    await usage_buffer.stop()
     
     # 关闭Redis连接
     await redis_service.close_redis()
@@ -148,6 +145,9 @@ app.add_middleware(
 # 注意：ASGI 中间件的执行顺序是后添加先执行，所以这个中间件会在 CORS 之后执行
 app.add_middleware(URLNormalizeMiddleware)
 
+# 熔断探测名额中间件：探测请求没有结果就结束（客户端断开等）时立即归还名额
+app.add_middleware(CircuitProbeMiddleware)
+
 # 注册路由
 app.include_router(auth.router)
 app.include_router(proxy.router)
@@ -206,10 +206,11 @@ frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static
 if os.path.exists(frontend_path):
     app.mount("/assets", StaticFiles(directory=os.path.join(frontend_path, "assets")), name="assets")
     
-    # 图片存储目录
+    # 图片存储目录（文件名为内容哈希，带长期缓存头）
+    from app.services.image_storage import ImmutableStaticFiles
     images_path = os.path.join(frontend_path, "images")
     os.makedirs(images_path, exist_ok=True)
-    app.mount("/images", StaticFiles(directory=images_path), name="images")
+    app.mount("/images", ImmutableStaticFiles(directory=images_path), name="images")
     
     @app.get("/{full_path:path}")
     async def serve_frontend(full_path: str):
@@ -0,0 +1,37 @@
+"""
+熔断器探测名额中间件
+
+半开状态的熔断器只放行少量探测请求。探测请求如果没有产生结果就结束
+（客户端断开、没有可用凭证、被其他异常中断），名额不会被成功/失败记录释放，
+原来要等 PROBE_TIMEOUT 秒后才允许新的探测，期间该模型家族的请求全部被拒绝。
+
+这里在 ASGI 层包住整个请求（包括流式响应体的发送），请求结束时在 finally 中归还本请求持有的探测名额。
+"""
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.services.circuit_breaker import circuit_breakers, PROBES_SCOPE_KEY
+
+
+class CircuitProbeMiddleware:
+    """
+    ASGI 中间件：请求结束时归还未产生结果的熔断探测名额
+
+    使用方式：
+        from app.middleware.circuit_probe import CircuitProbeMiddleware
+        app.add_middleware(CircuitProbeMiddleware)
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        probes = scope[PROBES_SCOPE_KEY] = []
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if probes:
+                circuit_breakers.release_probes(probes)
@@ -45,6 +45,7 @@ class APIKey(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_used_at = Column(DateTime, nullable=True)
+    response_cache = Column(Boolean, default=False)  # 是否开启响应缓存（相同请求直接返回缓存结果）
     
     # 关系
     user = relationship("User", back_populates="api_keys")
@@ -81,6 +82,7 @@ class UsageLog(Base):
     error_code = Column(String(100), nullable=True)  # 错误码：PERMISSION_DENIED, RESOURCE_EXHAUSTED 等
     credential_email = Column(String(100), nullable=True)  # 使用的凭证邮箱（方便排查）
     retry_count = Column(Integer, default=0)  # 重试次数：0表示首次成功，>0表示经过重试
+    cache_hit = Column(Boolean, default=False)  # 是否由响应缓存直接返回（未使用凭证）
     
     # 关系
     user = relationship("User", back_populates="usage_logs")
@@ -165,3 +167,15 @@ class ErrorMessageConfig(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+
+
+class LeaderLock(Base):
+    """主 worker 锁（未启用 Redis 时的选主方式）
+
+    持有者在到期前不断续期；持有者退出或卡住时锁过期，由其他 worker 接管。
+    """
+    __tablename__ = "leader_locks"
+    
+    name = Column(String(50), primary_key=True)
+    owner = Column(String(64), nullable=False)   # 持有者（worker 标识）
+    expires_at = Column(DateTime, nullable=False)
@@ -11,7 +11,7 @@ from app.services.auth import get_current_admin, get_password_hash
 from app.services.credential_pool import CredentialPool
 from app.services.websocket import notify_user_update, notify_credential_update
 from app.services.error_classifier import ErrorType, ERROR_TYPE_NAMES, get_error_type_name
-from app.cache import cached, CACHE_KEYS
+from app.cache import cached, invalidate_cache, CACHE_KEYS
 
 router = APIRouter(prefix="/api/admin", tags=["管理后台"])
 
@@ -157,6 +157,7 @@ async def update_user(
         user.quota_30pro = data.quota_30pro
     
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
     await notify_user_update()
     return {"message": "更新成功"}
 
@@ -191,6 +192,7 @@ async def delete_user(
     
     await db.delete(user)
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
     await notify_user_update()
     await notify_credential_update()
     return {"message": "删除成功（已同时删除关联凭证）"}
@@ -214,6 +216,7 @@ async def update_user_password(
     
     user.hashed_password = get_password_hash(data.new_password)
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
     return {"message": f"用户 {user.username} 的密码已重置"}
 
 
@@ -959,8 +962,8 @@ async def set_default_quota(
     admin: User = Depends(get_current_admin)
 ):
     """设置新用户默认配额"""
-    from app.config import settings
-    settings.default_daily_quota = data.quota
+    from app.config import save_config_to_db
+    await save_config_to_db("default_daily_quota", data.quota)
     return {"message": "默认配额已更新", "quota": data.quota}
 
 
@@ -975,5 +978,6 @@ async def batch_update_quota(
         update(User).values(daily_quota=data.quota)
     )
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
     await notify_user_update()
     return {"message": f"已将所有用户配额设为 {data.quota}"}
@@ -3,18 +3,29 @@ from fastapi.responses import StreamingResponse, JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func, or_, and_
 from datetime import datetime, timedelta
+import asyncio
 import json
 import time
 
-from app.database import get_db, async_session
+from app.database import get_db, async_session, db_writer
+from app.services.usage_buffer import usage_buffer
 from app.models.user import User, UsageLog
 from app.services.auth import get_user_by_api_key
 from app.services.credential_pool import CredentialPool
 from app.services.antigravity_client import AntigravityClient
+from app.services.antigravity_models import antigravity_model_cache, get_pool_scope
 from app.services.websocket import notify_log_update, notify_stats_update
 from app.services.error_classifier import classify_error_simple
 from app.services.error_message_service import get_custom_error_message
-from app.config import settings
+from app.services.circuit_breaker import circuit_breakers, circuit_open_exception
+from app.config import settings, config_snapshot
+from app.utils.heartbeat import wait_with_heartbeat
+from app.utils.usage import usage_to_log_tokens
+from app.utils.disconnect import cancel_on_disconnect, CLIENT_CLOSED_REQUEST
+from app.services.response_cache import (
+    response_cache, record_cache_hit, replay_openai_response,
+    is_cacheable_openai_response, OpenAIStreamCollector,
+)
 import re
 
 router = APIRouter(prefix="/antigravity", tags=["Antigravity API代理"])
@@ -69,6 +80,7 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
     user = await get_user_by_api_key(db, api_key)
     if not user:
         raise HTTPException(status_code=401, detail="无效的API Key")
+    request.state.api_key = api_key  # 供响应缓存判断 API Key 开关
     
     if not user.is_active:
         raise HTTPException(status_code=403, detail="账户已被禁用")
@@ -153,6 +165,7 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
             )
             .where(UsageLog.user_id == user.id)
             .where(UsageLog.created_at >= start_of_day)
+            .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         )
         usage_stats = usage_stats_result.one()
         current_usage = usage_stats.model_usage or 0
@@ -188,135 +201,15 @@ async def options_handler():
 @router.get("/v1/models")
 @router.get("/models")
 async def list_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
-    """列出可用模型 (OpenAI兼容) - Antigravity"""
-    from app.models.user import Credential
-    
-    # 检查是否有可用的 3.0 Antigravity 凭证
+    """列出可用模型 (OpenAI兼容) - Antigravity
+
+    按 (凭证池范围, 等级) 缓存，不选取凭证、不写数据库（见 antigravity_models.py）
+    """
     has_tier3 = await CredentialPool.has_tier3_credentials(user, db, mode="antigravity")
-    
-    # 尝试从 Antigravity API 获取动态模型列表
     user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id, mode="antigravity")
-    credential = await CredentialPool.get_available_credential(
-        db, user_id=user.id, user_has_public_creds=user_has_public, model="gemini-2.5-flash",
-        mode="antigravity"  # 使用 Antigravity 凭证
-    )
-    
-    if credential:
-        access_token = await CredentialPool.get_access_token(credential, db)
-        if access_token:
-            project_id = credential.project_id or ""
-            client = AntigravityClient(access_token, project_id)
-            try:
-                dynamic_models = await client.fetch_available_models()
-                if dynamic_models:
-                    print(f"[Antigravity] 🔍 动态模型数量: {len(dynamic_models)}", flush=True)
-                    
-                    # 过滤掉不需要的测试/内部模型
-                    # 只保留标准的 gemini, claude, gpt 模型
-                    def is_valid_model(model_id: str) -> bool:
-                        model_lower = model_id.lower()
-                        # 排除条件：包含这些关键字的跳过
-                        invalid_patterns = [
-                            "chat_", "rev", "tab_", "uic", "test", "exp", "lite_preview",
-                            "2.5", "gemini-2", "gcli-"
-                        ]
-                        for pattern in invalid_patterns:
-                            if pattern in model_lower:
-                                return False
-                        # 允许条件：必须是 gemini, claude, gpt 开头的模型
-                        valid_prefixes = ["gemini-3", "claude", "gpt-oss", "agy-gemini-3", "agy-claude", "agy-gpt"]
-                        for prefix in valid_prefixes:
-                            if model_lower.startswith(prefix):
-                                return True
-                        return False
-                    
-                    # 添加流式抗截断变体（假非流已自动处理，不需要单独列出）
-                    models = []
-                    for m in dynamic_models:
-                        model_id = m.get("id", "")
-                        # 过滤无效模型
-                        if not is_valid_model(model_id):
-                            continue
-                        models.append({"id": model_id, "object": "model", "owned_by": "google"})
-                        models.append({"id": f"流式抗截断/{model_id}", "object": "model", "owned_by": "google"})
-                        
-                        if "image" in model_id.lower() and "2k" not in model_id.lower() and "4k" not in model_id.lower():
-                            models.append({"id": f"{model_id}-2k", "object": "model", "owned_by": "google"})
-                            models.append({"id": f"{model_id}-4k", "object": "model", "owned_by": "google"})
-                            if not model_id.startswith("agy-"):
-                                models.append({"id": f"agy-{model_id}-2k", "object": "model", "owned_by": "google"})
-                                models.append({"id": f"agy-{model_id}-4k", "object": "model", "owned_by": "google"})
-                    
-                    # 强制添加 Claude 模型的不带 -thinking 后缀版本
-                    claude_base_models = [
-                        "claude-opus-4-5", "agy-claude-opus-4-5",
-                        "claude-sonnet-4-5", "agy-claude-sonnet-4-5",
-                    ]
-                    existing_ids = {m["id"] for m in models}
-                    for base_model in claude_base_models:
-                        if base_model not in existing_ids:
-                            models.append({"id": base_model, "object": "model", "owned_by": "google"})
-                            models.append({"id": f"流式抗截断/{base_model}", "object": "model", "owned_by": "google"})
-                            print(f"[Antigravity] ✅ 强制添加 Claude 基础模型: {base_model}", flush=True)
-                    
-                    image_variants = [
-                        "gemini-3-pro-image", "agy-gemini-3-pro-image",
-                        "gemini-3-pro-image-2k", "agy-gemini-3-pro-image-2k",
-                        "流式抗截断/gemini-3-pro-image-2k", "流式抗截断/agy-gemini-3-pro-image-2k",
-                        "gemini-3-pro-image-4k", "agy-gemini-3-pro-image-4k",
-                        "流式抗截断/gemini-3-pro-image-4k", "流式抗截断/agy-gemini-3-pro-image-4k",
-                    ]
-                    existing_ids = {m["id"] for m in models}
-                    for variant in image_variants:
-                        if variant not in existing_ids:
-                            models.append({"id": variant, "object": "model", "owned_by": "google"})
-                            print(f"[Antigravity] ✅ 强制添加图片模型变体: {variant}", flush=True)
-                    
-                    # 调试：打印所有图片相关模型
-                    image_models = [m["id"] for m in models if "image" in m["id"].lower()]
-                    print(f"[Antigravity] 📷 图片模型列表: {image_models}", flush=True)
-                    
-                    return {"object": "list", "data": models}
-            except Exception as e:
-                print(f"[Antigravity] 获取动态模型列表失败: {e}", flush=True)
-    
-    # 回退到静态模型列表 (仅 3.0 级别模型，2.5已移除)
-    base_models = [
-        # Gemini 3.0 模型
-        "gemini-3-pro-preview",
-        "gemini-3-flash-preview",
-        # Gemini 3.0 图片生成模型
-        "gemini-3-pro-image",
-        "gemini-3-pro-image-2k",
-        "gemini-3-pro-image-4k",
-        # Claude 模型 (Antigravity 独有) - 使用用户友好的名称
-        "claude-sonnet-4-5",
-        "claude-opus-4-5",
-        # GPT-OSS 模型 (Antigravity 独有)
-        "gpt-oss-120b",
-    ]
-    
-    thinking_suffixes = ["-maxthinking", "-nothinking", "-thinking"]
-    search_suffix = "-search"
-    
-    models = []
-    for base in base_models:
-        # 基础模型
-        models.append({"id": f"agy-{base}", "object": "model", "owned_by": "google"})
-        models.append({"id": base, "object": "model", "owned_by": "google"})
-        models.append({"id": f"流式抗截断/{base}", "object": "model", "owned_by": "google"})
-        
-        # 思维模式变体 (仅 Claude 和部分 Gemini)
-        if base.startswith("claude") or "pro" in base:
-            for suffix in thinking_suffixes:
-                models.append({"id": f"agy-{base}{suffix}", "object": "model", "owned_by": "google"})
-                models.append({"id": f"{base}{suffix}", "object": "model", "owned_by": "google"})
-        
-        # 搜索变体 (Gemini 和 Claude 都支持)
-        if base.startswith("gemini") or base.startswith("claude"):
-            models.append({"id": f"agy-{base}{search_suffix}", "object": "model", "owned_by": "google"})
-            models.append({"id": f"{base}{search_suffix}", "object": "model", "owned_by": "google"})
     
+    scope = get_pool_scope(user.id, user_has_public)
+    models = await antigravity_model_cache.get_models(scope, "3" if has_tier3 else "2.5")
     return {"object": "list", "data": models}
 
 
@@ -354,6 +247,9 @@ async def chat_completions(
     # 检查用户是否有公开的 Antigravity 凭证
     user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id, mode="antigravity")
     
+    # 本次请求使用的配置快照（请求处理中配置变更不影响本次请求）
+    cfg = config_snapshot()
+    
     # 速率限制检查
     if not user.is_admin:
         one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
@@ -361,20 +257,21 @@ async def chat_completions(
             select(func.count(UsageLog.id))
             .where(UsageLog.user_id == user.id)
             .where(UsageLog.created_at >= one_minute_ago)
+            .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.antigravity_contributor_rpm if user_has_public else settings.antigravity_base_rpm
+        max_rpm = cfg.antigravity_contributor_rpm if user_has_public else cfg.antigravity_base_rpm
         
         if current_rpm >= max_rpm:
             raise HTTPException(
                 status_code=429, 
-                detail=f"Antigravity 速率限制: {max_rpm} 次/分钟。{'上传 Antigravity 凭证可提升至 ' + str(settings.antigravity_contributor_rpm) + ' 次/分钟' if not user_has_public else ''}"
+                detail=f"Antigravity 速率限制: {max_rpm} 次/分钟。{'上传 Antigravity 凭证可提升至 ' + str(cfg.antigravity_contributor_rpm) + ' 次/分钟' if not user_has_public else ''}"
             )
     
     # Antigravity 配额检查
-    if settings.antigravity_quota_enabled and not user.is_admin:
+    if cfg.antigravity_quota_enabled and not user.is_admin:
         # 获取用户配额（先检查用户自定义配额，否则用系统默认）
-        user_quota = user.quota_antigravity if user.quota_antigravity > 0 else settings.antigravity_quota_default
+        user_quota = user.quota_antigravity if user.quota_antigravity > 0 else cfg.antigravity_quota_default
         user_used = user.used_antigravity or 0
         
         if user_used >= user_quota:
@@ -401,9 +298,31 @@ async def chat_completions(
     await db.commit()
     await db.refresh(placeholder_log)
     placeholder_log_id = placeholder_log.id
+
+    # 响应缓存：命中时直接返回，不选取凭证、不触发 CD
+    response_cache_key = None
+    if await response_cache.is_enabled(request, db, body.get("temperature"), body.get("n")):
+        response_cache_key = await response_cache.chat_key(user.id, "antigravity", body)
+        cached_response = await response_cache.get(response_cache_key)
+        if cached_response is not None:
+            latency = (time.time() - start_time) * 1000
+            await record_cache_hit(db, placeholder_log, user.username, f"antigravity/{model}", latency, cached_response)
+            return replay_openai_response(cached_response, stream)
+    
+    # 上游熔断中：直接返回 503，不选取凭证
+    upstream = settings.antigravity_api_base
+    retry_after = circuit_breakers.acquire(upstream, model, request)
+    if retry_after:
+        placeholder_log.status_code = 503
+        placeholder_log.latency_ms = (time.time() - start_time) * 1000
+        placeholder_log.error_type = "UPSTREAM_ERROR"
+        placeholder_log.error_code = "CIRCUIT_OPEN"
+        placeholder_log.error_message = "上游熔断中"
+        await db.commit()
+        raise circuit_open_exception(upstream, model, retry_after)
     
     # 获取 Antigravity 凭证
-    max_retries = settings.error_retry_count
+    max_retries = cfg.error_retry_count
     tried_credential_ids = set()
     
     credential = await CredentialPool.get_available_credential(
@@ -467,6 +386,7 @@ async def chat_completions(
         raise HTTPException(status_code=503, detail="凭证未激活 Antigravity，无法获取 project_id")
     first_credential_id = credential.id
     first_credential_email = credential.email
+    first_credential_selection = credential.selection
     print(f"[Antigravity Proxy] ★★★ 凭证信息 ★★★", flush=True)
     print(f"[Antigravity Proxy] ★ 凭证邮箱: {credential.email}", flush=True)
     print(f"[Antigravity Proxy] ★ Project ID: {project_id}", flush=True)
@@ -488,9 +408,11 @@ async def chat_completions(
                 result = await client.chat_completions(
                     model=model,
                     messages=messages,
+                    cache_scope=f"user:{user.id}",
                     server_base_url=str(request.base_url).rstrip("/"),
-                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream", "cache_scope"]}
                 )
+                circuit_breakers.record_success(upstream, model)
                 
                 latency = (time.time() - start_time) * 1000
                 
@@ -499,11 +421,10 @@ async def chat_completions(
                 placeholder_log.latency_ms = latency
                 placeholder_log.credential_email = credential.email
                 placeholder_log.retry_count = retry_attempt
+                placeholder_log.tokens_input, placeholder_log.tokens_output = usage_to_log_tokens(client.last_usage)
                 await db.commit()
                 
-                credential.total_requests = (credential.total_requests or 0) + 1
-                credential.last_used_at = datetime.utcnow()
-                await db.commit()
+                usage_buffer.add_credential_use(credential.id)
                 
                 await notify_log_update({
                     "username": user.username,
@@ -514,11 +435,15 @@ async def chat_completions(
                 })
                 await notify_stats_update()
                 
+                if response_cache_key and is_cacheable_openai_response(result):
+                    await response_cache.set(response_cache_key, result)
+                
                 return JSONResponse(content=result)
                 
             except Exception as e:
                 error_str = str(e)
                 last_error = error_str
+                breaker_open = circuit_breakers.record_failure(upstream, model, error_str, request=request)
                 
                 # 检查是否是 Token 过期导致的 401 错误
                 is_auth_error = any(code in error_str for code in ["401", "UNAUTHENTICATED", "invalid_grant", "Token has been expired", "token expired"])
@@ -540,14 +465,17 @@ async def chat_completions(
                         # 刷新失败，禁用凭证
                         print(f"[Antigravity Proxy] ❌ Token 刷新失败，禁用凭证: {credential.email}", flush=True)
                         await CredentialPool.handle_credential_failure(db, credential.id, error_str)
+                elif breaker_open:
+                    # 上游熔断：不是凭证的问题，不记错误，释放本次选取设置的 CD
+                    await CredentialPool.release_model_group_cd(db, credential.id, model, credential.selection)
                 else:
                     # 非认证错误，照常处理
                     await CredentialPool.handle_credential_failure(db, credential.id, error_str)
                 
-                # 决定是否切换凭证重试（增加401到重试列表）
+                # 决定是否切换凭证重试（增加401到重试列表；熔断后不再重试）
                 should_retry = any(code in error_str for code in ["401", "404", "500", "502", "503", "504", "429", "UNAUTHENTICATED", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
                 
-                if should_retry and retry_attempt < max_retries:
+                if should_retry and not breaker_open and retry_attempt < max_retries:
                     print(f"[Antigravity Proxy] ⚠️ 请求失败: {error_str}，切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
                     
                     credential = await CredentialPool.get_available_credential(
@@ -566,7 +494,7 @@ async def chat_completions(
                     print(f"[Antigravity Proxy] 🔄 切换到凭证: {credential.email}", flush=True)
                     continue
                 
-                status_code = extract_status_code(error_str)
+                status_code = 503 if breaker_open else extract_status_code(error_str)
                 latency = (time.time() - start_time) * 1000
                 error_type, error_code = classify_error_simple(status_code, error_str)
                 
@@ -575,86 +503,105 @@ async def chat_completions(
                 placeholder_log.latency_ms = latency
                 placeholder_log.error_message = error_str[:2000]
                 placeholder_log.error_type = error_type
-                placeholder_log.error_code = error_code
+                placeholder_log.error_code = "CIRCUIT_OPEN" if breaker_open else error_code
                 placeholder_log.credential_email = credential.email
                 placeholder_log.request_body = request_body_str
                 placeholder_log.retry_count = retry_attempt
                 await db.commit()
                 
+                if breaker_open:
+                    raise circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), error_str)
                 raise HTTPException(status_code=status_code, detail=f"Antigravity API调用失败 (已重试 {retry_attempt + 1} 次): {error_str}")
         
         raise HTTPException(status_code=503, detail=f"所有凭证都失败了: {last_error}")
     
+    async def on_client_disconnect(cred_id: int, cred_email: str, selection: tuple):
+        """客户端断开：占位日志仍在处理中时记录为客户端取消，并释放本次占用的凭证 CD"""
+        latency = (time.time() - start_time) * 1000
+        error_type, error_code = classify_error_simple(CLIENT_CLOSED_REQUEST, "")
+        
+        async def write_cancel(bg_db):
+            # 日志更新和 CD 释放在同一个写队列事务中提交
+            log_result = await bg_db.execute(
+                select(UsageLog).where(UsageLog.id == placeholder_log_id)
+            )
+            log = log_result.scalar_one_or_none()
+            if not log or log.status_code != 0:
+                return False  # 结果已记录，断开发生在响应发送之后
+            log.credential_id = cred_id
+            log.status_code = CLIENT_CLOSED_REQUEST
+            log.latency_ms = latency
+            log.error_message = "客户端断开连接，已取消上游请求"
+            log.error_type = error_type
+            log.error_code = error_code
+            log.credential_email = cred_email
+            await CredentialPool.release_model_group_cd(bg_db, cred_id, model, selection, commit=False)
+            return True
+        
+        if not await db_writer.run(write_cancel):
+            return
+        
+        print(f"[Antigravity Proxy] ⚠️ 客户端断开，已取消上游请求: user={user.username}, model={model}", flush=True)
+        await notify_log_update({
+            "username": user.username,
+            "model": f"antigravity/{model}",
+            "status_code": CLIENT_CLOSED_REQUEST,
+            "error_type": error_type,
+            "latency_ms": round(latency, 0),
+            "created_at": datetime.utcnow().isoformat()
+        })
+    
     # 假非流模式：以流式调用 API，发送心跳保持连接，最后返回普通 JSON
     # 适用于：前端强制非流式（stream=false），但需要防止 Cloudflare 504 超时
     async def fake_non_stream_generator():
         nonlocal credential, access_token, project_id, client, tried_credential_ids, last_error
         
-        heartbeat_interval = 15  # 每15秒发送一次心跳（空格）
+        heartbeat_interval = settings.fake_non_stream_heartbeat_interval  # 心跳间隔（发送空格）
         
         for retry_attempt in range(max_retries + 1):
             try:
-                full_content = ""
-                reasoning_content = ""
-                last_heartbeat = time.time()
-                
-                async for chunk in client.chat_completions_stream(
+                # 直接聚合上游 Gemini 分块，等待期间按间隔发送空格心跳
+                request_task = asyncio.create_task(client.chat_completions_aggregate(
                     model=model,
                     messages=messages,
+                    cache_scope=f"user:{user.id}",
                     server_base_url=str(request.base_url).rstrip("/"),
-                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                ):
-                    # 定期发送心跳保持连接
-                    if time.time() - last_heartbeat > heartbeat_interval:
-                        yield " "  # 发送空格作为心跳
-                        last_heartbeat = time.time()
-                    
-                    # 解析流式响应块，提取内容
-                    if chunk.startswith("data: "):
-                        chunk_data = chunk[6:]
-                        if chunk_data.strip() == "[DONE]":
-                            continue
-                        try:
-                            chunk_json = json.loads(chunk_data)
-                            if "choices" in chunk_json and chunk_json["choices"]:
-                                delta = chunk_json["choices"][0].get("delta", {})
-                                if "content" in delta:
-                                    full_content += delta["content"]
-                                if "reasoning_content" in delta:
-                                    reasoning_content += delta["reasoning_content"]
-                        except json.JSONDecodeError:
-                            pass
+                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream", "cache_scope"]}
+                ))
+                try:
+                    async for _ in wait_with_heartbeat(request_task, heartbeat_interval):
+                        yield " "
+                finally:
+                    # 客户端断开时取消上游请求
+                    if not request_task.done():
+                        request_task.cancel()
+                result = await request_task
+                circuit_breakers.record_success(upstream, model)
                 
                 # 收集完成，更新日志
                 latency = (time.time() - start_time) * 1000
                 
+                async def write_log(bg_db):
+                    log_result = await bg_db.execute(
+                        select(UsageLog).where(UsageLog.id == placeholder_log_id)
+                    )
+                    log = log_result.scalar_one_or_none()
+                    if log:
+                        log.credential_id = credential.id
+                        log.status_code = 200
+                        log.latency_ms = latency
+                        log.credential_email = credential.email
+                        log.retry_count = retry_attempt
+                        log.tokens_input, log.tokens_output = usage_to_log_tokens(client.last_usage)
+                
                 try:
-                    async with async_session() as bg_db:
-                        log_result = await bg_db.execute(
-                            select(UsageLog).where(UsageLog.id == placeholder_log_id)
-                        )
-                        log = log_result.scalar_one_or_none()
-                        if log:
-                            log.credential_id = credential.id
-                            log.status_code = 200
-                            log.latency_ms = latency
-                            log.credential_email = credential.email
-                            log.retry_count = retry_attempt
-                        
-                        # 更新凭证使用次数
-                        from app.models.user import Credential as CredentialModel
-                        cred_result = await bg_db.execute(
-                            select(CredentialModel).where(CredentialModel.id == credential.id)
-                        )
-                        cred = cred_result.scalar_one_or_none()
-                        if cred:
-                            cred.total_requests = (cred.total_requests or 0) + 1
-                            cred.last_used_at = datetime.utcnow()
-                        
-                        await bg_db.commit()
+                    await db_writer.run(write_log)
                 except Exception as log_err:
                     print(f"[Antigravity Proxy] ⚠️ 假非流日志记录失败: {log_err}", flush=True)
                 
+                # 更新凭证使用次数
+                usage_buffer.add_credential_use(credential.id)
+                
                 await notify_log_update({
                     "username": user.username,
                     "model": f"antigravity/{model}",
@@ -664,33 +611,16 @@ async def chat_completions(
                 })
                 await notify_stats_update()
                 
-                # 构建并返回 JSON 响应
-                message = {"role": "assistant", "content": full_content}
-                if reasoning_content:
-                    message["reasoning_content"] = reasoning_content
-                
-                result = {
-                    "id": "chatcmpl-antigravity",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": model,
-                    "choices": [{
-                        "index": 0,
-                        "message": message,
-                        "finish_reason": "stop"
-                    }],
-                    "usage": {
-                        "prompt_tokens": 0,
-                        "completion_tokens": 0,
-                        "total_tokens": 0
-                    }
-                }
+                if response_cache_key and is_cacheable_openai_response(result):
+                    await response_cache.set(response_cache_key, result)
+                
                 yield json.dumps(result)
                 return
                 
             except Exception as e:
                 error_str = str(e)
                 last_error = error_str
+                breaker_open = circuit_breakers.record_failure(upstream, model, error_str, request=request)
                 
                 # 检查是否是 Token 过期导致的 401 错误
                 is_auth_error = any(code in error_str for code in ["401", "UNAUTHENTICATED", "invalid_grant", "Token has been expired", "token expired"])
@@ -723,16 +653,19 @@ async def chat_completions(
                     except Exception as refresh_err:
                         print(f"[Antigravity Proxy] ⚠️ 假非流 Token 刷新异常: {refresh_err}", flush=True)
                 else:
-                    # 非认证错误，照常处理
+                    # 非认证错误，照常处理（上游熔断时不记错误，释放本次选取设置的 CD）
                     try:
                         async with async_session() as bg_db:
-                            await CredentialPool.handle_credential_failure(bg_db, credential.id, error_str)
+                            if breaker_open:
+                                await CredentialPool.release_model_group_cd(bg_db, credential.id, model, credential.selection)
+                            else:
+                                await CredentialPool.handle_credential_failure(bg_db, credential.id, error_str)
                     except:
                         pass
                 
                 should_retry = any(code in error_str for code in ["401", "404", "500", "502", "503", "504", "429", "UNAUTHENTICATED", "RESOURCE_EXHAUSTED", "NOT_FOUND"])
                 
-                if should_retry and retry_attempt < max_retries:
+                if should_retry and not breaker_open and retry_attempt < max_retries:
                     print(f"[Antigravity Proxy] ⚠️ 假非流请求失败: {error_str}，切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
                     
                     try:
@@ -756,6 +689,9 @@ async def chat_completions(
                         print(f"[Antigravity Proxy] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
                 
                 # 失败，返回错误 JSON
+                if breaker_open:
+                    yield json.dumps({"error": circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), error_str).detail})
+                    return
                 yield json.dumps({"error": f"Antigravity 假非流调用失败: {error_str}"})
                 return
         
@@ -768,7 +704,10 @@ async def chat_completions(
     if use_fake_streaming or not stream:
         print(f"[Antigravity Proxy] 🔄 使用假非流模式 (use_fake_streaming={use_fake_streaming}, stream={stream})", flush=True)
         return StreamingResponse(
-            fake_non_stream_generator(),
+            cancel_on_disconnect(
+                fake_non_stream_generator(),
+                lambda: on_client_disconnect(credential.id, credential.email, credential.selection)
+            ),
             media_type="application/json",
             headers={"Cache-Control": "no-cache"}
         )
@@ -776,16 +715,16 @@ async def chat_completions(
     # 流式处理
     async def save_log_background(log_data: dict):
         try:
-            async with async_session() as bg_db:
-                latency = log_data.get("latency_ms", 0)
-                status_code = log_data.get("status_code", 200)
-                error_msg = log_data.get("error_message")
-                
-                error_type = None
-                error_code = None
-                if status_code != 200 and error_msg:
-                    error_type, error_code = classify_error_simple(status_code, error_msg)
-                
+            latency = log_data.get("latency_ms", 0)
+            status_code = log_data.get("status_code", 200)
+            error_msg = log_data.get("error_message")
+            
+            error_type = None
+            error_code = None
+            if status_code != 200 and error_msg:
+                error_type, error_code = classify_error_simple(status_code, error_msg)
+            
+            async def write_log(bg_db):
                 log_result = await bg_db.execute(
                     select(UsageLog).where(UsageLog.id == placeholder_log_id)
                 )
@@ -800,75 +739,88 @@ async def chat_completions(
                     log.credential_email = log_data.get("cred_email")
                     log.request_body = request_body_str if status_code != 200 else None
                     log.retry_count = log_data.get("retry_count", 0)
-                
-                cred_id = log_data.get("cred_id")
-                if cred_id:
-                    from app.models.user import Credential
-                    cred_result = await bg_db.execute(
-                        select(Credential).where(Credential.id == cred_id)
-                    )
-                    cred = cred_result.scalar_one_or_none()
-                    if cred:
-                        cred.total_requests = (cred.total_requests or 0) + 1
-                        cred.last_used_at = datetime.utcnow()
-                
-                await bg_db.commit()
-                
-                await notify_log_update({
-                    "username": user.username,
-                    "model": f"antigravity/{model}",
-                    "status_code": status_code,
-                    "error_type": error_type,
-                    "latency_ms": round(latency, 0),
-                    "created_at": datetime.utcnow().isoformat()
-                })
-                await notify_stats_update()
-                print(f"[Antigravity Proxy] ✅ 后台日志已记录: user={user.username}, model={model}, status={status_code}", flush=True)
+                    log.tokens_input, log.tokens_output = usage_to_log_tokens(log_data.get("usage"))
+            
+            await db_writer.run(write_log)
+            
+            if log_data.get("cred_id"):
+                usage_buffer.add_credential_use(log_data["cred_id"])
+            
+            await notify_log_update({
+                "username": user.username,
+                "model": f"antigravity/{model}",
+                "status_code": status_code,
+                "error_type": error_type,
+                "latency_ms": round(latency, 0),
+                "created_at": datetime.utcnow().isoformat()
+            })
+            await notify_stats_update()
+            print(f"[Antigravity Proxy] ✅ 后台日志已记录: user={user.username}, model={model}, status={status_code}", flush=True)
         except Exception as log_err:
             print(f"[Antigravity Proxy] ❌ 后台日志记录失败: {log_err}", flush=True)
     
+    current_cred_id = first_credential_id
+    current_cred_email = first_credential_email
+    current_cred_selection = first_credential_selection
+    
     async def stream_generator_with_retry():
-        nonlocal access_token, project_id, client, tried_credential_ids, last_error
-        current_cred_id = first_credential_id
-        current_cred_email = first_credential_email
+        nonlocal access_token, project_id, client, tried_credential_ids, last_error, current_cred_id, current_cred_email, current_cred_selection
+        # 已经向客户端输出过数据后不能再刷新 Token / 换凭证重试（客户端会收到重复/拼接的内容），只能输出错误结束
+        yielded = False
         
         for stream_retry in range(max_retries + 1):
+            collector = OpenAIStreamCollector() if response_cache_key else None
             try:
                 if use_fake_streaming:
                     async for chunk in client.chat_completions_fake_stream(
                         model=model,
                         messages=messages,
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                        cache_scope=f"user:{user.id}",
+                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream", "cache_scope"]}
                     ):
+                        if collector:
+                            collector.feed(chunk)
+                        yielded = True
                         yield chunk
                 else:
                     async for chunk in client.chat_completions_stream(
                         model=model,
                         messages=messages,
+                        cache_scope=f"user:{user.id}",
                         server_base_url=str(request.base_url).rstrip("/"),
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream", "cache_scope"]}
                     ):
+                        if collector:
+                            collector.feed(chunk)
+                        yielded = True
                         yield chunk
                 
+                circuit_breakers.record_success(upstream, model)
                 latency = (time.time() - start_time) * 1000
                 await save_log_background({
                     "status_code": 200,
                     "cred_id": current_cred_id,
                     "cred_email": current_cred_email,
                     "latency_ms": latency,
-                    "retry_count": stream_retry
+                    "retry_count": stream_retry,
+                    "usage": client.last_usage
                 })
+                if collector:
+                    cacheable_result = collector.build()
+                    if cacheable_result:
+                        await response_cache.set(response_cache_key, cacheable_result)
                 yield "data: [DONE]\n\n"
                 return
                 
             except Exception as e:
                 error_str = str(e)
                 last_error = error_str
+                breaker_open = circuit_breakers.record_failure(upstream, model, error_str, request=request)
                 
                 # 检查是否是 Token 过期导致的 401 错误
                 is_auth_error = any(code in error_str for code in ["401", "UNAUTHENTICATED", "invalid_grant", "Token has been expired", "token expired"])
                 
-                if is_auth_error:
+                if is_auth_error and not yielded:
                     # 先尝试刷新当前凭证的 Token
                     print(f"[Antigravity Proxy] ⚠️ 流式认证失败，尝试刷新 Token: {current_cred_email}", flush=True)
                     try:
@@ -893,15 +845,19 @@ async def chat_completions(
                     except Exception as refresh_err:
                         print(f"[Antigravity Proxy] ⚠️ 流式 Token 刷新异常: {refresh_err}", flush=True)
                 else:
+                    # 上游熔断时不记错误，释放本次选取设置的 CD
                     try:
                         async with async_session() as stream_db:
-                            await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
+                            if breaker_open:
+                                await CredentialPool.release_model_group_cd(stream_db, current_cred_id, model, current_cred_selection)
+                            else:
+                                await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
                     except Exception as db_err:
                         print(f"[Antigravity Proxy] ⚠️ 标记凭证失败时出错: {db_err}", flush=True)
                 
-                should_retry = any(code in error_str for code in ["401", "404", "500", "502", "503", "504", "429", "UNAUTHENTICATED", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
+                should_retry = not yielded and any(code in error_str for code in ["401", "404", "500", "502", "503", "504", "429", "UNAUTHENTICATED", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
                 
-                if should_retry and stream_retry < max_retries:
+                if should_retry and not breaker_open and stream_retry < max_retries:
                     print(f"[Antigravity Proxy] ⚠️ 流式请求失败: {error_str}，切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
                     
                     try:
@@ -916,6 +872,7 @@ async def chat_completions(
                                 new_token, new_project_id = await CredentialPool.get_access_token_and_project(new_credential, stream_db, mode="antigravity")
                                 if new_token and new_project_id:
                                     current_cred_id = new_credential.id
+                                    current_cred_selection = new_credential.selection
                                     current_cred_email = new_credential.email
                                     access_token = new_token
                                     project_id = new_project_id
@@ -925,7 +882,7 @@ async def chat_completions(
                     except Exception as retry_err:
                         print(f"[Antigravity Proxy] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
                 
-                status_code = extract_status_code(error_str)
+                status_code = 503 if breaker_open else extract_status_code(error_str)
                 latency = (time.time() - start_time) * 1000
                 await save_log_background({
                     "status_code": status_code,
@@ -935,11 +892,18 @@ async def chat_completions(
                     "latency_ms": latency,
                     "retry_count": stream_retry
                 })
+                if breaker_open:
+                    error_detail = circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), error_str).detail
+                    yield f"data: {json.dumps({'error': error_detail})}\n\n"
+                    return
                 yield f"data: {json.dumps({'error': f'Antigravity API Error (已重试 {stream_retry + 1} 次): {error_str}'})}\n\n"
                 return
     
     return StreamingResponse(
-        stream_generator_with_retry(),
+        cancel_on_disconnect(
+            stream_generator_with_retry(),
+            lambda: on_client_disconnect(current_cred_id, current_cred_email, current_cred_selection)
+        ),
         media_type="text/event-stream",
         headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
     )
@@ -12,6 +12,8 @@ from app.services.auth import (
     get_current_user
 )
 from app.config import settings
+from app.services.response_cache import response_cache
+from app.cache import invalidate_cache, CACHE_KEYS
 
 router = APIRouter(prefix="/api/auth", tags=["认证"])
 
@@ -44,6 +46,11 @@ class APIKeyResponse(BaseModel):
     is_active: bool
     created_at: datetime
     last_used_at: Optional[datetime]
+    response_cache: bool = False
+
+
+class APIKeyResponseCache(BaseModel):
+    enabled: bool
 
 
 @router.post("/register", response_model=TokenResponse)
@@ -131,6 +138,7 @@ async def get_me(user: User = Depends(get_current_user), db: AsyncSession = Depe
         select(func.count(UsageLog.id))
         .where(UsageLog.user_id == user.id)
         .where(UsageLog.created_at >= start_of_day)
+        .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
     )
     today_usage = result.scalar() or 0
     
@@ -139,6 +147,7 @@ async def get_me(user: User = Depends(get_current_user), db: AsyncSession = Depe
         select(func.count(UsageLog.id))
         .where(UsageLog.user_id == user.id)
         .where(UsageLog.created_at >= start_of_day)
+        .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         .where(UsageLog.model.notlike('%pro%'))
     )
     flash_usage = flash_result.scalar() or 0
@@ -147,6 +156,7 @@ async def get_me(user: User = Depends(get_current_user), db: AsyncSession = Depe
         select(func.count(UsageLog.id))
         .where(UsageLog.user_id == user.id)
         .where(UsageLog.created_at >= start_of_day)
+        .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         .where(UsageLog.model.like('%pro%'))
         .where(UsageLog.model.notlike('%3%'))
     )
@@ -156,6 +166,7 @@ async def get_me(user: User = Depends(get_current_user), db: AsyncSession = Depe
         select(func.count(UsageLog.id))
         .where(UsageLog.user_id == user.id)
         .where(UsageLog.created_at >= start_of_day)
+        .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         .where(UsageLog.model.like('%3%'))
     )
     pro30_usage = pro30_result.scalar() or 0
@@ -259,7 +270,8 @@ async def list_api_keys(user: User = Depends(get_current_user), db: AsyncSession
             key=k.key,
             is_active=k.is_active,
             created_at=k.created_at,
-            last_used_at=k.last_used_at
+            last_used_at=k.last_used_at,
+            response_cache=bool(k.response_cache)
         )
         for k in keys
     ]
@@ -291,7 +303,8 @@ async def create_api_key(
         key=api_key.key,
         is_active=api_key.is_active,
         created_at=api_key.created_at,
-        last_used_at=api_key.last_used_at
+        last_used_at=api_key.last_used_at,
+        response_cache=bool(api_key.response_cache)
     )
 
 
@@ -311,6 +324,7 @@ async def delete_api_key(
     
     await db.delete(api_key)
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
     return {"message": "删除成功"}
 
 
@@ -329,9 +343,42 @@ async def regenerate_api_key(
         raise HTTPException(status_code=404, detail="API Key不存在")
     
     # 生成新的 key
+    response_cache.invalidate_key_flag(api_key.key)
     api_key.key = APIKey.generate_key()
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
+    await db.refresh(api_key)
+    
+    return APIKeyResponse(
+        id=api_key.id,
+        name=api_key.name,
+        key=api_key.key,
+        is_active=api_key.is_active,
+        created_at=api_key.created_at,
+        last_used_at=api_key.last_used_at,
+        response_cache=bool(api_key.response_cache)
+    )
+
+
+@router.put("/api-keys/{key_id}/response-cache", response_model=APIKeyResponse)
+async def set_api_key_response_cache(
+    key_id: int,
+    data: APIKeyResponseCache,
+    user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """开启/关闭 API Key 的响应缓存（相同请求直接返回缓存结果）"""
+    result = await db.execute(
+        select(APIKey).where(APIKey.id == key_id, APIKey.user_id == user.id)
+    )
+    api_key = result.scalar_one_or_none()
+    if not api_key:
+        raise HTTPException(status_code=404, detail="API Key不存在")
+    
+    api_key.response_cache = data.enabled
+    await db.commit()
     await db.refresh(api_key)
+    response_cache.invalidate_key_flag(api_key.key)
     
     return APIKeyResponse(
         id=api_key.id,
@@ -339,7 +386,8 @@ async def regenerate_api_key(
         key=api_key.key,
         is_active=api_key.is_active,
         created_at=api_key.created_at,
-        last_used_at=api_key.last_used_at
+        last_used_at=api_key.last_used_at,
+        response_cache=bool(api_key.response_cache)
     )
 
 
@@ -706,6 +754,7 @@ async def update_my_credential(
         cred.note = note if note else None
     
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
     return {"message": "更新成功", "is_public": cred.is_public, "is_active": cred.is_active}
 
 
@@ -743,6 +792,7 @@ async def delete_my_credential(
     )
     await db.delete(cred)
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
     return {"message": "删除成功"}
 
 
@@ -1224,6 +1274,7 @@ async def regenerate_discord_user_key(discord_id: str, db: AsyncSession = Depend
         db.add(api_key)
     
     await db.commit()
+    await invalidate_cache(CACHE_KEYS["user"])
     
     return {
         "username": user.username,
@@ -14,6 +14,8 @@ from app.database import get_db
 from app.models.user import User, ErrorMessageConfig, SystemConfig
 from app.routers.auth import get_current_user
 from app.services.error_classifier import ErrorType, ERROR_TYPE_NAMES
+from app.services.error_message_service import reload_custom_error_messages
+from app.config import bump_config_version, publish_config_change
 
 router = APIRouter(prefix="/api/admin/error-messages", tags=["错误消息配置"])
 
@@ -79,6 +81,14 @@ async def get_feature_enabled(db: AsyncSession) -> bool:
     return config is not None and config.value == "true"
 
 
+async def commit_and_reload(db: AsyncSession):
+    """提交修改并重新编译规则；配置版本号加 1，其他 worker 随配置一起重新加载规则"""
+    version = await bump_config_version(db)
+    await db.commit()
+    await reload_custom_error_messages(db)
+    await publish_config_change(version, ["error_messages"])
+
+
 async def set_feature_enabled(db: AsyncSession, enabled: bool):
     """设置自定义错误消息功能开关"""
     result = await db.execute(
@@ -95,7 +105,7 @@ async def set_feature_enabled(db: AsyncSession, enabled: bool):
         )
         db.add(config)
     
-    await db.commit()
+    await commit_and_reload(db)
 
 
 # ===== API 端点 =====
@@ -179,7 +189,7 @@ async def create_error_message(
         is_active=data.is_active
     )
     db.add(config)
-    await db.commit()
+    await commit_and_reload(db)
     await db.refresh(config)
     return config
 
@@ -211,7 +221,7 @@ async def update_error_message(
     if data.is_active is not None:
         config.is_active = data.is_active
     
-    await db.commit()
+    await commit_and_reload(db)
     await db.refresh(config)
     return config
 
@@ -232,7 +242,7 @@ async def delete_error_message(
         raise HTTPException(status_code=404, detail="配置不存在")
     
     await db.delete(config)
-    await db.commit()
+    await commit_and_reload(db)
     return {"message": "删除成功"}
 
 
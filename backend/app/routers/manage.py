@@ -11,6 +11,7 @@ from datetime import datetime, timedelta
 import json
 import io
 import zipfile
+import time
 
 from app.database import get_db
 from app.models.user import User, Credential, UsageLog
@@ -324,8 +325,24 @@ async def verify_credential(
     }
 
 
-# 后台任务状态存储
+# 后台任务状态存储（完成后保留 BACKGROUND_TASK_TTL 秒供前端查询，由维护任务清理）
 _background_tasks = {}
+BACKGROUND_TASK_TTL = 3600
+# 超过此时间仍未完成的任务视为已失效（进程内任务异常退出后不会再更新状态）
+BACKGROUND_TASK_STALE = 86400
+
+
+async def prune_background_tasks(batch_size: int):
+    """清理已完成/失效的后台任务状态（维护任务，见 services/maintenance.py）"""
+    now = time.time()
+    expired = [
+        task_id for task_id, state in _background_tasks.items()
+        if now - state.get("updated_at", 0) > (BACKGROUND_TASK_TTL if state.get("status") == "done" else BACKGROUND_TASK_STALE)
+    ]
+    for i in range(0, len(expired), batch_size):
+        for task_id in expired[i:i + batch_size]:
+            _background_tasks.pop(task_id, None)
+        yield len(expired[i:i + batch_size])
 
 @router.post("/credentials/start-all")
 async def start_all_credentials(
@@ -358,7 +375,7 @@ async def start_all_credentials(
     } for c in creds]
     
     task_id = f"start_{datetime.utcnow().timestamp()}"
-    _background_tasks[task_id] = {"status": "running", "total": total, "success": 0, "failed": 0, "progress": 0}
+    _background_tasks[task_id] = {"status": "running", "total": total, "success": 0, "failed": 0, "progress": 0, "updated_at": time.time()}
     
     async def run_in_background():
         """后台执行刷新"""
@@ -411,7 +428,7 @@ async def start_all_credentials(
                     failed += 1
             await session.commit()
         
-        _background_tasks[task_id] = {"status": "done", "total": total, "success": success, "failed": failed}
+        _background_tasks[task_id] = {"status": "done", "total": total, "success": success, "failed": failed, "updated_at": time.time()}
         print(f"[启动凭证] 完成: 成功 {success}, 失败 {failed}", flush=True)
         
         # 通知前端刷新统计数据
@@ -462,7 +479,7 @@ async def verify_all_credentials(
     } for c in creds]
     
     task_id = f"verify_{datetime.utcnow().timestamp()}"
-    _background_tasks[task_id] = {"status": "running", "total": total, "valid": 0, "invalid": 0, "tier3": 0, "pro": 0}
+    _background_tasks[task_id] = {"status": "running", "total": total, "valid": 0, "invalid": 0, "tier3": 0, "pro": 0, "updated_at": time.time()}
     
     async def run_in_background():
         """后台执行检测"""
@@ -560,7 +577,7 @@ async def verify_all_credentials(
             
             await session.commit()
         
-        _background_tasks[task_id] = {"status": "done", "total": total, "valid": valid, "invalid": invalid, "tier3": tier3, "pro": pro}
+        _background_tasks[task_id] = {"status": "done", "total": total, "valid": valid, "invalid": invalid, "tier3": tier3, "pro": pro, "updated_at": time.time()}
         print(f"[检测凭证] 完成: 有效 {valid}, 无效 {invalid}, 3.0 {tier3}", flush=True)
         
         # 通知前端刷新统计数据
@@ -1095,187 +1112,108 @@ async def update_config(
     user: User = Depends(get_current_admin)
 ):
     """更新配置（持久化保存到数据库）"""
-    from app.config import settings, save_config_to_db
+    from app.config import save_configs_to_db
     
     updated = {}
     if allow_registration is not None:
-        settings.allow_registration = allow_registration
-        await save_config_to_db("allow_registration", allow_registration)
         updated["allow_registration"] = allow_registration
     if discord_only_registration is not None:
-        settings.discord_only_registration = discord_only_registration
-        await save_config_to_db("discord_only_registration", discord_only_registration)
         updated["discord_only_registration"] = discord_only_registration
     if discord_oauth_only is not None:
-        settings.discord_oauth_only = discord_oauth_only
-        await save_config_to_db("discord_oauth_only", discord_oauth_only)
         updated["discord_oauth_only"] = discord_oauth_only
     if default_daily_quota is not None:
-        settings.default_daily_quota = default_daily_quota
-        await save_config_to_db("default_daily_quota", default_daily_quota)
         updated["default_daily_quota"] = default_daily_quota
     if no_credential_quota is not None:
-        settings.no_credential_quota = no_credential_quota
-        await save_config_to_db("no_credential_quota", no_credential_quota)
         updated["no_credential_quota"] = no_credential_quota
     if no_cred_quota_flash is not None:
-        settings.no_cred_quota_flash = no_cred_quota_flash
-        await save_config_to_db("no_cred_quota_flash", no_cred_quota_flash)
         updated["no_cred_quota_flash"] = no_cred_quota_flash
     if no_cred_quota_25pro is not None:
-        settings.no_cred_quota_25pro = no_cred_quota_25pro
-        await save_config_to_db("no_cred_quota_25pro", no_cred_quota_25pro)
         updated["no_cred_quota_25pro"] = no_cred_quota_25pro
     if no_cred_quota_30pro is not None:
-        settings.no_cred_quota_30pro = no_cred_quota_30pro
-        await save_config_to_db("no_cred_quota_30pro", no_cred_quota_30pro)
         updated["no_cred_quota_30pro"] = no_cred_quota_30pro
     if cred25_quota_30pro is not None:
-        settings.cred25_quota_30pro = cred25_quota_30pro
-        await save_config_to_db("cred25_quota_30pro", cred25_quota_30pro)
         updated["cred25_quota_30pro"] = cred25_quota_30pro
     if credential_reward_quota is not None:
-        settings.credential_reward_quota = credential_reward_quota
-        await save_config_to_db("credential_reward_quota", credential_reward_quota)
         updated["credential_reward_quota"] = credential_reward_quota
     if credential_reward_quota_25 is not None:
-        settings.credential_reward_quota_25 = credential_reward_quota_25
-        await save_config_to_db("credential_reward_quota_25", credential_reward_quota_25)
         updated["credential_reward_quota_25"] = credential_reward_quota_25
     if credential_reward_quota_30 is not None:
-        settings.credential_reward_quota_30 = credential_reward_quota_30
-        await save_config_to_db("credential_reward_quota_30", credential_reward_quota_30)
         updated["credential_reward_quota_30"] = credential_reward_quota_30
     if quota_flash is not None:
-        settings.quota_flash = quota_flash
-        await save_config_to_db("quota_flash", quota_flash)
         updated["quota_flash"] = quota_flash
     if quota_25pro is not None:
-        settings.quota_25pro = quota_25pro
-        await save_config_to_db("quota_25pro", quota_25pro)
         updated["quota_25pro"] = quota_25pro
     if quota_30pro is not None:
-        settings.quota_30pro = quota_30pro
-        await save_config_to_db("quota_30pro", quota_30pro)
         updated["quota_30pro"] = quota_30pro
     if base_rpm is not None:
-        settings.base_rpm = base_rpm
-        await save_config_to_db("base_rpm", base_rpm)
         updated["base_rpm"] = base_rpm
     if contributor_rpm is not None:
-        settings.contributor_rpm = contributor_rpm
-        await save_config_to_db("contributor_rpm", contributor_rpm)
         updated["contributor_rpm"] = contributor_rpm
     if credential_pool_mode is not None:
         if credential_pool_mode in ["private", "tier3_shared", "full_shared"]:
-            settings.credential_pool_mode = credential_pool_mode
-            await save_config_to_db("credential_pool_mode", credential_pool_mode)
             updated["credential_pool_mode"] = credential_pool_mode
         else:
             raise HTTPException(status_code=400, detail="无效的凭证池模式")
     if error_retry_count is not None:
-        settings.error_retry_count = error_retry_count
-        await save_config_to_db("error_retry_count", error_retry_count)
         updated["error_retry_count"] = error_retry_count
     if cd_flash is not None:
-        settings.cd_flash = cd_flash
-        await save_config_to_db("cd_flash", cd_flash)
         updated["cd_flash"] = cd_flash
     if cd_pro is not None:
-        settings.cd_pro = cd_pro
-        await save_config_to_db("cd_pro", cd_pro)
         updated["cd_pro"] = cd_pro
     if cd_30 is not None:
-        settings.cd_30 = cd_30
-        await save_config_to_db("cd_30", cd_30)
         updated["cd_30"] = cd_30
     if force_donate is not None:
-        settings.force_donate = force_donate
-        await save_config_to_db("force_donate", force_donate)
         updated["force_donate"] = force_donate
     if lock_donate is not None:
-        settings.lock_donate = lock_donate
-        await save_config_to_db("lock_donate", lock_donate)
         updated["lock_donate"] = lock_donate
     
     # 日志保留配置
     if log_retention_days is not None:
-        settings.log_retention_days = log_retention_days
-        await save_config_to_db("log_retention_days", log_retention_days)
         updated["log_retention_days"] = log_retention_days
     
     # 公告配置
     if announcement_enabled is not None:
-        settings.announcement_enabled = announcement_enabled
-        await save_config_to_db("announcement_enabled", announcement_enabled)
         updated["announcement_enabled"] = announcement_enabled
     if announcement_title is not None:
-        settings.announcement_title = announcement_title
-        await save_config_to_db("announcement_title", announcement_title)
         updated["announcement_title"] = announcement_title
     if announcement_content is not None:
-        settings.announcement_content = announcement_content
-        await save_config_to_db("announcement_content", announcement_content)
         updated["announcement_content"] = announcement_content
     if announcement_read_seconds is not None:
-        settings.announcement_read_seconds = announcement_read_seconds
-        await save_config_to_db("announcement_read_seconds", announcement_read_seconds)
         updated["announcement_read_seconds"] = announcement_read_seconds
     
     # 全站统计额度配置
     if stats_quota_flash is not None:
-        settings.stats_quota_flash = stats_quota_flash
-        await save_config_to_db("stats_quota_flash", stats_quota_flash)
         updated["stats_quota_flash"] = stats_quota_flash
     if stats_quota_25pro is not None:
-        settings.stats_quota_25pro = stats_quota_25pro
-        await save_config_to_db("stats_quota_25pro", stats_quota_25pro)
         updated["stats_quota_25pro"] = stats_quota_25pro
     if stats_quota_30pro is not None:
-        settings.stats_quota_30pro = stats_quota_30pro
-        await save_config_to_db("stats_quota_30pro", stats_quota_30pro)
         updated["stats_quota_30pro"] = stats_quota_30pro
     
     # Antigravity 反代配置
     if antigravity_enabled is not None:
-        settings.antigravity_enabled = antigravity_enabled
-        await save_config_to_db("antigravity_enabled", antigravity_enabled)
         updated["antigravity_enabled"] = antigravity_enabled
     if antigravity_system_prompt is not None:
-        settings.antigravity_system_prompt = antigravity_system_prompt
-        await save_config_to_db("antigravity_system_prompt", antigravity_system_prompt)
         updated["antigravity_system_prompt"] = antigravity_system_prompt
     if antigravity_quota_enabled is not None:
-        settings.antigravity_quota_enabled = antigravity_quota_enabled
-        await save_config_to_db("antigravity_quota_enabled", antigravity_quota_enabled)
         updated["antigravity_quota_enabled"] = antigravity_quota_enabled
     if antigravity_quota_default is not None:
-        settings.antigravity_quota_default = antigravity_quota_default
-        await save_config_to_db("antigravity_quota_default", antigravity_quota_default)
         updated["antigravity_quota_default"] = antigravity_quota_default
     if antigravity_quota_contributor is not None:
-        settings.antigravity_quota_contributor = antigravity_quota_contributor
-        await save_config_to_db("antigravity_quota_contributor", antigravity_quota_contributor)
         updated["antigravity_quota_contributor"] = antigravity_quota_contributor
     if antigravity_base_rpm is not None:
-        settings.antigravity_base_rpm = antigravity_base_rpm
-        await save_config_to_db("antigravity_base_rpm", antigravity_base_rpm)
         updated["antigravity_base_rpm"] = antigravity_base_rpm
     if antigravity_contributor_rpm is not None:
-        settings.antigravity_contributor_rpm = antigravity_contributor_rpm
-        await save_config_to_db("antigravity_contributor_rpm", antigravity_contributor_rpm)
         updated["antigravity_contributor_rpm"] = antigravity_contributor_rpm
     
     # OAuth 操作指引弹窗配置
     if oauth_guide_enabled is not None:
-        settings.oauth_guide_enabled = oauth_guide_enabled
-        await save_config_to_db("oauth_guide_enabled", oauth_guide_enabled)
         updated["oauth_guide_enabled"] = oauth_guide_enabled
     if oauth_guide_seconds is not None:
-        settings.oauth_guide_seconds = oauth_guide_seconds
-        await save_config_to_db("oauth_guide_seconds", oauth_guide_seconds)
         updated["oauth_guide_seconds"] = oauth_guide_seconds
     
+    # 一个事务保存所有修改，应用到本 worker，并通知其他 worker 重新加载
+    await save_configs_to_db(updated)
+    
     return {"message": "配置已保存", "updated": updated}
 
 
@@ -1296,7 +1234,7 @@ async def get_global_stats(
     """
     # 尝试从缓存获取（缓存5秒，按 api_type 分开缓存）
     cache_key = f"stats:global:{api_type}"
-    cached_stats = cache.get(cache_key)
+    cached_stats = await cache.get(cache_key)
     if cached_stats:
         return cached_stats
     
@@ -1661,7 +1599,7 @@ async def get_global_stats(
     }
     
     # 缓存结果5秒
-    cache.set("stats:global", result, ttl=5)
+    await cache.set(cache_key, result, ttl=5)
     
     return result
 
@@ -1699,6 +1637,7 @@ async def get_log_detail(
         "client_ip": log.client_ip,
         "user_agent": log.user_agent,
         "retry_count": getattr(log, 'retry_count', 0) or 0,  # 重试次数
+        "cache_hit": bool(getattr(log, 'cache_hit', False)),  # 是否命中响应缓存
         "created_at": log.created_at.isoformat() + "Z" if log.created_at else None
     }
 
@@ -1800,3 +1739,66 @@ async def get_error_stats(
     }
 
 
+
+
+@router.get("/stats/cache")
+async def get_cache_stats(user: User = Depends(get_current_admin)):
+    """获取进程内缓存的命中统计、WebSocket 发送队列、数据库写队列、使用计数缓冲、维护任务进度、Redis 命令耗时和选主状态（仅当前 worker）"""
+    from app.services.openai2gemini_full import get_tool_declaration_cache_stats
+    from app.services.conversation_cache import conversation_cache
+    from app.services.response_cache import response_cache
+    from app.services.antigravity_models import antigravity_model_cache
+    from app.services.model_catalog import model_catalog
+    from app.services.websocket import manager
+    from app.database import db_writer
+    from app.services.leader import leader
+    from app.services.redis_service import redis_service
+    from app.services.usage_buffer import usage_buffer
+    from app.services.maintenance import maintenance
+    
+    return {
+        "tool_declarations": get_tool_declaration_cache_stats(),
+        "conversations": conversation_cache.get_stats(),
+        "responses": response_cache.get_stats(),
+        "antigravity_models": antigravity_model_cache.get_stats(),
+        "model_catalog": model_catalog.get_stats(),
+        "websocket": manager.get_stats(),
+        "db_writer": db_writer.get_stats(),
+        "usage_buffer": usage_buffer.get_stats(),
+        "maintenance": maintenance.get_stats(),
+        "leader": leader.get_status(),
+        "redis": redis_service.get_stats(),
+    }
+
+
+@router.get("/circuit-breakers")
+async def get_circuit_breakers(user: User = Depends(get_current_admin)):
+    """获取上游熔断器状态（仅当前 worker）"""
+    from app.services.circuit_breaker import circuit_breakers
+    
+    return {
+        "enabled": settings.circuit_breaker_enabled,
+        "config": {
+            "window": settings.circuit_breaker_window,
+            "min_requests": settings.circuit_breaker_min_requests,
+            "failure_rate": settings.circuit_breaker_failure_rate,
+            "open_seconds": settings.circuit_breaker_open_seconds,
+            "max_open_seconds": settings.circuit_breaker_max_open_seconds,
+            "half_open_probes": settings.circuit_breaker_half_open_probes,
+        },
+        "breakers": circuit_breakers.get_states(),
+    }
+
+
+@router.post("/circuit-breakers/reset")
+async def reset_circuit_breakers(
+    upstream: Optional[str] = Form(None),  # 不填则重置全部
+    family: Optional[str] = Form(None),
+    user: User = Depends(get_current_admin)
+):
+    """手动关闭熔断器"""
+    from app.services.circuit_breaker import circuit_breakers
+    
+    count = circuit_breakers.reset(upstream, family)
+    print(f"[CircuitBreaker] 管理员 {user.username} 重置了 {count} 个熔断器", flush=True)
+    return {"message": f"已重置 {count} 个熔断器", "count": count}
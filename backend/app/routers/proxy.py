@@ -6,15 +6,25 @@ from datetime import datetime, timedelta
 import json
 import time
 
-from app.database import get_db, async_session
+from app.database import get_db, async_session, db_writer
+from app.services.usage_buffer import usage_buffer
 from app.models.user import User, UsageLog
 from app.services.auth import get_user_by_api_key
 from app.services.credential_pool import CredentialPool
 from app.services.gemini_client import GeminiClient
+from app.services.model_catalog import model_catalog
 from app.services.websocket import notify_log_update, notify_stats_update
 from app.services.error_classifier import classify_error_simple
 from app.services.error_message_service import get_custom_error_message
-from app.config import settings
+from app.services.circuit_breaker import circuit_breakers, circuit_open_exception
+from app.config import settings, config_snapshot
+from app.utils.usage import extract_usage, extract_final_usage, usage_to_log_tokens
+from app.utils.disconnect import cancel_on_disconnect, CLIENT_CLOSED_REQUEST
+from app.utils.deadline import build_timeout, timeout_error, iter_lines_with_deadline
+from app.services.response_cache import (
+    response_cache, record_cache_hit, replay_openai_response, RESPONSE_CACHE_HEADER,
+    is_cacheable_openai_response, OpenAIStreamCollector,
+)
 import re
 
 router = APIRouter(tags=["API代理"])
@@ -66,6 +76,7 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
     user = await get_user_by_api_key(db, api_key)
     if not user:
         raise HTTPException(status_code=401, detail="无效的API Key")
+    request.state.api_key = api_key  # 供响应缓存判断 API Key 开关
     
     if not user.is_active:
         raise HTTPException(status_code=403, detail="账户已被禁用")
@@ -165,6 +176,7 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
             )
             .where(UsageLog.user_id == user.id)
             .where(UsageLog.created_at >= start_of_day)
+            .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         )
         usage_stats = usage_stats_result.one()
         current_usage = usage_stats.model_usage or 0
@@ -207,152 +219,9 @@ async def list_models(request: Request, user: User = Depends(get_user_from_api_k
     - 有 GeminiCLI 凭证：显示 gcli- 前缀模型
     - 有 Antigravity 凭证：显示 agy- 前缀模型
     - 没有任何凭证：不显示任何模型
+    目录按用户权益缓存，支持 ETag / If-None-Match（见 model_catalog.py）
     """
-    from app.models.user import Credential
-    from sqlalchemy import or_
-    
-    models = []
-    
-    # ===== 检查用户是否有 GeminiCLI 凭证 =====
-    cli_creds_result = await db.execute(
-        select(func.count(Credential.id))
-        .where(Credential.api_type != "antigravity")  # 非 Antigravity 就是 CLI
-        .where(Credential.is_active == True)
-        .where(or_(
-            Credential.user_id == user.id,
-            Credential.is_public == True
-        ))
-    )
-    has_cli_creds = (cli_creds_result.scalar() or 0) > 0
-    
-    # ===== 检查用户是否有 Antigravity 凭证 =====
-    agy_creds_result = await db.execute(
-        select(func.count(Credential.id))
-        .where(Credential.api_type == "antigravity")
-        .where(Credential.is_active == True)
-        .where(or_(
-            Credential.user_id == user.id,
-            Credential.is_public == True
-        ))
-    )
-    has_agy_creds = (agy_creds_result.scalar() or 0) > 0
-    
-    # ===== GeminiCLI 模型（仅当有 CLI 凭证时显示）=====
-    if has_cli_creds:
-        has_cli_tier3 = await CredentialPool.has_tier3_credentials(user, db, mode="geminicli")
-        
-        base_models = ["gemini-2.5-pro", "gemini-2.5-flash"]
-        tier3_models = ["gemini-3-pro-preview", "gemini-3-flash-preview"]
-        thinking_suffixes = ["-maxthinking", "-nothinking"]
-        search_suffix = "-search"
-        
-        cli_base_models = base_models.copy()
-        if has_cli_tier3:
-            cli_base_models.extend(tier3_models)
-        
-        for base in cli_base_models:
-            # 基础模型
-            models.append({"id": f"gcli-{base}", "object": "model", "owned_by": "google"})
-            
-            # thinking 变体
-            for suffix in thinking_suffixes:
-                models.append({"id": f"gcli-{base}{suffix}", "object": "model", "owned_by": "google"})
-            
-            # search 变体
-            models.append({"id": f"gcli-{base}{search_suffix}", "object": "model", "owned_by": "google"})
-            
-            # thinking + search 组合
-            for suffix in thinking_suffixes:
-                combined = f"{suffix}{search_suffix}"
-                models.append({"id": f"gcli-{base}{combined}", "object": "model", "owned_by": "google"})
-    
-    # ===== Antigravity 模型（仅当有 Antigravity 凭证时显示）=====
-    if has_agy_creds and settings.antigravity_enabled:
-        # 定义有效模型的过滤函数
-        def is_valid_agy_model(model_id: str) -> bool:
-            model_lower = model_id.lower()
-            # 排除条件：包含这些关键字的跳过
-            invalid_patterns = [
-                "chat_", "rev", "tab_", "uic", "test", "exp", "lite_preview",
-                "2.5", "gemini-2", "gcli-"
-            ]
-            for pattern in invalid_patterns:
-                if pattern in model_lower:
-                    return False
-            # 允许条件：必须是 gemini-3, claude, gpt 开头
-            valid_prefixes = ["gemini-3", "claude", "gpt-oss"]
-            for prefix in valid_prefixes:
-                if model_lower.startswith(prefix):
-                    return True
-            return False
-        
-        try:
-            from app.services.antigravity_client import AntigravityClient
-            
-            # 获取一个有效的 Antigravity 凭证
-            agy_cred_result = await db.execute(
-                select(Credential)
-                .where(Credential.api_type == "antigravity")
-                .where(Credential.is_active == True)
-                .where(or_(
-                    Credential.user_id == user.id,
-                    Credential.is_public == True
-                ))
-                .limit(1)
-            )
-            agy_cred = agy_cred_result.scalar_one_or_none()
-            
-            if agy_cred:
-                access_token = await CredentialPool.get_access_token(agy_cred, db)
-                if access_token:
-                    client = AntigravityClient(access_token, agy_cred.project_id)
-                    api_models = await client.fetch_available_models()
-                    
-                    # 添加过滤后的模型
-                    for model_info in api_models:
-                        model_id = model_info.get("id", "")
-                        if model_id and is_valid_agy_model(model_id):
-                            models.append({"id": f"agy-{model_id}", "object": "model", "owned_by": "google"})
-                            # 为图片模型添加 2k/4k 变体
-                            if "image" in model_id.lower() and "2k" not in model_id.lower() and "4k" not in model_id.lower():
-                                models.append({"id": f"agy-{model_id}-2k", "object": "model", "owned_by": "google"})
-                                models.append({"id": f"agy-{model_id}-4k", "object": "model", "owned_by": "google"})
-                    
-                    existing_ids = {m["id"] for m in models}
-                    image_variants = [
-                        "agy-gemini-3-pro-image", "agy-gemini-3-pro-image-2k", "agy-gemini-3-pro-image-4k"
-                    ]
-                    for variant in image_variants:
-                        if variant not in existing_ids:
-                            models.append({"id": variant, "object": "model", "owned_by": "google"})
-                    
-                    # 强制添加不带 -thinking 后缀的 Claude 基础模型和 -search 变体
-                    claude_model_variants = [
-                        # 基础模型（不带后缀）
-                        "agy-claude-opus-4-5", "agy-claude-sonnet-4-5",
-                        # 联网搜索变体
-                        "agy-claude-opus-4-5-search", "agy-claude-sonnet-4-5-search",
-                        "agy-claude-opus-4-5-thinking-search", "agy-claude-sonnet-4-5-thinking-search",
-                    ]
-                    existing_ids = {m["id"] for m in models}
-                    for variant in claude_model_variants:
-                        if variant not in existing_ids:
-                            models.append({"id": variant, "object": "model", "owned_by": "google"})
-                            print(f"[Models] ✅ 强制添加 Claude 模型变体: {variant}", flush=True)
-        except Exception as e:
-            print(f"[Models] 获取 Antigravity 模型列表失败: {e}", flush=True)
-            # 降级：使用静态模型列表
-            fallback_agy_models = [
-                "gemini-3-flash", "gemini-3-pro-low", "gemini-3-pro-high", "gemini-3-pro-image",
-                "gemini-3-pro-image-2k", "gemini-3-pro-image-4k",
-                "claude-opus-4-5", "claude-opus-4-5-thinking",
-                "claude-sonnet-4-5", "claude-sonnet-4-5-thinking",
-                "gpt-oss-120b-medium"
-            ]
-            for base in fallback_agy_models:
-                models.append({"id": f"agy-{base}", "object": "model", "owned_by": "google"})
-    
-    return {"object": "list", "data": models}
+    return model_catalog.respond(request, await model_catalog.openai_catalog(user, db))
 
 
 @router.post("/v1/chat/completions")
@@ -440,6 +309,9 @@ async def chat_completions(
     # 检查用户是否参与大锅饭
     user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
     
+    # 本次请求使用的配置快照（请求处理中配置变更不影响本次请求）
+    cfg = config_snapshot()
+    
     # 速率限制检查 (RPM) - 管理员豁免
     if not user.is_admin:
         one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
@@ -447,14 +319,15 @@ async def chat_completions(
             select(func.count(UsageLog.id))
             .where(UsageLog.user_id == user.id)
             .where(UsageLog.created_at >= one_minute_ago)
+            .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+        max_rpm = cfg.contributor_rpm if user_has_public else cfg.base_rpm
         
         if current_rpm >= max_rpm:
             raise HTTPException(
                 status_code=429, 
-                detail=f"速率限制: {max_rpm} 次/分钟。{'上传凭证可提升至 ' + str(settings.contributor_rpm) + ' 次/分钟' if not user_has_public else ''}"
+                detail=f"速率限制: {max_rpm} 次/分钟。{'上传凭证可提升至 ' + str(cfg.contributor_rpm) + ' 次/分钟' if not user_has_public else ''}"
             )
     
     # 立即插入占位记录以计入 RPM（防止 BackgroundTasks 导致 RPM 失效）
@@ -471,10 +344,32 @@ async def chat_completions(
     await db.commit()
     await db.refresh(placeholder_log)  # 获取插入后的 ID
     placeholder_log_id = placeholder_log.id  # 保存ID，后续通过独立会话访问
+
+    # 响应缓存：命中时直接返回，不选取凭证、不触发 CD
+    response_cache_key = None
+    if await response_cache.is_enabled(request, db, body.get("temperature"), body.get("n")):
+        response_cache_key = await response_cache.chat_key(user.id, "geminicli", body)
+        cached_response = await response_cache.get(response_cache_key)
+        if cached_response is not None:
+            latency = (time.time() - start_time) * 1000
+            await record_cache_hit(db, placeholder_log, user.username, model, latency, cached_response)
+            return replay_openai_response(cached_response, stream)
+    
+    # 上游熔断中：直接返回 503，不选取凭证
+    upstream = GeminiClient.INTERNAL_API_BASE
+    retry_after = circuit_breakers.acquire(upstream, model, request)
+    if retry_after:
+        placeholder_log.status_code = 503
+        placeholder_log.latency_ms = (time.time() - start_time) * 1000
+        placeholder_log.error_type = "UPSTREAM_ERROR"
+        placeholder_log.error_code = "CIRCUIT_OPEN"
+        placeholder_log.error_message = "上游熔断中"
+        await db.commit()
+        raise circuit_open_exception(upstream, model, retry_after)
     
     # 获取首个凭证后立即释放主连接（流式响应将使用独立会话）
     # 重试逻辑：报错时切换凭证重试
-    max_retries = settings.error_retry_count
+    max_retries = cfg.error_retry_count
     last_error = None
     tried_credential_ids = set()
     
@@ -532,6 +427,7 @@ async def chat_completions(
     project_id = credential.project_id or ""
     first_credential_id = credential.id
     first_credential_email = credential.email
+    first_credential_selection = credential.selection
     print(f"[Proxy] 使用凭证: {credential.email}, project_id: {project_id}, model: {model}", flush=True)
     
     if not project_id:
@@ -552,8 +448,10 @@ async def chat_completions(
                 result = await client.chat_completions(
                     model=model,
                     messages=messages,
-                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                    cache_scope=f"user:{user.id}",
+                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream", "cache_scope"]}
                 )
+                circuit_breakers.record_success(upstream, model)
                 
                 # 成功：更新占位日志
                 latency = (time.time() - start_time) * 1000
@@ -567,12 +465,11 @@ async def chat_completions(
                 placeholder_log.error_code = error_code
                 placeholder_log.credential_email = credential.email
                 placeholder_log.retry_count = retry_attempt  # 记录重试次数
+                placeholder_log.tokens_input, placeholder_log.tokens_output = usage_to_log_tokens(client.last_usage)
                 await db.commit()
                 
                 # 更新凭证使用次数
-                credential.total_requests = (credential.total_requests or 0) + 1
-                credential.last_used_at = datetime.utcnow()
-                await db.commit()
+                usage_buffer.add_credential_use(credential.id)
                 
                 # WebSocket 实时通知
                 await notify_log_update({
@@ -585,17 +482,25 @@ async def chat_completions(
                 })
                 await notify_stats_update()
                 
+                if response_cache_key and is_cacheable_openai_response(result):
+                    await response_cache.set(response_cache_key, result)
+                
                 return JSONResponse(content=result)
                 
             except Exception as e:
                 error_str = str(e)
-                await CredentialPool.handle_credential_failure(db, credential.id, error_str)
+                breaker_open = circuit_breakers.record_failure(upstream, model, error_str, request=request)
+                if breaker_open:
+                    # 上游熔断：不是凭证的问题，不记错误，释放本次选取设置的 CD
+                    await CredentialPool.release_model_group_cd(db, credential.id, model, credential.selection)
+                else:
+                    await CredentialPool.handle_credential_failure(db, credential.id, error_str)
                 last_error = error_str
                 
-                # 检查是否应该重试
+                # 检查是否应该重试（熔断后切换凭证也是打到同一个故障端点，不再重试）
                 should_retry = any(code in error_str for code in ["404", "500", "502", "503", "504", "429", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
                 
-                if should_retry and retry_attempt < max_retries:
+                if should_retry and not breaker_open and retry_attempt < max_retries:
                     print(f"[Proxy] ⚠️ 请求失败: {error_str}，切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
                     
                     # 获取新凭证
@@ -617,7 +522,7 @@ async def chat_completions(
                     continue
                 
                 # 失败：更新占位日志
-                status_code = extract_status_code(error_str)
+                status_code = 503 if breaker_open else extract_status_code(error_str)
                 latency = (time.time() - start_time) * 1000
                 error_type, error_code = classify_error_simple(status_code, error_str)
                 
@@ -626,12 +531,14 @@ async def chat_completions(
                 placeholder_log.latency_ms = latency
                 placeholder_log.error_message = error_str[:2000]
                 placeholder_log.error_type = error_type
-                placeholder_log.error_code = error_code
+                placeholder_log.error_code = "CIRCUIT_OPEN" if breaker_open else error_code
                 placeholder_log.credential_email = credential.email
                 placeholder_log.request_body = request_body_str
                 placeholder_log.retry_count = retry_attempt  # 记录重试次数
                 await db.commit()
                 
+                if breaker_open:
+                    raise circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), error_str)
                 raise HTTPException(status_code=status_code, detail=f"API调用失败 (已重试 {retry_attempt + 1} 次): {error_str}")
         
         # 所有重试都失败
@@ -643,19 +550,19 @@ async def chat_completions(
     
     # 流式响应：使用独立会话，不持有主db连接
     async def save_log_background(log_data: dict):
-        """后台任务：更新占位日志记录（使用独立会话）"""
+        """后台任务：更新占位日志记录（通过写队列批量提交）"""
         try:
-            async with async_session() as bg_db:
-                latency = log_data.get("latency_ms", 0)
-                status_code = log_data.get("status_code", 200)
-                error_msg = log_data.get("error_message")
-                
-                # 错误分类
-                error_type = None
-                error_code = None
-                if status_code != 200 and error_msg:
-                    error_type, error_code = classify_error_simple(status_code, error_msg)
-                
+            latency = log_data.get("latency_ms", 0)
+            status_code = log_data.get("status_code", 200)
+            error_msg = log_data.get("error_message")
+            
+            # 错误分类
+            error_type = None
+            error_code = None
+            if status_code != 200 and error_msg:
+                error_type, error_code = classify_error_simple(status_code, error_msg)
+            
+            async def write_log(bg_db):
                 # 更新占位记录
                 log_result = await bg_db.execute(
                     select(UsageLog).where(UsageLog.id == placeholder_log_id)
@@ -671,85 +578,137 @@ async def chat_completions(
                     log.credential_email = log_data.get("cred_email")
                     log.request_body = request_body_str if status_code != 200 else None
                     log.retry_count = log_data.get("retry_count", 0)  # 记录重试次数
-                
-                # 更新凭证使用次数
-                cred_id = log_data.get("cred_id")
-                if cred_id:
-                    from app.models.user import Credential
-                    cred_result = await bg_db.execute(
-                        select(Credential).where(Credential.id == cred_id)
-                    )
-                    cred = cred_result.scalar_one_or_none()
-                    if cred:
-                        cred.total_requests = (cred.total_requests or 0) + 1
-                        cred.last_used_at = datetime.utcnow()
-                
-                await bg_db.commit()
-                
-                # WebSocket 实时通知
-                await notify_log_update({
-                    "username": user.username,
-                    "model": model,
-                    "status_code": status_code,
-                    "error_type": error_type,
-                    "latency_ms": round(latency, 0),
-                    "created_at": datetime.utcnow().isoformat()
-                })
-                await notify_stats_update()
-                print(f"[Proxy] ✅ 后台日志已记录: user={user.username}, model={model}, status={status_code}", flush=True)
+                    log.tokens_input, log.tokens_output = usage_to_log_tokens(log_data.get("usage"))
+            
+            await db_writer.run(write_log)
+            
+            # 更新凭证使用次数
+            if log_data.get("cred_id"):
+                usage_buffer.add_credential_use(log_data["cred_id"])
+            
+            # WebSocket 实时通知
+            await notify_log_update({
+                "username": user.username,
+                "model": model,
+                "status_code": status_code,
+                "error_type": error_type,
+                "latency_ms": round(latency, 0),
+                "created_at": datetime.utcnow().isoformat()
+            })
+            await notify_stats_update()
+            print(f"[Proxy] ✅ 后台日志已记录: user={user.username}, model={model}, status={status_code}", flush=True)
         except Exception as log_err:
             print(f"[Proxy] ❌ 后台日志记录失败: {log_err}", flush=True)
     
+    async def on_client_disconnect():
+        """客户端断开：占位日志仍在处理中时记录为客户端取消，并释放本次占用的凭证 CD"""
+        latency = (time.time() - start_time) * 1000
+        error_type, error_code = classify_error_simple(CLIENT_CLOSED_REQUEST, "")
+        
+        async def write_cancel(bg_db):
+            # 日志更新和 CD 释放在同一个写队列事务中提交
+            log_result = await bg_db.execute(
+                select(UsageLog).where(UsageLog.id == placeholder_log_id)
+            )
+            log = log_result.scalar_one_or_none()
+            if not log or log.status_code != 0:
+                return False  # 结果已记录，断开发生在响应发送之后
+            log.credential_id = current_cred_id
+            log.status_code = CLIENT_CLOSED_REQUEST
+            log.latency_ms = latency
+            log.error_message = "客户端断开连接，已取消上游请求"
+            log.error_type = error_type
+            log.error_code = error_code
+            log.credential_email = current_cred_email
+            await CredentialPool.release_model_group_cd(bg_db, current_cred_id, model, current_cred_selection, commit=False)
+            return True
+        
+        if not await db_writer.run(write_cancel):
+            return
+        
+        print(f"[Proxy] ⚠️ 客户端断开，已取消上游请求: user={user.username}, model={model}", flush=True)
+        await notify_log_update({
+            "username": user.username,
+            "model": model,
+            "status_code": CLIENT_CLOSED_REQUEST,
+            "error_type": error_type,
+            "latency_ms": round(latency, 0),
+            "created_at": datetime.utcnow().isoformat()
+        })
+    
+    current_cred_id = first_credential_id
+    current_cred_email = first_credential_email
+    current_cred_selection = first_credential_selection
+    
     async def stream_generator_with_retry():
         """流式生成器（使用独立会话进行数据库操作）"""
-        nonlocal access_token, project_id, client, tried_credential_ids, last_error
-        current_cred_id = first_credential_id
-        current_cred_email = first_credential_email
+        nonlocal access_token, project_id, client, tried_credential_ids, last_error, current_cred_id, current_cred_email, current_cred_selection
         
+        # 已经向客户端输出过数据后不能再换凭证重试（客户端会收到重复/拼接的内容），只能输出错误结束
+        yielded = False
         for stream_retry in range(max_retries + 1):
+            collector = OpenAIStreamCollector() if response_cache_key else None
             try:
                 if use_fake_streaming:
                     async for chunk in client.chat_completions_fake_stream(
                         model=model,
                         messages=messages,
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                        cache_scope=f"user:{user.id}",
+                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream", "cache_scope"]}
                     ):
+                        if collector:
+                            collector.feed(chunk)
+                        yielded = True
                         yield chunk
                 else:
                     async for chunk in client.chat_completions_stream(
                         model=model,
                         messages=messages,
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                        cache_scope=f"user:{user.id}",
+                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream", "cache_scope"]}
                     ):
+                        if collector:
+                            collector.feed(chunk)
+                        yielded = True
                         yield chunk
                 
                 # 成功：记录日志数据
+                circuit_breakers.record_success(upstream, model)
                 latency = (time.time() - start_time) * 1000
                 await save_log_background({
                     "status_code": 200,
                     "cred_id": current_cred_id,
                     "cred_email": current_cred_email,
                     "latency_ms": latency,
-                    "retry_count": stream_retry  # 记录重试次数
+                    "retry_count": stream_retry,  # 记录重试次数
+                    "usage": client.last_usage
                 })
+                if collector:
+                    cacheable_result = collector.build()
+                    if cacheable_result:
+                        await response_cache.set(response_cache_key, cacheable_result)
                 yield "data: [DONE]\n\n"
                 return  # 成功，退出
                 
             except Exception as e:
                 error_str = str(e)
                 last_error = error_str
+                breaker_open = circuit_breakers.record_failure(upstream, model, error_str, request=request)
                 
-                # 使用独立会话处理凭证失败
+                # 使用独立会话处理凭证失败（上游熔断时不记错误，释放本次选取设置的 CD）
                 try:
                     async with async_session() as stream_db:
-                        await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
+                        if breaker_open:
+                            await CredentialPool.release_model_group_cd(stream_db, current_cred_id, model, current_cred_selection)
+                        else:
+                            await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
                 except Exception as db_err:
                     print(f"[Proxy] ⚠️ 标记凭证失败时出错: {db_err}", flush=True)
                 
-                # 检查是否应该重试
-                should_retry = any(code in error_str for code in ["404", "500", "502", "503", "504", "429", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
+                # 检查是否应该重试（熔断后不再重试）
+                should_retry = not yielded and any(code in error_str for code in ["404", "500", "502", "503", "504", "429", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
                 
-                if should_retry and stream_retry < max_retries:
+                if should_retry and not breaker_open and stream_retry < max_retries:
                     print(f"[Proxy] ⚠️ 流式请求失败: {error_str}，切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
                     
                     # 🚀 使用独立会话获取新凭证
@@ -764,6 +723,7 @@ async def chat_completions(
                                 new_token = await CredentialPool.get_access_token(new_credential, stream_db)
                                 if new_token:
                                     current_cred_id = new_credential.id
+                                    current_cred_selection = new_credential.selection
                                     current_cred_email = new_credential.email
                                     access_token = new_token
                                     project_id = new_credential.project_id or ""
@@ -774,7 +734,7 @@ async def chat_completions(
                         print(f"[Proxy] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
                 
                 # 无法重试，输出错误并记录日志
-                status_code = extract_status_code(error_str)
+                status_code = 503 if breaker_open else extract_status_code(error_str)
                 latency = (time.time() - start_time) * 1000
                 await save_log_background({
                     "status_code": status_code,
@@ -784,11 +744,15 @@ async def chat_completions(
                     "latency_ms": latency,
                     "retry_count": stream_retry  # 记录重试次数
                 })
+                if breaker_open:
+                    error_detail = circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), error_str).detail
+                    yield f"data: {json.dumps({'error': error_detail})}\n\n"
+                    return
                 yield f"data: {json.dumps({'error': f'API Error (已重试 {stream_retry + 1} 次): {error_str}'})}\n\n"
                 return
     
     return StreamingResponse(
-        stream_generator_with_retry(),
+        cancel_on_disconnect(stream_generator_with_retry(), on_client_disconnect),
         media_type="text/event-stream",
         headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
     )
@@ -813,28 +777,8 @@ async def gemini_options_handler(model: str):
 
 @router.get("/v1beta/models")
 async def list_gemini_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
-    """Gemini 格式模型列表"""
-    # 检查是否有可用的 3.0 凭证
-    has_tier3 = await CredentialPool.has_tier3_credentials(user, db)
-    
-    base_models = ["gemini-2.5-pro", "gemini-2.5-flash"]
-    if has_tier3:
-        base_models.append("gemini-3-pro-preview")
-        base_models.append("gemini-3-flash-preview")
-    
-    models = []
-    for base in base_models:
-        models.append({
-            "name": f"models/{base}",
-            "version": "001",
-            "displayName": base,
-            "description": f"Gemini {base} model",
-            "inputTokenLimit": 1000000,
-            "outputTokenLimit": 65536,
-            "supportedGenerationMethods": ["generateContent", "streamGenerateContent"],
-        })
-    
-    return {"models": models}
+    """Gemini 格式模型列表（按用户权益缓存，支持 ETag / If-None-Match）"""
+    return model_catalog.respond(request, await model_catalog.gemini_catalog(user, db))
 
 
 @router.post("/v1beta/models/{model:path}:generateContent")
@@ -864,6 +808,9 @@ async def gemini_generate_content(
     # 检查用户是否参与大锅饭
     user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
     
+    # 本次请求使用的配置快照（请求处理中配置变更不影响本次请求）
+    cfg = config_snapshot()
+    
     # 速率限制 - 管理员豁免
     if not user.is_admin:
         one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
@@ -871,9 +818,10 @@ async def gemini_generate_content(
             select(func.count(UsageLog.id))
             .where(UsageLog.user_id == user.id)
             .where(UsageLog.created_at >= one_minute_ago)
+            .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+        max_rpm = cfg.contributor_rpm if user_has_public else cfg.base_rpm
         
         if current_rpm >= max_rpm:
             raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
@@ -901,8 +849,26 @@ async def gemini_generate_content(
     if "tools" in body:
         request_body["tools"] = body["tools"]
     
+    # 响应缓存：命中时直接返回，不选取凭证、不触发 CD
+    response_cache_key = None
+    generation_config = request_body.get("generationConfig") or {}
+    if await response_cache.is_enabled(request, db, generation_config.get("temperature"), generation_config.get("candidateCount")):
+        response_cache_key = response_cache.make_key(user.id, "gemini", model, request_body)
+        cached_response = await response_cache.get(response_cache_key)
+        if cached_response is not None:
+            latency = (time.time() - start_time) * 1000
+            log = UsageLog(user_id=user.id, model=model, endpoint="/v1beta/generateContent")
+            await record_cache_hit(db, log, user.username, model, latency, cached_response)
+            return JSONResponse(content=cached_response, headers={RESPONSE_CACHE_HEADER: "HIT"})
+    
+    # 上游熔断中：直接返回 503，不选取凭证
+    upstream = GeminiClient.INTERNAL_API_BASE
+    retry_after = circuit_breakers.acquire(upstream, model, request)
+    if retry_after:
+        raise circuit_open_exception(upstream, model, retry_after)
+    
     # 重试逻辑
-    max_retries = settings.error_retry_count
+    max_retries = cfg.error_retry_count
     tried_credential_ids = set()
     last_error = None
     credential = None
@@ -934,14 +900,24 @@ async def gemini_generate_content(
         payload = {"model": model, "project": project_id, "request": request_body}
         
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    url,
-                    headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
-                    json=payload
-                )
+            # 按模型家族的超时策略，超时后切换凭证重试
+            async with httpx.AsyncClient(timeout=build_timeout(model)) as client:
+                try:
+                    response = await client.post(
+                        url,
+                        headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+                        json=payload
+                    )
+                except httpx.TimeoutException as e:
+                    raise timeout_error(model, e)
                 
                 if response.status_code == 200:
+                    circuit_breakers.record_success(upstream, model)
+                    result = response.json()
+                    tokens_input, tokens_output = usage_to_log_tokens(
+                        extract_usage(result.get("response", result))
+                    )
+                    
                     # 成功：记录日志
                     latency = (time.time() - start_time) * 1000
                     log = UsageLog(
@@ -951,12 +927,13 @@ async def gemini_generate_content(
                         endpoint="/v1beta/generateContent",
                         status_code=200,
                         latency_ms=latency,
+                        tokens_input=tokens_input,
+                        tokens_output=tokens_output,
                         credential_email=credential.email
                     )
                     db.add(log)
-                    credential.total_requests = (credential.total_requests or 0) + 1
-                    credential.last_used_at = datetime.utcnow()
                     await db.commit()
+                    usage_buffer.add_credential_use(credential.id)
                     
                     # WebSocket 实时通知
                     await notify_log_update({
@@ -969,13 +946,17 @@ async def gemini_generate_content(
                     await notify_stats_update()
                     
                     # 转换响应格式
-                    result = response.json()
+                    standard_result = result
                     if "response" in result:
                         standard_result = result.get("response", {})
                         if "modelVersion" in result:
                             standard_result["modelVersion"] = result["modelVersion"]
-                        return JSONResponse(content=standard_result)
-                    return JSONResponse(content=result)
+                    
+                    if response_cache_key:
+                        candidates = standard_result.get("candidates") or [{}]
+                        if candidates[0].get("finishReason") == "STOP":
+                            await response_cache.set(response_cache_key, standard_result)
+                    return JSONResponse(content=standard_result)
                 
                 # 请求失败
                 error_text = response.text[:500]
@@ -984,7 +965,11 @@ async def gemini_generate_content(
                 
                 # 处理凭证失败
                 cd_sec = None
-                if response.status_code in [401, 403]:
+                breaker_open = circuit_breakers.record_failure(upstream, model, error_text, status_code=response.status_code, request=request)
+                if breaker_open:
+                    # 上游熔断：不是凭证的问题，释放本次选取设置的 CD
+                    await CredentialPool.release_model_group_cd(db, credential.id, model, credential.selection)
+                elif response.status_code in [401, 403]:
                     await CredentialPool.handle_credential_failure(db, credential.id, last_error)
                 elif response.status_code == 429:
                     cd_sec = await CredentialPool.handle_429_rate_limit(
@@ -1008,9 +993,8 @@ async def gemini_generate_content(
                     credential_email=credential.email
                 )
                 db.add(log)
-                credential.total_requests = (credential.total_requests or 0) + 1
-                credential.last_used_at = datetime.utcnow()
                 await db.commit()
+                usage_buffer.add_credential_use(credential.id)
                 
                 # WebSocket 实时通知
                 await notify_log_update({
@@ -1023,7 +1007,9 @@ async def gemini_generate_content(
                 })
                 await notify_stats_update()
                 
-                # 检查是否应该重试
+                # 检查是否应该重试（熔断后不再重试）
+                if breaker_open:
+                    raise circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), last_error)
                 should_retry = response.status_code in [429, 500, 503, 404]
                 if should_retry and retry_attempt < max_retries:
                     print(f"[Gemini API] 🔄 切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
@@ -1042,8 +1028,12 @@ async def gemini_generate_content(
             last_error = error_str
             print(f"[Gemini API] ❌ 异常: {error_str}", flush=True)
             
+            breaker_open = circuit_breakers.record_failure(upstream, model, error_str, request=request)
             if credential:
-                await CredentialPool.handle_credential_failure(db, credential.id, error_str)
+                if breaker_open:
+                    await CredentialPool.release_model_group_cd(db, credential.id, model, credential.selection)
+                else:
+                    await CredentialPool.handle_credential_failure(db, credential.id, error_str)
             
             # ✅ 每次尝试都记录日志（包括中间的重试）
             status_code = extract_status_code(error_str)
@@ -1062,10 +1052,9 @@ async def gemini_generate_content(
                 credential_email=credential.email if credential else None
             )
             db.add(log)
-            if credential:
-                credential.total_requests = (credential.total_requests or 0) + 1
-                credential.last_used_at = datetime.utcnow()
             await db.commit()
+            if credential:
+                usage_buffer.add_credential_use(credential.id)
             
             # WebSocket 实时通知
             await notify_log_update({
@@ -1078,8 +1067,10 @@ async def gemini_generate_content(
             })
             await notify_stats_update()
             
-            # 检查是否应该重试
-            should_retry = any(code in error_str for code in ["429", "500", "503", "RESOURCE_EXHAUSTED", "ECONNRESET", "ETIMEDOUT"])
+            # 检查是否应该重试（熔断后不再重试）
+            if breaker_open:
+                raise circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), error_str)
+            should_retry = any(code in error_str for code in ["429", "500", "503", "504", "RESOURCE_EXHAUSTED", "ECONNRESET", "ETIMEDOUT"])
             if should_retry and retry_attempt < max_retries:
                 print(f"[Gemini API] 🔄 切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
                 continue
@@ -1122,6 +1113,9 @@ async def gemini_stream_generate_content(
     # 检查用户是否参与大锅饭
     user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
     
+    # 本次请求使用的配置快照（请求处理中配置变更不影响本次请求）
+    cfg = config_snapshot()
+    
     # 速率限制 - 管理员豁免
     if not user.is_admin:
         one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
@@ -1129,9 +1123,10 @@ async def gemini_stream_generate_content(
             select(func.count(UsageLog.id))
             .where(UsageLog.user_id == user.id)
             .where(UsageLog.created_at >= one_minute_ago)
+            .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+        max_rpm = cfg.contributor_rpm if user_has_public else cfg.base_rpm
         
         if current_rpm >= max_rpm:
             raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
@@ -1159,8 +1154,14 @@ async def gemini_stream_generate_content(
     if "tools" in body:
         request_body["tools"] = body["tools"]
     
+    # 上游熔断中：直接返回 503，不选取凭证
+    upstream = GeminiClient.INTERNAL_API_BASE
+    retry_after = circuit_breakers.acquire(upstream, model, request)
+    if retry_after:
+        raise circuit_open_exception(upstream, model, retry_after)
+    
     # 预先获取第一个凭证（使用主db）
-    max_retries = settings.error_retry_count
+    max_retries = cfg.error_retry_count
     tried_credential_ids = set()
     
     credential = await CredentialPool.get_available_credential(
@@ -1179,28 +1180,29 @@ async def gemini_stream_generate_content(
     project_id = credential.project_id or ""
     first_credential_id = credential.id
     first_credential_email = credential.email
+    first_credential_selection = credential.selection
     user_id = user.id
     username = user.username
     print(f"[Gemini Stream] 使用凭证: {credential.email}, project_id: {project_id}, model: {model}", flush=True)
     
     # ✅ 主db连接到此处结束使用，流式生成器将使用独立会话
     
-    # 后台任务：记录日志（使用独立会话）
+    # 后台任务：记录日志（通过写队列批量提交）
     async def save_log_background(log_data: dict):
         try:
-            async with async_session() as bg_db:
-                latency = log_data.get("latency_ms", 0)
-                status_code = log_data.get("status_code", 200)
-                error_msg = log_data.get("error_message")
-                cred_id = log_data.get("cred_id")
-                cred_email = log_data.get("cred_email")
-                
-                # 错误分类
-                error_type = None
-                error_code = None
-                if status_code != 200 and error_msg:
-                    error_type, error_code = classify_error_simple(status_code, error_msg)
-                
+            latency = log_data.get("latency_ms", 0)
+            status_code = log_data.get("status_code", 200)
+            error_msg = log_data.get("error_message")
+            cred_id = log_data.get("cred_id")
+            cred_email = log_data.get("cred_email")
+            
+            # 错误分类
+            error_type = None
+            error_code = None
+            if status_code != 200 and error_msg:
+                error_type, error_code = classify_error_simple(status_code, error_msg)
+            
+            async def write_log(bg_db):
                 log = UsageLog(
                     user_id=user_id,
                     credential_id=cred_id,
@@ -1208,6 +1210,8 @@ async def gemini_stream_generate_content(
                     endpoint="/v1beta/streamGenerateContent",
                     status_code=status_code,
                     latency_ms=latency,
+                    tokens_input=log_data.get("tokens_input", 0),
+                    tokens_output=log_data.get("tokens_output", 0),
                     cd_seconds=log_data.get("cd_seconds"),
                     error_message=error_msg[:2000] if error_msg else None,
                     error_type=error_type,
@@ -1215,47 +1219,60 @@ async def gemini_stream_generate_content(
                     credential_email=cred_email
                 )
                 bg_db.add(log)
-                
-                # 更新凭证使用次数
-                if cred_id:
-                    from app.models.user import Credential
-                    cred_result = await bg_db.execute(
-                        select(Credential).where(Credential.id == cred_id)
-                    )
-                    cred = cred_result.scalar_one_or_none()
-                    if cred:
-                        cred.total_requests = (cred.total_requests or 0) + 1
-                        cred.last_used_at = datetime.utcnow()
-                
-                await bg_db.commit()
-                
-                # WebSocket 实时通知
-                await notify_log_update({
-                    "username": username,
-                    "model": model,
-                    "status_code": status_code,
-                    "error_type": error_type,
-                    "latency_ms": round(latency, 0),
-                    "created_at": datetime.utcnow().isoformat()
-                })
-                await notify_stats_update()
-                print(f"[Gemini Stream] ✅ 后台日志已记录: user={username}, model={model}, status={status_code}", flush=True)
+            
+            await db_writer.run(write_log)
+            
+            # 更新凭证使用次数（客户端取消的请求不计入）
+            if cred_id and status_code != CLIENT_CLOSED_REQUEST:
+                usage_buffer.add_credential_use(cred_id)
+            
+            # WebSocket 实时通知
+            await notify_log_update({
+                "username": username,
+                "model": model,
+                "status_code": status_code,
+                "error_type": error_type,
+                "latency_ms": round(latency, 0),
+                "created_at": datetime.utcnow().isoformat()
+            })
+            await notify_stats_update()
+            print(f"[Gemini Stream] ✅ 后台日志已记录: user={username}, model={model}, status={status_code}", flush=True)
         except Exception as log_err:
             print(f"[Gemini Stream] ❌ 后台日志记录失败: {log_err}", flush=True)
     
+    async def on_client_disconnect():
+        """客户端断开：记录为客户端取消，并释放本次占用的凭证 CD"""
+        print(f"[Gemini Stream] ⚠️ 客户端断开，已取消上游请求: user={username}, model={model}", flush=True)
+        await save_log_background({
+            "status_code": CLIENT_CLOSED_REQUEST,
+            "error_message": "客户端断开连接，已取消上游请求",
+            "latency_ms": (time.time() - start_time) * 1000,
+            "cred_id": current_cred_id,
+            "cred_email": current_cred_email
+        })
+        await db_writer.run(
+            lambda bg_db: CredentialPool.release_model_group_cd(bg_db, current_cred_id, model, current_cred_selection, commit=False)
+        )
+    
+    current_cred_id = first_credential_id
+    current_cred_email = first_credential_email
+    current_cred_selection = first_credential_selection
+    
     async def stream_generator_with_retry():
         """🚀 流式生成器（带重试功能，使用独立会话进行数据库操作）"""
-        nonlocal access_token, project_id, tried_credential_ids
-        current_cred_id = first_credential_id
-        current_cred_email = first_credential_email
+        nonlocal access_token, project_id, tried_credential_ids, current_cred_id, current_cred_email, current_cred_selection
         last_error = None
+        # 已经向客户端输出过数据后不能再换凭证重试（客户端会收到重复/拼接的内容），只能输出错误结束
+        yielded = False
         
         for stream_retry in range(max_retries + 1):
             cd_seconds = None
+            usage = None
             payload = {"model": model, "project": project_id, "request": request_body}
             
             try:
-                async with httpx.AsyncClient(timeout=120.0) as client:
+                # 按模型家族的超时策略（连接 / 首字节 / 分块间隔），超时后切换凭证重试
+                async with httpx.AsyncClient(timeout=build_timeout(model, stream=True)) as client:
                     async with client.stream(
                         "POST", url,
                         headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
@@ -1268,10 +1285,13 @@ async def gemini_stream_generate_content(
                             last_error = f"API Error {response.status_code}: {error_text}"
                             print(f"[Gemini Stream] ❌ 错误 {response.status_code}: {error_text}", flush=True)
                             
-                            # 使用独立会话处理凭证失败
+                            # 使用独立会话处理凭证失败（上游熔断时释放本次选取设置的 CD）
+                            breaker_open = circuit_breakers.record_failure(upstream, model, error_text, status_code=response.status_code, request=request)
                             try:
                                 async with async_session() as stream_db:
-                                    if response.status_code in [401, 403]:
+                                    if breaker_open:
+                                        await CredentialPool.release_model_group_cd(stream_db, current_cred_id, model, current_cred_selection)
+                                    elif response.status_code in [401, 403]:
                                         await CredentialPool.handle_credential_failure(stream_db, current_cred_id, last_error)
                                     elif response.status_code == 429:
                                         cd_seconds = await CredentialPool.handle_429_rate_limit(
@@ -1291,8 +1311,8 @@ async def gemini_stream_generate_content(
                                 "cred_email": current_cred_email
                             })
                             
-                            # 检查是否应该重试
-                            should_retry = response.status_code in [429, 500, 503, 404]
+                            # 检查是否应该重试（熔断后不再重试）
+                            should_retry = response.status_code in [429, 500, 503, 404] and not breaker_open
                             if should_retry and stream_retry < max_retries:
                                 print(f"[Gemini Stream] 🔄 切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
                                 
@@ -1308,6 +1328,7 @@ async def gemini_stream_generate_content(
                                             new_token = await CredentialPool.get_access_token(new_credential, stream_db)
                                             if new_token:
                                                 current_cred_id = new_credential.id
+                                                current_cred_selection = new_credential.selection
                                                 current_cred_email = new_credential.email
                                                 access_token = new_token
                                                 project_id = new_credential.project_id or ""
@@ -1317,16 +1338,23 @@ async def gemini_stream_generate_content(
                                     print(f"[Gemini Stream] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
                             
                             # 无法重试，输出错误（日志已记录）
+                            if breaker_open:
+                                error_detail = circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), last_error).detail
+                                yield f"data: {json.dumps({'error': error_detail})}\n\n"
+                                return
                             yield f"data: {json.dumps({'error': f'API Error (已重试 {stream_retry + 1} 次): {error.decode()}'})}\n\n"
                             return
                         
                         # 响应成功，开始输出数据（此后无法重试）
-                        async for line in response.aiter_lines():
+                        async for line in iter_lines_with_deadline(response, model):
                             if line:
+                                yielded = True
                                 # 转换 SSE 数据格式
                                 if line.startswith("data: "):
                                     try:
                                         data = json.loads(line[6:])
+                                        # 最后一个分块（带 finishReason）携带最终用量
+                                        usage = extract_final_usage(data.get("response", data)) or usage
                                         if "response" in data:
                                             standard_data = data.get("response", {})
                                             if "modelVersion" in data:
@@ -1340,23 +1368,33 @@ async def gemini_stream_generate_content(
                                     yield f"{line}\n"
                 
                 # 成功：后台记录日志
+                circuit_breakers.record_success(upstream, model)
                 latency = (time.time() - start_time) * 1000
+                tokens_input, tokens_output = usage_to_log_tokens(usage)
                 background_tasks.add_task(save_log_background, {
                     "status_code": 200,
                     "latency_ms": latency,
+                    "tokens_input": tokens_input,
+                    "tokens_output": tokens_output,
                     "cred_id": current_cred_id,
                     "cred_email": current_cred_email
                 })
                 return  # 成功，退出
                 
             except Exception as e:
+                if isinstance(e, httpx.TimeoutException):
+                    e = timeout_error(model, e)
                 error_str = str(e)
                 last_error = error_str
+                breaker_open = circuit_breakers.record_failure(upstream, model, error_str, request=request)
                 
-                # 使用独立会话处理凭证失败
+                # 使用独立会话处理凭证失败（上游熔断时不记错误，释放本次选取设置的 CD）
                 try:
                     async with async_session() as stream_db:
-                        await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
+                        if breaker_open:
+                            await CredentialPool.release_model_group_cd(stream_db, current_cred_id, model, current_cred_selection)
+                        else:
+                            await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
                 except Exception as db_err:
                     print(f"[Gemini Stream] ⚠️ 标记凭证失败时出错: {db_err}", flush=True)
                 
@@ -1371,10 +1409,10 @@ async def gemini_stream_generate_content(
                     "cred_email": current_cred_email
                 })
                 
-                # 检查是否应该重试
-                should_retry = any(code in error_str for code in ["429", "500", "503", "RESOURCE_EXHAUSTED", "ECONNRESET", "ETIMEDOUT"])
+                # 检查是否应该重试（熔断后不再重试）
+                should_retry = not yielded and any(code in error_str for code in ["429", "500", "503", "504", "RESOURCE_EXHAUSTED", "ECONNRESET", "ETIMEDOUT"])
                 
-                if should_retry and stream_retry < max_retries:
+                if should_retry and not breaker_open and stream_retry < max_retries:
                     print(f"[Gemini Stream] ⚠️ 流式请求失败: {error_str}，切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
                     
                     # 使用独立会话获取新凭证
@@ -1389,6 +1427,7 @@ async def gemini_stream_generate_content(
                                 new_token = await CredentialPool.get_access_token(new_credential, stream_db)
                                 if new_token:
                                     current_cred_id = new_credential.id
+                                    current_cred_selection = new_credential.selection
                                     current_cred_email = new_credential.email
                                     access_token = new_token
                                     project_id = new_credential.project_id or ""
@@ -1398,11 +1437,15 @@ async def gemini_stream_generate_content(
                         print(f"[Gemini Stream] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
                 
                 # 无法重试，输出错误（日志已记录）
+                if breaker_open:
+                    error_detail = circuit_open_exception(upstream, model, circuit_breakers.retry_after(upstream, model), error_str).detail
+                    yield f"data: {json.dumps({'error': error_detail})}\n\n"
+                    return
                 yield f"data: {json.dumps({'error': f'API Error (已重试 {stream_retry + 1} 次): {error_str}'})}\n\n"
                 return
     
     return StreamingResponse(
-        stream_generator_with_retry(),
+        cancel_on_disconnect(stream_generator_with_retry(), on_client_disconnect),
         media_type="text/event-stream",
         headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
     )
@@ -1427,15 +1470,19 @@ async def openai_proxy(
     
     # 检查速率限制 - 管理员豁免
     user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
+    # 本次请求使用的配置快照（请求处理中配置变更不影响本次请求）
+    cfg = config_snapshot()
+    
     if not user.is_admin:
         one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
         rpm_result = await db.execute(
             select(func.count(UsageLog.id))
             .where(UsageLog.user_id == user.id)
             .where(UsageLog.created_at >= one_minute_ago)
+            .where(UsageLog.cache_hit.isnot(True))  # 响应缓存命中不计入
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+        max_rpm = cfg.contributor_rpm if user_has_public else cfg.base_rpm
         
         if current_rpm >= max_rpm:
             raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
@@ -42,8 +42,8 @@ async def websocket_endpoint(
     await manager.connect(websocket, user_id, is_admin)
     
     try:
-        # 发送连接成功消息
-        await websocket.send_json({
+        # 发送连接成功消息（所有发送都经过该连接的发送队列，避免与广播并发写）
+        await manager.send_to_socket(websocket, {
             "type": "connected",
             "message": "WebSocket 连接成功",
             "user_id": user_id,
@@ -56,14 +56,14 @@ async def websocket_endpoint(
                 data = await asyncio.wait_for(websocket.receive_json(), timeout=30)
                 
                 if data.get("type") == "ping":
-                    await websocket.send_json({"type": "pong"})
+                    await manager.send_to_socket(websocket, {"type": "pong"})
                     
             except asyncio.TimeoutError:
-                # 发送心跳
-                try:
-                    await websocket.send_json({"type": "ping"})
-                except:
+                # 发送队列已因发送失败关闭
+                if not manager.is_alive(websocket):
                     break
+                # 发送心跳
+                await manager.send_to_socket(websocket, {"type": "ping"})
                     
     except WebSocketDisconnect:
         pass
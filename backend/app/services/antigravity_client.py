@@ -3,6 +3,9 @@ import json
 import uuid
 from typing import AsyncGenerator, Optional, Dict, Any, List
 from app.config import settings
+from app.utils.heartbeat import wait_with_heartbeat
+from app.utils.usage import extract_usage, extract_final_usage, usage_to_openai
+from app.utils.deadline import build_timeout, timeout_error, iter_lines_with_deadline
 
 
 class AntigravityClient:
@@ -18,6 +21,7 @@ class AntigravityClient:
     def __init__(self, access_token: str, project_id: str = None):
         self.access_token = access_token
         self.project_id = project_id or ""
+        self.last_usage = None  # 最近一次请求的 token 用量（见 app.utils.usage）
         self.api_base = settings.antigravity_api_base
     
     # 安全设置 (完全复制自 gcli2api src/utils.py 第47-58行)
@@ -276,15 +280,12 @@ class AntigravityClient:
         print(json_module.dumps(payload, ensure_ascii=False, indent=2)[:5000], flush=True)
         print(f"[AntigravityClient] ===== END PAYLOAD =====", flush=True)
         
-        # 使用更细粒度的超时配置
-        timeout = httpx.Timeout(
-            connect=30.0,
-            read=600.0,
-            write=30.0,
-            pool=30.0
-        )
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.post(url, headers=headers, json=payload)
+        # 按模型家族的超时策略（连接 / 首字节），超时后由路由切换凭证重试
+        async with httpx.AsyncClient(timeout=build_timeout(final_model)) as client:
+            try:
+                response = await client.post(url, headers=headers, json=payload)
+            except httpx.TimeoutException as e:
+                raise timeout_error(final_model, e)
             
             if response.status_code != 200:
                 error_text = response.text
@@ -333,16 +334,19 @@ class AntigravityClient:
         
         print(f"[AntigravityClient] 流式请求: model={final_model}, project={self.project_id}", flush=True)
         
-        timeout = httpx.Timeout(connect=30.0, read=600.0, write=30.0, pool=30.0)
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            async with client.stream("POST", url, headers=headers, json=payload) as response:
-                if response.status_code != 200:
-                    error_text = await response.aread()
-                    print(f"[AntigravityClient] ❌ 流式错误 {response.status_code}: {error_text.decode()[:500]}", flush=True)
-                    raise Exception(f"API Error {response.status_code}: {error_text.decode()}")
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        yield line[6:]
+        # 按模型家族的超时策略（连接 / 首字节 / 分块间隔），超时后由路由切换凭证重试
+        async with httpx.AsyncClient(timeout=build_timeout(final_model, stream=True)) as client:
+            try:
+                async with client.stream("POST", url, headers=headers, json=payload) as response:
+                    if response.status_code != 200:
+                        error_text = await response.aread()
+                        print(f"[AntigravityClient] ❌ 流式错误 {response.status_code}: {error_text.decode()[:500]}", flush=True)
+                        raise Exception(f"API Error {response.status_code}: {error_text.decode()}")
+                    async for line in iter_lines_with_deadline(response, final_model):
+                        if line.startswith("data: "):
+                            yield line[6:]
+            except httpx.TimeoutException as e:
+                raise timeout_error(final_model, e)
     
     async def fetch_available_models(self) -> List[Dict[str, Any]]:
         """获取可用模型列表"""
@@ -440,6 +444,7 @@ class AntigravityClient:
         
         # 提取 server_base_url
         server_base_url = kwargs.pop("server_base_url", None)
+        cache_scope = kwargs.pop("cache_scope", None)
 
         openai_request = {
             "model": gemini_model,
@@ -449,7 +454,7 @@ class AntigravityClient:
         
         # 2. 使用 gcli2api 完整版转换器将 OpenAI 格式转换为 Gemini 格式
         from app.services.openai2gemini_full import convert_openai_to_gemini_request
-        gemini_dict = await convert_openai_to_gemini_request(openai_request)
+        gemini_dict = await convert_openai_to_gemini_request(openai_request, cache_scope)
         
         print(f"[AntigravityClient] OpenAI->Gemini 转换完成, contents数量: {len(gemini_dict.get('contents', []))}", flush=True)
         
@@ -460,7 +465,7 @@ class AntigravityClient:
         
         # 4. 调用 generate_content (会在内部调用 _normalize_antigravity_request)
         result = await self.generate_content(gemini_model, contents, generation_config, system_instruction)
-        return self._convert_to_openai_response(result, model, server_base_url)
+        return await self._convert_to_openai_response(result, model, server_base_url)
     
     async def chat_completions_stream(
         self,
@@ -474,6 +479,7 @@ class AntigravityClient:
         
         # 提取 server_base_url
         server_base_url = kwargs.pop("server_base_url", None)
+        cache_scope = kwargs.pop("cache_scope", None)
 
         openai_request = {
             "model": gemini_model,
@@ -483,7 +489,7 @@ class AntigravityClient:
         
         # 2. 使用完整版转换器
         from app.services.openai2gemini_full import convert_openai_to_gemini_request
-        gemini_dict = await convert_openai_to_gemini_request(openai_request)
+        gemini_dict = await convert_openai_to_gemini_request(openai_request, cache_scope)
         
         # 3. 提取字段
         contents = gemini_dict.get("contents", [])
@@ -491,7 +497,59 @@ class AntigravityClient:
         system_instruction = gemini_dict.get("systemInstruction")
         
         async for chunk in self.generate_content_stream(gemini_model, contents, generation_config, system_instruction):
-            yield self._convert_to_openai_stream(chunk, model, server_base_url)
+            yield await self._convert_to_openai_stream(chunk, model, server_base_url)
+    
+    async def chat_completions_aggregate(
+        self,
+        model: str,
+        messages: list,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """假非流: 以流式调用上游，直接从 Gemini 分块收集内容，结束后一次性构建 OpenAI 响应
+        
+        不经过 OpenAI SSE 序列化再解析的往返，文本先追加到列表，最后只 join 一次。
+        """
+        import time
+        
+        # 1. 构建完整的 OpenAI 请求对象
+        gemini_model = self._map_model_name(model)
+        
+        # 提取 server_base_url
+        server_base_url = kwargs.pop("server_base_url", None)
+        cache_scope = kwargs.pop("cache_scope", None)
+
+        openai_request = {
+            "model": gemini_model,
+            "messages": messages,
+            **kwargs
+        }
+        
+        # 2. 使用完整版转换器
+        from app.services.openai2gemini_full import convert_openai_to_gemini_request
+        gemini_dict = await convert_openai_to_gemini_request(openai_request, cache_scope)
+        
+        # 3. 提取字段
+        contents = gemini_dict.get("contents", [])
+        generation_config = gemini_dict.get("generationConfig", {})
+        system_instruction = gemini_dict.get("systemInstruction")
+        
+        # 4. 直接收集上游分块
+        content_parts = []
+        reasoning_parts = []
+        async for chunk in self.generate_content_stream(gemini_model, contents, generation_config, system_instruction):
+            try:
+                data = json.loads(chunk)
+            except json.JSONDecodeError:
+                continue
+            response_data = data.get("response", data)
+            usage = extract_final_usage(response_data)
+            if usage:
+                self.last_usage = usage
+            await self._collect_parts(response_data, content_parts, reasoning_parts, server_base_url)
+        
+        return self._build_openai_response(
+            model, "".join(content_parts), "".join(reasoning_parts), created=int(time.time()), usage=self.last_usage
+        )
     
     async def chat_completions_fake_stream(
         self,
@@ -504,6 +562,7 @@ class AntigravityClient:
         
         # 1. 构建完整的 OpenAI 请求对象
         gemini_model = self._map_model_name(model)
+        cache_scope = kwargs.pop("cache_scope", None)
         
         openai_request = {
             "model": gemini_model,
@@ -513,7 +572,7 @@ class AntigravityClient:
         
         # 2. 使用完整版转换器
         from app.services.openai2gemini_full import convert_openai_to_gemini_request
-        gemini_dict = await convert_openai_to_gemini_request(openai_request)
+        gemini_dict = await convert_openai_to_gemini_request(openai_request, cache_scope)
         
         # 3. 提取字段
         contents = gemini_dict.get("contents", [])
@@ -535,7 +594,7 @@ class AntigravityClient:
             self.generate_content(gemini_model, contents, generation_config, system_instruction)
         )
         
-        # 每2秒发送心跳，直到请求完成
+        # 按心跳间隔等待请求完成，上游返回后立即输出（不再轮询）
         heartbeat_chunk = {
             "id": "chatcmpl-antigravity",
             "object": "chat.completion.chunk",
@@ -543,11 +602,15 @@ class AntigravityClient:
             "model": model,
             "choices": [{"index": 0, "delta": {}, "finish_reason": None}]
         }
+        heartbeat_data = f"data: {json.dumps(heartbeat_chunk)}\n\n"
         
-        while not request_task.done():
-            await asyncio.sleep(2)
+        try:
+            async for _ in wait_with_heartbeat(request_task, settings.fake_stream_heartbeat_interval):
+                yield heartbeat_data
+        finally:
+            # 客户端断开时取消上游请求，不再继续消耗凭证额度
             if not request_task.done():
-                yield f"data: {json.dumps(heartbeat_chunk)}\n\n"
+                request_task.cancel()
         
         # 获取完整响应
         try:
@@ -556,6 +619,7 @@ class AntigravityClient:
             
             # API 返回格式是 {"response": {"candidates": ...}}
             response_data = result.get("response", result)
+            self.last_usage = extract_usage(response_data)
             
             if "candidates" in response_data and response_data["candidates"]:
                 candidate = response_data["candidates"][0]
@@ -654,86 +718,6 @@ class AntigravityClient:
                         print(f"[AntigravityClient] 已在最后一个 assistant 消息开头插入思考块（含跳过验证签名）", flush=True)
                     break
     
-    def _convert_messages_to_contents(self, messages: list) -> tuple:
-        """将OpenAI消息格式转换为Gemini contents格式"""
-        contents = []
-        system_instructions = []
-        
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            
-            if role == "system":
-                if isinstance(content, str):
-                    system_instructions.append(content)
-                elif isinstance(content, list):
-                    for item in content:
-                        if isinstance(item, dict) and item.get("type") == "text":
-                            system_instructions.append(item.get("text", ""))
-                        elif isinstance(item, str):
-                            system_instructions.append(item)
-                continue
-            
-            gemini_role = "user" if role == "user" else "model"
-            
-            # 处理多模态内容
-            parts = []
-            if isinstance(content, str):
-                parts.append({"text": content})
-            elif isinstance(content, list):
-                for item in content:
-                    if isinstance(item, dict):
-                        if item.get("type") == "text":
-                            parts.append({"text": item.get("text", "")})
-                        elif item.get("type") == "image_url":
-                            image_url = item.get("image_url", {})
-                            url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
-                            if url.startswith("data:"):
-                                try:
-                                    header, base64_data = url.split(",", 1)
-                                    mime_type = header.split(":")[1].split(";")[0]
-                                    parts.append({
-                                        "inlineData": {
-                                            "mimeType": mime_type,
-                                            "data": base64_data
-                                        }
-                                    })
-                                except Exception as e:
-                                    print(f"[AntigravityClient] ⚠️ 解析图片数据失败: {e}", flush=True)
-                            else:
-                                parts.append({
-                                    "fileData": {
-                                        "mimeType": "image/jpeg",
-                                        "fileUri": url
-                                    }
-                                })
-                        elif "text" in item and "type" not in item:
-                            parts.append({"text": item["text"]})
-                        elif "inlineData" in item:
-                            parts.append({"inlineData": item["inlineData"]})
-                        elif "fileData" in item:
-                            parts.append({"fileData": item["fileData"]})
-                    elif isinstance(item, str):
-                        parts.append({"text": item})
-            
-            if not parts:
-                parts.append({"text": ""})
-            
-            contents.append({
-                "role": gemini_role,
-                "parts": parts
-            })
-        
-        # 构建 systemInstruction
-        system_instruction = None
-        if system_instructions:
-            combined = "\n\n".join(system_instructions)
-            system_instruction = {"parts": [{"text": combined}]}
-        
-        if not contents:
-            contents.append({"role": "user", "parts": [{"text": "请根据系统指令回答。"}]})
-        
-        return contents, system_instruction
     
     def _map_model_name(self, model: str) -> str:
         """映射模型名称 - 只做前缀去除，Claude映射在 _normalize_antigravity_request 中完成"""
@@ -750,49 +734,51 @@ class AntigravityClient:
         
         return model
     
-    def _convert_to_openai_response(self, gemini_response: dict, model: str, server_base_url: str = None) -> dict:
-        """将Gemini响应转换为OpenAI格式"""
-        content = ""
-        reasoning_content = ""
-        
-        response_data = gemini_response.get("response", gemini_response)
-        
-        if "candidates" in response_data and response_data["candidates"]:
-            candidate = response_data["candidates"][0]
-            if "content" in candidate and "parts" in candidate["content"]:
-                parts = candidate["content"]["parts"]
-                print(f"[AntigravityClient] 响应 parts 数量: {len(parts)}, 类型: {[list(p.keys()) for p in parts]}", flush=True)
-                for part in parts:
-                    # 处理文本
-                    if "text" in part:
-                        text = part.get("text", "")
-                        if part.get("thought", False):
-                            reasoning_content += text
+    async def _collect_parts(self, response_data: dict, content_parts: List[str], reasoning_parts: List[str], server_base_url: str = None, log_parts: bool = False) -> None:
+        """从 Gemini 响应（或流式分块）中收集文本/思考/图片，追加到列表缓冲区"""
+        if "candidates" not in response_data or not response_data["candidates"]:
+            return
+        candidate = response_data["candidates"][0]
+        if "content" not in candidate or "parts" not in candidate["content"]:
+            return
+        parts = candidate["content"]["parts"]
+        if log_parts:
+            print(f"[AntigravityClient] 响应 parts 数量: {len(parts)}, 类型: {[list(p.keys()) for p in parts]}", flush=True)
+        for part in parts:
+            # 处理文本
+            if "text" in part:
+                text = part.get("text", "")
+                if part.get("thought", False):
+                    reasoning_parts.append(text)
+                else:
+                    content_parts.append(text)
+            # 处理图片 (inlineData)
+            elif "inlineData" in part:
+                inline_data = part["inlineData"]
+                mime_type = inline_data.get("mimeType", "image/png")
+                data = inline_data.get("data", "")
+                if data:
+                    # 保存图片到本地并获取 URL（线程池中解码写盘，不阻塞事件循环）
+                    from app.services.image_storage import ImageStorage
+                    relative_url, thumbnail_url = await ImageStorage.save_base64_image_async(data, mime_type)
+                    
+                    if relative_url:
+                        # 如果有 server_base_url，拼接成完整 URL
+                        base_url = server_base_url or ""
+                        final_url = f"{base_url}{relative_url}"
+                        
+                        if thumbnail_url:
+                            # 有缩略图：显示缩略图，点击打开原图
+                            content_parts.append(f"[![Generated Image]({base_url}{thumbnail_url})]({final_url})")
                         else:
-                            content += text
-                    # 处理图片 (inlineData)
-                    elif "inlineData" in part:
-                        inline_data = part["inlineData"]
-                        mime_type = inline_data.get("mimeType", "image/png")
-                        data = inline_data.get("data", "")
-                        if data:
-                            # 保存图片到本地并获取 URL
-                            from app.services.image_storage import ImageStorage
-                            relative_url = ImageStorage.save_base64_image(data, mime_type)
-                            
-                            if relative_url:
-                                # 如果有 server_base_url，拼接成完整 URL
-                                if server_base_url:
-                                    final_url = f"{server_base_url}{relative_url}"
-                                else:
-                                    final_url = relative_url
-                                    
-                                content += f"![Generated Image]({final_url})"
-                            else:
-                                # 回退到 data URL
-                                data_url = f"data:{mime_type};base64,{data}"
-                                content += f"![Generated Image]({data_url})"
-        
+                            content_parts.append(f"![Generated Image]({final_url})")
+                    else:
+                        # 回退到 data URL
+                        data_url = f"data:{mime_type};base64,{data}"
+                        content_parts.append(f"![Generated Image]({data_url})")
+    
+    def _build_openai_response(self, model: str, content: str, reasoning_content: str = "", created: int = 0, usage: Optional[Dict[str, int]] = None) -> dict:
+        """构建 OpenAI 格式的非流式响应"""
         message = {
             "role": "assistant",
             "content": content
@@ -803,61 +789,44 @@ class AntigravityClient:
         return {
             "id": "chatcmpl-antigravity",
             "object": "chat.completion",
-            "created": 0,
+            "created": created,
             "model": model,
             "choices": [{
                 "index": 0,
                 "message": message,
                 "finish_reason": "stop"
             }],
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0
-            }
+            "usage": usage_to_openai(usage)
         }
     
-    def _convert_to_openai_stream(self, chunk_data: str, model: str, server_base_url: str = None) -> str:
+    async def _convert_to_openai_response(self, gemini_response: dict, model: str, server_base_url: str = None) -> dict:
+        """将Gemini响应转换为OpenAI格式"""
+        content_parts = []
+        reasoning_parts = []
+        
+        response_data = gemini_response.get("response", gemini_response)
+        self.last_usage = extract_usage(response_data)
+        await self._collect_parts(response_data, content_parts, reasoning_parts, server_base_url, log_parts=True)
+        
+        return self._build_openai_response(model, "".join(content_parts), "".join(reasoning_parts), usage=self.last_usage)
+    
+    async def _convert_to_openai_stream(self, chunk_data: str, model: str, server_base_url: str = None) -> str:
         """将Gemini流式响应转换为OpenAI SSE格式"""
         try:
             data = json.loads(chunk_data)
-            content = ""
-            reasoning_content = ""
+            content_parts = []
+            reasoning_parts = []
             
             response_data = data.get("response", data)
             
-            if "candidates" in response_data and response_data["candidates"]:
-                candidate = response_data["candidates"][0]
-                if "content" in candidate and "parts" in candidate["content"]:
-                    for part in candidate["content"]["parts"]:
-                        # 处理文本
-                        if "text" in part:
-                            text = part.get("text", "")
-                            if part.get("thought", False):
-                                reasoning_content += text
-                            else:
-                                content += text
-                        # 处理图片 (inlineData)
-                        elif "inlineData" in part:
-                            inline_data = part["inlineData"]
-                            mime_type = inline_data.get("mimeType", "image/png")
-                            data = inline_data.get("data", "")
-                            if data:
-                                # 保存图片到本地并获取 URL
-                                from app.services.image_storage import ImageStorage
-                                relative_url = ImageStorage.save_base64_image(data, mime_type)
-                                
-                                if relative_url:
-                                    # 如果有 server_base_url，拼接成完整 URL
-                                    if server_base_url:
-                                        final_url = f"{server_base_url}{relative_url}"
-                                    else:
-                                        final_url = relative_url
-                                        
-                                    content += f"![Generated Image]({final_url})"
-                                else:
-                                    data_url = f"data:{mime_type};base64,{data}"
-                                    content += f"![Generated Image]({data_url})"
+            # 最后一个分块（带 finishReason）携带最终用量
+            usage = extract_final_usage(response_data)
+            if usage:
+                self.last_usage = usage
+            
+            await self._collect_parts(response_data, content_parts, reasoning_parts, server_base_url)
+            content = "".join(content_parts)
+            reasoning_content = "".join(reasoning_parts)
             
             delta = {}
             if content:
@@ -880,5 +849,5 @@ class AntigravityClient:
                 }]
             }
             return f"data: {json.dumps(openai_chunk)}\n\n"
-        except:
+        except Exception:
             return ""
\ No newline at end of file
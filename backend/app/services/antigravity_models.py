@@ -0,0 +1,275 @@
+"""
+Antigravity 模型列表缓存
+
+SillyTavern 等客户端会频繁请求 /antigravity/v1/models，原实现每次都选取一个凭证
+（更新 last_used_at / total_requests 并提交）、可能刷新 Token，再请求上游 fetchAvailableModels。
+这里按 (凭证池范围, 等级) 缓存过滤、展开变体后的模型列表：
+- 命中（未过期）:   直接返回，不选取凭证、不写数据库
+- 过期:           先返回旧列表，后台刷新（同一个键同时只有一个刷新任务）
+- 首次/无缓存:      同步获取一次；获取失败时回退到静态列表（短 TTL，避免持续打上游）
+上游获取只读取凭证（不更新使用时间和计数，不触发 CD），且只使用范围内的凭证：
+public 范围只用公共凭证（列表被所有用户共享，不能借用触发刷新的用户的私有凭证），
+user:{id} 范围只用该用户自己的凭证。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.config import settings, config_snapshot
+
+# 获取失败时静态列表的缓存时间（秒）
+FALLBACK_TTL = 60
+# 最多缓存的 (范围, 等级) 条目数（私有模式下每个用户一个范围）
+MAX_ENTRIES = 1024
+
+
+def _is_valid_model(model_id: str) -> bool:
+    """只保留标准的 gemini, claude, gpt 模型，过滤测试/内部模型"""
+    model_lower = model_id.lower()
+    # 排除条件：包含这些关键字的跳过
+    invalid_patterns = [
+        "chat_", "rev", "tab_", "uic", "test", "exp", "lite_preview",
+        "2.5", "gemini-2", "gcli-"
+    ]
+    for pattern in invalid_patterns:
+        if pattern in model_lower:
+            return False
+    # 允许条件：必须是 gemini, claude, gpt 开头的模型
+    valid_prefixes = ["gemini-3", "claude", "gpt-oss", "agy-gemini-3", "agy-claude", "agy-gpt"]
+    for prefix in valid_prefixes:
+        if model_lower.startswith(prefix):
+            return True
+    return False
+
+
+def build_dynamic_model_list(dynamic_models: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """上游模型列表 -> 过滤并添加变体后的 OpenAI 模型列表"""
+    # 添加流式抗截断变体（假非流已自动处理，不需要单独列出）
+    models = []
+    for m in dynamic_models:
+        model_id = m.get("id", "")
+        # 过滤无效模型
+        if not _is_valid_model(model_id):
+            continue
+        models.append({"id": model_id, "object": "model", "owned_by": "google"})
+        models.append({"id": f"流式抗截断/{model_id}", "object": "model", "owned_by": "google"})
+
+        if "image" in model_id.lower() and "2k" not in model_id.lower() and "4k" not in model_id.lower():
+            models.append({"id": f"{model_id}-2k", "object": "model", "owned_by": "google"})
+            models.append({"id": f"{model_id}-4k", "object": "model", "owned_by": "google"})
+            if not model_id.startswith("agy-"):
+                models.append({"id": f"agy-{model_id}-2k", "object": "model", "owned_by": "google"})
+                models.append({"id": f"agy-{model_id}-4k", "object": "model", "owned_by": "google"})
+
+    # 强制添加 Claude 模型的不带 -thinking 后缀版本
+    claude_base_models = [
+        "claude-opus-4-5", "agy-claude-opus-4-5",
+        "claude-sonnet-4-5", "agy-claude-sonnet-4-5",
+    ]
+    existing_ids = {m["id"] for m in models}
+    for base_model in claude_base_models:
+        if base_model not in existing_ids:
+            models.append({"id": base_model, "object": "model", "owned_by": "google"})
+            models.append({"id": f"流式抗截断/{base_model}", "object": "model", "owned_by": "google"})
+
+    image_variants = [
+        "gemini-3-pro-image", "agy-gemini-3-pro-image",
+        "gemini-3-pro-image-2k", "agy-gemini-3-pro-image-2k",
+        "流式抗截断/gemini-3-pro-image-2k", "流式抗截断/agy-gemini-3-pro-image-2k",
+        "gemini-3-pro-image-4k", "agy-gemini-3-pro-image-4k",
+        "流式抗截断/gemini-3-pro-image-4k", "流式抗截断/agy-gemini-3-pro-image-4k",
+    ]
+    existing_ids = {m["id"] for m in models}
+    for variant in image_variants:
+        if variant not in existing_ids:
+            models.append({"id": variant, "object": "model", "owned_by": "google"})
+
+    return models
+
+
+def build_static_model_list() -> List[Dict[str, Any]]:
+    """静态模型列表 (仅 3.0 级别模型，2.5已移除)，上游获取失败时使用"""
+    base_models = [
+        # Gemini 3.0 模型
+        "gemini-3-pro-preview",
+        "gemini-3-flash-preview",
+        # Gemini 3.0 图片生成模型
+        "gemini-3-pro-image",
+        "gemini-3-pro-image-2k",
+        "gemini-3-pro-image-4k",
+        # Claude 模型 (Antigravity 独有) - 使用用户友好的名称
+        "claude-sonnet-4-5",
+        "claude-opus-4-5",
+        # GPT-OSS 模型 (Antigravity 独有)
+        "gpt-oss-120b",
+    ]
+
+    thinking_suffixes = ["-maxthinking", "-nothinking", "-thinking"]
+    search_suffix = "-search"
+
+    models = []
+    for base in base_models:
+        # 基础模型
+        models.append({"id": f"agy-{base}", "object": "model", "owned_by": "google"})
+        models.append({"id": base, "object": "model", "owned_by": "google"})
+        models.append({"id": f"流式抗截断/{base}", "object": "model", "owned_by": "google"})
+
+        # 思维模式变体 (仅 Claude 和部分 Gemini)
+        if base.startswith("claude") or "pro" in base:
+            for suffix in thinking_suffixes:
+                models.append({"id": f"agy-{base}{suffix}", "object": "model", "owned_by": "google"})
+                models.append({"id": f"{base}{suffix}", "object": "model", "owned_by": "google"})
+
+        # 搜索变体 (Gemini 和 Claude 都支持)
+        if base.startswith("gemini") or base.startswith("claude"):
+            models.append({"id": f"agy-{base}{search_suffix}", "object": "model", "owned_by": "google"})
+            models.append({"id": f"{base}{search_suffix}", "object": "model", "owned_by": "google"})
+
+    return models
+
+
+def build_prefixed_model_list(models: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Antigravity 模型列表 -> GeminiCLI /v1/models 中的 agy- 前缀部分"""
+    prefixed = []
+    existing_ids = set()
+    for m in models:
+        model_id = m["id"]
+        if model_id.startswith("流式抗截断/") or model_id.startswith("agy-"):
+            continue
+        prefixed_id = f"agy-{model_id}"
+        if prefixed_id not in existing_ids:
+            existing_ids.add(prefixed_id)
+            prefixed.append({"id": prefixed_id, "object": "model", "owned_by": "google"})
+
+    # 强制添加图片模型变体、不带 -thinking 后缀的 Claude 基础模型和 -search 变体
+    forced_variants = [
+        "agy-gemini-3-pro-image", "agy-gemini-3-pro-image-2k", "agy-gemini-3-pro-image-4k",
+        "agy-claude-opus-4-5", "agy-claude-sonnet-4-5",
+        "agy-claude-opus-4-5-search", "agy-claude-sonnet-4-5-search",
+        "agy-claude-opus-4-5-thinking-search", "agy-claude-sonnet-4-5-thinking-search",
+    ]
+    for variant in forced_variants:
+        if variant not in existing_ids:
+            prefixed.append({"id": variant, "object": "model", "owned_by": "google"})
+    return prefixed
+
+
+def get_pool_scope(user_id: int, user_has_public: bool) -> str:
+    """用户可见的凭证池范围（与 get_available_credential 选取 Flash 凭证的规则一致）"""
+    pool_mode = config_snapshot().credential_pool_mode
+    if pool_mode == "private":
+        return f"user:{user_id}"
+    if pool_mode == "tier3_shared" or user_has_public:
+        return "public"
+    return f"user:{user_id}"
+
+
+class AntigravityModelCache:
+    """按 (凭证池范围, 等级) 缓存的 Antigravity 模型列表"""
+
+    def __init__(self):
+        # (scope, tier) -> (过期时间, 模型列表)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._refreshing: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_failures": 0}
+
+    async def get_models(self, scope: str, tier: str) -> List[Dict[str, Any]]:
+        """scope 为 get_pool_scope 的结果（"public" 或 "user:{id}"），刷新时只使用该范围内的凭证"""
+        key = (scope, tier)
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+            if entry[0] > time.time():
+                self._stats["hits"] += 1
+            else:
+                # 过期：返回旧列表，后台刷新
+                self._stats["stale_hits"] += 1
+                self._start_refresh(key)
+            return entry[1]
+
+        self._stats["misses"] += 1
+        task = self._start_refresh(key)
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            return build_static_model_list()
+
+    def _start_refresh(self, key: Tuple[str, str]) -> asyncio.Task:
+        task = self._refreshing.get(key)
+        if task is None or task.done():
+            task = asyncio.create_task(self._refresh(key))
+            self._refreshing[key] = task
+            task.add_done_callback(lambda t, k=key: self._refreshing.pop(k, None) if self._refreshing.get(k) is t else None)
+        return task
+
+    async def _refresh(self, key: Tuple[str, str]) -> List[Dict[str, Any]]:
+        self._stats["refreshes"] += 1
+        dynamic_models = await self._fetch_dynamic_models(key[0])
+        if dynamic_models:
+            models = build_dynamic_model_list(dynamic_models)
+            ttl = settings.antigravity_models_cache_ttl
+            print(f"[Antigravity] 🔍 模型列表已刷新: scope={key[0]}, tier={key[1]}, 动态模型={len(dynamic_models)}, 列表={len(models)}", flush=True)
+        else:
+            self._stats["refresh_failures"] += 1
+            old = self._entries.get(key)
+            # 获取失败：保留旧列表（若有），否则使用静态列表
+            models = old[1] if old else build_static_model_list()
+            ttl = FALLBACK_TTL
+
+        self._entries[key] = (time.time() + ttl, models)
+        self._entries.move_to_end(key)
+        while len(self._entries) > MAX_ENTRIES:
+            self._entries.popitem(last=False)
+        return models
+
+    @staticmethod
+    async def _fetch_dynamic_models(scope: str) -> List[Dict[str, Any]]:
+        """用范围内任一凭证获取上游模型列表（只读凭证，不更新使用时间、不触发 CD）"""
+        from app.database import async_session
+        from app.models.user import Credential
+        from app.services.credential_pool import CredentialPool
+        from app.services.antigravity_client import AntigravityClient
+
+        try:
+            async with async_session() as db:
+                query = select(Credential).where(
+                    Credential.is_active == True,
+                    Credential.api_type == "antigravity",
+                    Credential.project_id != None,
+                    Credential.project_id != ""
+                )
+                if scope == "public":
+                    query = query.where(Credential.is_public == True)
+                else:
+                    query = query.where(Credential.user_id == int(scope.split(":", 1)[1]))
+                # 优先使用最近成功使用过的凭证（Token 大概率仍有效，无需刷新）
+                result = await db.execute(query.order_by(Credential.last_used_at.desc().nullslast()).limit(1))
+                credential = result.scalar_one_or_none()
+                if not credential:
+                    return []
+
+                access_token = await CredentialPool.get_access_token(credential, db)
+                if not access_token:
+                    return []
+                client = AntigravityClient(access_token, credential.project_id or "")
+                return await client.fetch_available_models()
+        except Exception as e:
+            print(f"[Antigravity] 获取动态模型列表失败: {e}", flush=True)
+            return []
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "ttl": settings.antigravity_models_cache_ttl,
+            **self._stats,
+        }
+
+
+# 全局 Antigravity 模型列表缓存
+antigravity_model_cache = AntigravityModelCache()
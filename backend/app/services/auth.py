@@ -11,6 +11,7 @@ from app.config import settings
 from app.database import get_db
 from app.models.user import User, APIKey
 from app.cache import cache, CACHE_KEYS, cached
+from app.services.usage_buffer import usage_buffer
 
 security = HTTPBearer(auto_error=False)
 
@@ -41,35 +42,32 @@ async def get_user_by_api_key(db: AsyncSession, api_key: str) -> Optional[User]:
     cache_key = f"{CACHE_KEYS['user']}:api_key:{api_key}"
     
     # 尝试从缓存获取
-    cached_user_dict = cache.get(cache_key)
+    cached_user_dict = await cache.get(cache_key)
     if cached_user_dict:
-        # 检查缓存值是否为协程对象，如果是则跳过缓存
-        if callable(getattr(cached_user_dict, "__await__", None)):
-            # 清除无效的协程对象缓存
-            cache.delete(cache_key)
-        else:
-            try:
-                # 从缓存重建User对象
-                user = User(
-                    id=cached_user_dict["id"],
-                    username=cached_user_dict["username"],
-                    email=cached_user_dict["email"],
-                    hashed_password=cached_user_dict["hashed_password"],
-                    discord_id=cached_user_dict["discord_id"],
-                    discord_name=cached_user_dict["discord_name"],
-                    is_active=cached_user_dict["is_active"],
-                    is_admin=cached_user_dict["is_admin"],
-                    daily_quota=cached_user_dict["daily_quota"],
-                    bonus_quota=cached_user_dict["bonus_quota"],
-                    quota_flash=cached_user_dict["quota_flash"],
-                    quota_25pro=cached_user_dict["quota_25pro"],
-                    quota_30pro=cached_user_dict["quota_30pro"],
-                    created_at=datetime.fromisoformat(cached_user_dict["created_at"])
-                )
-                return user
-            except (TypeError, KeyError, ValueError):
-                # 清除无效的缓存值
-                cache.delete(cache_key)
+        try:
+            # 从缓存重建User对象
+            user = User(
+                id=cached_user_dict["id"],
+                username=cached_user_dict["username"],
+                email=cached_user_dict["email"],
+                hashed_password=cached_user_dict["hashed_password"],
+                discord_id=cached_user_dict["discord_id"],
+                discord_name=cached_user_dict["discord_name"],
+                is_active=cached_user_dict["is_active"],
+                is_admin=cached_user_dict["is_admin"],
+                daily_quota=cached_user_dict["daily_quota"],
+                bonus_quota=cached_user_dict["bonus_quota"],
+                quota_flash=cached_user_dict["quota_flash"],
+                quota_25pro=cached_user_dict["quota_25pro"],
+                quota_30pro=cached_user_dict["quota_30pro"],
+                created_at=datetime.fromisoformat(cached_user_dict["created_at"])
+            )
+            if cached_user_dict.get("api_key_id"):
+                usage_buffer.touch_api_key(cached_user_dict["api_key_id"])
+            return user
+        except (TypeError, KeyError, ValueError):
+            # 清除无效的缓存值
+            await cache.delete(cache_key)
     
     # 缓存中没有，查询数据库
     result = await db.execute(
@@ -77,9 +75,8 @@ async def get_user_by_api_key(db: AsyncSession, api_key: str) -> Optional[User]:
     )
     key_obj = result.scalar_one_or_none()
     if key_obj:
-        # 更新最后使用时间
-        key_obj.last_used_at = datetime.utcnow()
-        await db.commit()
+        # 更新最后使用时间（先记在内存，定时批量写入）
+        usage_buffer.touch_api_key(key_obj.id)
         
         result = await db.execute(select(User).where(User.id == key_obj.user_id))
         user = result.scalar_one_or_none()
@@ -100,9 +97,10 @@ async def get_user_by_api_key(db: AsyncSession, api_key: str) -> Optional[User]:
                 "quota_flash": user.quota_flash,
                 "quota_25pro": user.quota_25pro,
                 "quota_30pro": user.quota_30pro,
-                "created_at": user.created_at.isoformat()
+                "created_at": user.created_at.isoformat(),
+                "api_key_id": key_obj.id,
             }
-            cache.set(cache_key, user_dict, ttl=3600)  # 缓存1小时
+            await cache.set(cache_key, user_dict, ttl=3600)  # 缓存1小时
         
         return user
     return None
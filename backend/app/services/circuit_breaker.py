@@ -0,0 +1,282 @@
+"""
+上游熔断器（按 上游地址 + 模型家族）
+
+上游端点（code-assist / Antigravity sandbox）整体故障时，原实现每个请求仍会轮换
+error_retry_count + 1 个凭证，每次都打到同一个故障端点，每个 5xx 都写日志并给凭证记错误、占用 CD。
+
+熔断器按 (上游地址, 模型家族) 统计最近窗口内的结果：
+- 关闭(closed):    正常放行；窗口内请求数 >= 最小请求数 且 失败率 >= 阈值时打开
+- 打开(open):      直接返回 503 + Retry-After，不选取凭证；打开时间到后进入半开
+- 半开(half_open): 只放行少量探测请求，成功则关闭，失败（5xx、超时，以及 429）则重新打开（打开时间翻倍，有上限），
+                 其他错误（400、401 等）不改变状态，只归还探测名额
+只统计上游自身的故障（5xx、超时、连接错误），429 / 4xx 是凭证或请求的问题，不计入；
+但半开探测遇到 429 说明上游仍无法正常服务，按失败处理。
+探测请求没有结果就结束（客户端断开、没有可用凭证等）时，由 CircuitProbeMiddleware 在请求结束时归还探测名额。
+熔断器打开期间失败的请求不给凭证记错误，并释放本次选取设置的 CD。
+状态只在当前 worker 内存中。
+"""
+import re
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, Request
+
+from app.config import settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 探测请求超过此时间仍未返回结果也未归还时，视为丢失，允许新的探测（正常情况下请求结束时即归还）
+PROBE_TIMEOUT = 300
+
+# ASGI scope 中记录本请求持有的探测名额的 key（见 app/middleware/circuit_probe.py）
+PROBES_SCOPE_KEY = "circuit_probes"
+
+# 上游自身故障的特征（429 / RESOURCE_EXHAUSTED 属于凭证配额，不计入）
+_UPSTREAM_FAILURE_PATTERNS = [
+    "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT",
+    "ECONNREFUSED", "Gateway Timeout", "timeout", "Timeout", "ConnectError", "RemoteProtocolError",
+]
+_STATUS_CODE_RE = re.compile(r'(?:API Error |"code":\s*|status_code[=:]\s*|HTTP |Error )(\d{3})')
+
+
+def model_family(model: str) -> str:
+    """模型名 -> 模型家族（去掉流式/渠道前缀和思考、搜索、分辨率等后缀）"""
+    name = model.lower().split("/")[-1]
+    for prefix in ("agy-", "gcli-"):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    if "claude" in name:
+        return "claude"
+    if name.startswith("gpt"):
+        return "gpt-oss"
+    if "image" in name:
+        return "image"
+    match = re.match(r"gemini-(\d+(?:\.\d+)?)-(pro|flash)", name)
+    if match:
+        return f"gemini-{match.group(1)}-{match.group(2)}"
+    return "other"
+
+
+def is_upstream_failure(status_code: Optional[int] = None, error_text: str = "") -> bool:
+    """是否为上游自身的故障（计入熔断统计）"""
+    if status_code is None:
+        match = _STATUS_CODE_RE.search(error_text or "")
+        status_code = int(match.group(1)) if match else None
+    if status_code is not None:
+        return status_code >= 500
+    return any(pattern in (error_text or "") for pattern in _UPSTREAM_FAILURE_PATTERNS)
+
+
+def is_rate_limited(status_code: Optional[int] = None, error_text: str = "") -> bool:
+    """是否为 429 / RESOURCE_EXHAUSTED"""
+    if status_code is None:
+        match = _STATUS_CODE_RE.search(error_text or "")
+        status_code = int(match.group(1)) if match else None
+    return status_code == 429 or "RESOURCE_EXHAUSTED" in (error_text or "")
+
+
+class CircuitBreaker:
+    """单个 (上游地址, 模型家族) 的熔断器"""
+
+    def __init__(self):
+        self.state = CLOSED
+        # 最近窗口内的结果: (时间, 是否失败)
+        self.events: Deque[Tuple[float, bool]] = deque()
+        self.opened_at = 0.0
+        self.open_seconds = 0
+        # 半开状态下已放行、尚未有结果的探测请求编号
+        self.probes: Set[int] = set()
+        self.probe_seq = 0
+        self.probe_deadline = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self.last_failure = ""
+
+    def _trim(self, now: float) -> None:
+        cutoff = now - settings.circuit_breaker_window
+        while self.events and self.events[0][0] < cutoff:
+            self.events.popleft()
+
+    def _open(self, now: float, open_seconds: int) -> None:
+        self.state = OPEN
+        self.opened_at = now
+        self.open_seconds = open_seconds
+        self.probes.clear()
+        self.trips += 1
+
+    def retry_after(self, now: float) -> int:
+        return max(1, int(self.opened_at + self.open_seconds - now + 0.999))
+
+    def acquire(self, now: float) -> Tuple[int, Optional[int]]:
+        """返回 (重试等待秒数, 探测编号)：放行时等待秒数为 0，半开状态下放行的请求带探测编号"""
+        if self.state == OPEN:
+            if now < self.opened_at + self.open_seconds:
+                self.rejected += 1
+                return self.retry_after(now), None
+            self.state = HALF_OPEN
+            self.probes.clear()
+
+        if self.state == HALF_OPEN:
+            if self.probes and now > self.probe_deadline:
+                self.probes.clear()
+            if len(self.probes) >= settings.circuit_breaker_half_open_probes:
+                self.rejected += 1
+                return settings.circuit_breaker_open_seconds, None
+            self.probe_seq += 1
+            self.probes.add(self.probe_seq)
+            self.probe_deadline = now + PROBE_TIMEOUT
+            return 0, self.probe_seq
+        return 0, None
+
+    def release(self, probe: int) -> None:
+        """归还没有结果的探测名额（已有结果时状态已切换，名额已清空，这里什么也不做）"""
+        self.probes.discard(probe)
+
+    def record(self, now: float, failed: bool) -> None:
+        if self.state == HALF_OPEN:
+            if failed:
+                # 探测失败：重新打开，打开时间翻倍
+                self._open(now, min(self.open_seconds * 2 or settings.circuit_breaker_open_seconds,
+                                    settings.circuit_breaker_max_open_seconds))
+            else:
+                self.probes.clear()
+                self.state = CLOSED
+                self.events.clear()
+            return
+        if self.state == OPEN:
+            # 打开前已发出的请求陆续返回，不影响状态
+            return
+
+        self.events.append((now, failed))
+        self._trim(now)
+        if not failed or len(self.events) < settings.circuit_breaker_min_requests:
+            return
+        failures = sum(1 for _, f in self.events if f)
+        if failures / len(self.events) >= settings.circuit_breaker_failure_rate:
+            self._open(now, settings.circuit_breaker_open_seconds)
+
+
+class CircuitBreakerRegistry:
+    """所有熔断器（进程内）"""
+
+    def __init__(self):
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+
+    def _get(self, upstream: str, model: str) -> CircuitBreaker:
+        key = (upstream, model_family(model))
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker()
+        return breaker
+
+    def acquire(self, upstream: str, model: str, request: Optional[Request] = None) -> int:
+        """
+        请求开始前调用：放行返回 0，熔断中返回 Retry-After 秒数
+
+        半开状态下放行的探测请求记录到 request 的 scope 中，请求结束时（无论结果如何）
+        由 CircuitProbeMiddleware 调用 release_probes 归还
+        """
+        if not settings.circuit_breaker_enabled:
+            return 0
+        breaker = self._get(upstream, model)
+        retry_after, probe = breaker.acquire(time.time())
+        if probe is not None and request is not None:
+            probes = request.scope.get(PROBES_SCOPE_KEY)
+            if probes is not None:
+                probes.append((breaker, probe))
+        return retry_after
+
+    @staticmethod
+    def release_probes(probes: List[Tuple[CircuitBreaker, int]]) -> None:
+        """请求结束时归还本请求持有、但没有产生结果的探测名额"""
+        for breaker, probe in probes:
+            breaker.release(probe)
+
+    def record_success(self, upstream: str, model: str) -> None:
+        if not settings.circuit_breaker_enabled:
+            return
+        breaker = self._get(upstream, model)
+        was_closed = breaker.state == CLOSED
+        breaker.record(time.time(), failed=False)
+        if not was_closed and breaker.state == CLOSED:
+            print(f"[CircuitBreaker] ✅ 已恢复: {upstream} / {model_family(model)}", flush=True)
+
+    def record_failure(self, upstream: str, model: str, error_text: str = "", status_code: Optional[int] = None,
+                       request: Optional[Request] = None) -> bool:
+        """
+        请求失败后调用
+
+        半开状态下凭证/请求层面的错误（400、401 等）说明不了上游是否恢复：状态不变，
+        归还 request 持有的该熔断器的探测名额，让其他请求继续探测
+
+        Returns:
+            熔断器是否处于打开状态（True 时调用方不应给凭证记错误，也不应切换凭证重试）
+        """
+        if not settings.circuit_breaker_enabled:
+            return False
+        breaker = self._get(upstream, model)
+        probing = breaker.state == HALF_OPEN
+        if is_upstream_failure(status_code, error_text) or (probing and is_rate_limited(status_code, error_text)):
+            breaker.last_failure = (error_text or f"HTTP {status_code}")[:200]
+            was_open = breaker.state == OPEN
+            breaker.record(time.time(), failed=True)
+            if breaker.state == OPEN and not was_open:
+                print(f"[CircuitBreaker] ⛔ 已熔断: {upstream} / {model_family(model)}, "
+                      f"{breaker.open_seconds} 秒后探测, 最近错误: {breaker.last_failure}", flush=True)
+        elif probing:
+            # 探测没有得到上游是否恢复的结论，只归还名额
+            probes = request.scope.get(PROBES_SCOPE_KEY) if request is not None else None
+            if probes:
+                for held in [item for item in probes if item[0] is breaker]:
+                    breaker.release(held[1])
+                    probes.remove(held)
+        else:
+            # 凭证/请求层面的错误：端点本身是正常的
+            breaker.record(time.time(), failed=False)
+        return breaker.state == OPEN
+
+    def retry_after(self, upstream: str, model: str) -> int:
+        breaker = self._get(upstream, model)
+        return breaker.retry_after(time.time()) if breaker.state == OPEN else settings.circuit_breaker_open_seconds
+
+    def reset(self, upstream: Optional[str] = None, family: Optional[str] = None) -> int:
+        """手动关闭熔断器（不传参数时全部重置），返回重置的数量"""
+        keys = [k for k in self._breakers if (upstream is None or k[0] == upstream) and (family is None or k[1] == family)]
+        for key in keys:
+            del self._breakers[key]
+        return len(keys)
+
+    def get_states(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        states = []
+        for (upstream, family), breaker in self._breakers.items():
+            breaker._trim(now)
+            failures = sum(1 for _, f in breaker.events if f)
+            states.append({
+                "upstream": upstream,
+                "family": family,
+                "state": breaker.state,
+                "requests": len(breaker.events),
+                "failures": failures,
+                "failure_rate": round(failures / len(breaker.events), 4) if breaker.events else 0.0,
+                "retry_after": breaker.retry_after(now) if breaker.state == OPEN else 0,
+                "trips": breaker.trips,
+                "rejected": breaker.rejected,
+                "last_failure": breaker.last_failure,
+            })
+        return states
+
+
+# 全局熔断器
+circuit_breakers = CircuitBreakerRegistry()
+
+
+def circuit_open_exception(upstream: str, model: str, retry_after: int, last_error: str = "") -> HTTPException:
+    """熔断中的 503 响应"""
+    detail = f"上游服务暂时不可用（{model_family(model)} 已熔断），请 {retry_after} 秒后重试"
+    if last_error:
+        detail += f": {last_error}"
+    return HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(retry_after)})
@@ -0,0 +1,200 @@
+"""
+对话转换缓存
+
+多轮对话每次请求都会带上完整历史，而历史消息的转换结果（OpenAI messages -> Gemini contents）
+是确定的。这里按作用域（用户）保留最近几次请求的消息列表和逐条转换结果，
+新请求与其做最长公共前缀匹配，命中部分直接复用，只转换新增的尾部消息。
+
+- 前缀匹配直接比较消息对象（C 层面的 list/dict 相等比较，遇到第一处不同即停止），
+  不对每条消息做哈希：实测在 Python 中逐条序列化+哈希比转换本身还慢，而且比较是精确的，不存在哈希碰撞
+- 作用域按用户隔离，不同用户之间不共享缓存
+- 转换结果是多个请求共享的对象，调用方不得原地修改
+- 容量: 每个作用域最多保留的前缀数 + 全局条目上限 + 全局字节预算（按作用域 LRU 淘汰）。
+  字节数按消息中字符串的总长度估算（内联 base64 图片占大头），单个前缀超过
+  CONVERSATION_CACHE_MAX_ENTRY_BYTES 的请求不缓存，避免几个带图片的长对话占满内存
+- 作用域按用户而不是按 API Key：同一用户的多个 Key 属于同一个人，共享缓存不会泄露数据
+"""
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List
+
+# 全局最多缓存的前缀数
+CONVERSATION_CACHE_SIZE = 2048
+# 每个作用域（用户）最多缓存的前缀数（重新生成、分支对话会用到较早的前缀）
+CONVERSATION_CACHE_PER_SCOPE = 8
+# 全局字节预算（按消息字符串长度估算）
+CONVERSATION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# 单个前缀超过此大小不缓存
+CONVERSATION_CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024
+
+
+def _common_prefix_length(a: list, b: list) -> int:
+    """两个消息列表的公共前缀长度"""
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _estimate_size(value: Any) -> int:
+    """估算消息占用的字节数：字符串长度之和（不计容器本身的开销）"""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_estimate_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_estimate_size(item) for item in value)
+    return 0
+
+
+class ConversationCache:
+    """按消息前缀缓存逐条消息的转换结果"""
+
+    def __init__(
+        self,
+        max_size: int = CONVERSATION_CACHE_SIZE,
+        per_scope: int = CONVERSATION_CACHE_PER_SCOPE,
+        max_bytes: int = CONVERSATION_CACHE_MAX_BYTES,
+        max_entry_bytes: int = CONVERSATION_CACHE_MAX_ENTRY_BYTES,
+    ):
+        self.max_size = max_size
+        self.per_scope = per_scope
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        # scope -> [(messages, context, converted, sizes), ...]，最近使用的在前；sizes 为逐条消息的估算字节数
+        self._scopes: "OrderedDict[str, List[tuple]]" = OrderedDict()
+        self._size = 0
+        self._bytes = 0
+        self._stats = {
+            "hits": 0,
+            "partial_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "oversized": 0,
+            "reused_messages": 0,
+            "converted_messages": 0,
+        }
+
+    def _remove(self, entries: List[tuple], index: int = -1) -> tuple:
+        entry = entries.pop(index)
+        self._size -= 1
+        self._bytes -= sum(entry[3])
+        return entry
+
+    def _evict(self) -> None:
+        while (self._size > self.max_size or self._bytes > self.max_bytes) and self._scopes:
+            scope, entries = next(iter(self._scopes.items()))
+            self._remove(entries)
+            self._stats["evictions"] += 1
+            if not entries:
+                del self._scopes[scope]
+
+    def convert(
+        self,
+        scope: str,
+        messages: List[Dict[str, Any]],
+        convert_message: Callable[[Dict[str, Any]], Any],
+        context: Any = None,
+    ) -> List[Any]:
+        """逐条转换消息，已缓存的最长前缀直接复用
+
+        Args:
+            scope: 缓存作用域（如 "user:1"）
+            messages: 消息列表
+            convert_message: 单条消息的转换函数，结果必须只依赖该消息、之前的消息和 context
+            context: 影响转换结果的其他上下文（如工具 schema），不相等的条目不会被复用
+
+        Returns:
+            与 messages 一一对应的转换结果列表（元素为共享对象）
+        """
+        if not scope or not messages:
+            return [convert_message(message) for message in messages]
+
+        entries = self._scopes.get(scope)
+        best_index, best_length = -1, 0
+        if entries:
+            self._scopes.move_to_end(scope)
+            for index, (cached_messages, cached_context, _, _) in enumerate(entries):
+                if len(cached_messages) <= best_length or cached_context != context:
+                    continue
+                length = _common_prefix_length(cached_messages, messages)
+                if length > best_length:
+                    best_index, best_length = index, length
+                    if length == len(messages):
+                        break
+
+        if best_length == len(messages):
+            self._stats["hits"] += 1
+        elif best_length:
+            self._stats["partial_hits"] += 1
+        else:
+            self._stats["misses"] += 1
+        self._stats["reused_messages"] += best_length
+        self._stats["converted_messages"] += len(messages) - best_length
+
+        if best_index >= 0:
+            cached_messages, _, converted, cached_sizes = entries[best_index]
+            if best_length == len(messages):
+                # 完全命中：提到最前，不新增条目
+                entries.insert(0, entries.pop(best_index))
+                return list(converted[:best_length])
+            results = list(converted[:best_length])
+            sizes = list(cached_sizes[:best_length])
+            if best_length == len(cached_messages):
+                # 新请求是旧条目的延续，旧条目的内容已被新条目覆盖
+                self._remove(entries, best_index)
+        else:
+            results = []
+            sizes = []
+
+        for message in messages[best_length:]:
+            results.append(convert_message(message))
+            sizes.append(_estimate_size(message))
+
+        entry_bytes = sum(sizes)
+        if entry_bytes > self.max_entry_bytes:
+            # 过大的前缀（通常带内联图片）不缓存
+            self._stats["oversized"] += 1
+            if entries is not None and not entries:
+                del self._scopes[scope]
+            return results
+
+        # 保存消息的浅拷贝，避免请求处理过程中对消息的修改影响后续匹配
+        stored_messages = [dict(message) if isinstance(message, dict) else message for message in messages]
+        if entries is None:
+            entries = self._scopes[scope] = []
+        entries.insert(0, (stored_messages, context, tuple(results), tuple(sizes)))
+        self._size += 1
+        self._bytes += entry_bytes
+        if len(entries) > self.per_scope:
+            self._remove(entries)
+            self._stats["evictions"] += 1
+        self._evict()
+        return results
+
+    def clear(self) -> None:
+        self._scopes.clear()
+        self._size = 0
+        self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """命中统计"""
+        requests = self._stats["hits"] + self._stats["partial_hits"] + self._stats["misses"]
+        messages = self._stats["reused_messages"] + self._stats["converted_messages"]
+        return {
+            "size": self._size,
+            "max_size": self.max_size,
+            "scopes": len(self._scopes),
+            "per_scope": self.per_scope,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            **self._stats,
+            "hit_rate": round((self._stats["hits"] + self._stats["partial_hits"]) / requests, 4) if requests else 0.0,
+            "message_reuse_rate": round(self._stats["reused_messages"] / messages, 4) if messages else 0.0,
+        }
+
+
+# 全局对话转换缓存
+conversation_cache = ConversationCache()
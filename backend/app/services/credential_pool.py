@@ -1,11 +1,11 @@
 from typing import Optional
 from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, or_
+from sqlalchemy import select, update, or_, case
 from app.models.user import Credential
 from app.services.crypto import decrypt_credential, encrypt_credential
-from app.config import settings
-from app.cache import cached, CACHE_KEYS
+from app.config import settings, config_snapshot
+from app.cache import cached, invalidate_cache, CACHE_KEYS
 import httpx
 import asyncio
 import logging
@@ -395,12 +395,13 @@ class CredentialPool:
     @staticmethod
     def get_cd_seconds(model_group: str) -> int:
         """获取模型组的 CD 时间（秒）"""
+        cfg = config_snapshot()
         if model_group == "30":
-            return settings.cd_30
+            return cfg.cd_30
         elif model_group == "pro":
-            return settings.cd_pro
+            return cfg.cd_pro
         else:
-            return settings.cd_flash
+            return cfg.cd_flash
     
     @staticmethod
     def is_credential_in_cd(credential: Credential, model_group: str) -> bool:
@@ -441,7 +442,7 @@ class CredentialPool:
     async def has_tier3_credentials(user, db: AsyncSession, mode: str = "geminicli") -> bool:
         """检查用户可用的凭证池中是否有 3.0 凭证（用于模型列表显示）"""
         mode = CredentialPool.validate_mode(mode)
-        pool_mode = settings.credential_pool_mode
+        pool_mode = config_snapshot().credential_pool_mode
         query = select(Credential).where(
             Credential.is_active == True,
             Credential.api_type == mode,
@@ -502,9 +503,12 @@ class CredentialPool:
         模型等级规则:
         - 3.0 模型只能用 3.0 等级的凭证
         - 2.5 模型可以用任何等级的凭证
+        
+        返回的凭证带 selection：(本次选取写入模型组 CD 字段的时间, 该字段选取前的值)，
+        释放 CD 时（release_model_group_cd）需原样传回
         """
         mode = CredentialPool.validate_mode(mode)
-        pool_mode = settings.credential_pool_mode
+        pool_mode = config_snapshot().credential_pool_mode
         query = select(Credential).where(
             Credential.is_active == True,
             Credential.api_type == mode  # 按凭证类型过滤
@@ -609,15 +613,19 @@ class CredentialPool:
         credential.last_used_at = now
         credential.total_requests += 1
         
-        # 更新对应模型组的 CD 时间
+        # 更新对应模型组的 CD 时间（记下原值，释放时恢复）
         if model_group == "30":
+            previous = credential.last_used_30
             credential.last_used_30 = now
         elif model_group == "pro":
+            previous = credential.last_used_pro
             credential.last_used_pro = now
         else:
+            previous = credential.last_used_flash
             credential.last_used_flash = now
         
         await db.commit()
+        credential.selection = (now, previous)
         
         return credential
     
@@ -779,6 +787,37 @@ class CredentialPool:
         )
         await db.commit()
     
+    @staticmethod
+    async def release_model_group_cd(db: AsyncSession, credential_id: int, model: str, selection: Optional[tuple], commit: bool = True):
+        """
+        释放凭证：上游熔断或客户端取消请求时撤销本次选取设置的模型组 CD，让凭证立即可被再次使用，
+        并扣回选取时加的 total_requests（本次尝试不计入使用次数）
+
+        selection 为选取时返回的 (selected_at, previous)。只有 CD 字段仍等于本次选取写入的时间时
+        才恢复为选取前的值（在 UPDATE 的 WHERE 中比较），之后其他请求再次选取或 429 设置的 CD 不受影响。
+        commit=False 时由调用方提交（例如在 db_writer 的 job 中与日志更新一起提交）
+        """
+        if not credential_id or not selection:
+            return
+
+        selected_at, previous = selection
+        model_group = CredentialPool.get_model_group(model)
+        field = {"30": "last_used_30", "pro": "last_used_pro"}.get(model_group, "last_used_flash")
+        column = getattr(Credential, field)
+        result = await db.execute(
+            update(Credential)
+            .where(Credential.id == credential_id, column == selected_at)
+            .values({
+                field: previous,
+                "total_requests": case((Credential.total_requests > 0, Credential.total_requests - 1), else_=0),
+            })
+            .execution_options(synchronize_session=False)
+        )
+        if commit:
+            await db.commit()
+        if result.rowcount:
+            print(f"[CD] 凭证 {credential_id} 已释放模型组 {model_group} 的 CD", flush=True)
+
     @staticmethod
     async def handle_credential_failure(db: AsyncSession, credential_id: int, error: str):
         """
@@ -817,6 +856,8 @@ class CredentialPool:
                         print(f"[凭证降级] 用户 {user.username} 凭证失效，扣除 {deduct} 奖励额度 (等级: {cred.model_tier})", flush=True)
                 
                 await db.commit()
+                if cred.is_public and cred.user_id:
+                    await invalidate_cache(CACHE_KEYS["user"])
                 print(f"[凭证禁用] 凭证 {credential_id} 已禁用: {error}", flush=True)
     
     @staticmethod
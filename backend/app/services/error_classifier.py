@@ -21,6 +21,7 @@ class ErrorType:
     UPSTREAM_ERROR = "UPSTREAM_ERROR"   # 500/502/503 上游服务错误
     TIMEOUT = "TIMEOUT"                 # 请求超时
     TOKEN_ERROR = "TOKEN_ERROR"         # Token 刷新失败
+    CLIENT_CANCELLED = "CLIENT_CANCELLED" # 499 客户端断开，请求已取消
     UNKNOWN = "UNKNOWN"                 # 未知错误
 
 
@@ -36,6 +37,7 @@ ERROR_TYPE_NAMES = {
     ErrorType.UPSTREAM_ERROR: "上游错误",
     ErrorType.TIMEOUT: "请求超时",
     ErrorType.TOKEN_ERROR: "Token错误",
+    ErrorType.CLIENT_CANCELLED: "客户端取消",
     ErrorType.UNKNOWN: "未知错误",
 }
 
@@ -65,6 +67,16 @@ def classify_error(status_code: int, error_text: str) -> ErrorClassification:
     
     # === 1. 按状态码初步分类 ===
     
+    # 499 客户端断开（不是上游或凭证的问题）
+    if status_code == 499:
+        return ErrorClassification(
+            error_type=ErrorType.CLIENT_CANCELLED,
+            error_code="CLIENT_CLOSED_REQUEST",
+            description="客户端断开连接，请求已取消",
+            is_retryable=False,
+            should_disable_credential=False
+        )
+    
     # 401 未授权
     if status_code == 401:
         return ErrorClassification(
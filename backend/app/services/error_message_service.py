@@ -2,14 +2,90 @@
 自定义错误消息服务
 
 提供获取自定义错误消息的功能，供 proxy.py 调用。
+
+启用的规则在内存中编译为匹配器（按 error_type 分组、按优先级排序的候选列表），
+匹配是纯 CPU 操作，不访问数据库；错误集中爆发（如整个池 429）时不会变成数据库查询风暴。
+匹配器只在 routers/error_config.py 修改规则或开关后重建（首次使用时从数据库加载）。
 """
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.models.user import ErrorMessageConfig, SystemConfig
 
 
+class ErrorMessageMatcher:
+    """编译后的自定义错误消息规则
+
+    规则按 (优先级降序, id 升序) 排好，并按 error_type 预先分组：
+    - 每个 error_type 只保留能匹配它的关键词规则（未限定类型的 + 限定为该类型的），关键词已转小写
+    - 仅按类型匹配的规则只记录排名最高的一条
+    匹配时按排名依次做子串判断，排名不可能超过“仅类型规则”时立即结束。
+    """
+
+    def __init__(self, enabled: bool, configs: list):
+        self.enabled = enabled
+        ranked = sorted(configs, key=lambda c: (-(c.priority or 0), c.id))
+        self._results = [{"id": c.id, "message": c.custom_message} for c in ranked]
+
+        # 仅按类型匹配: error_type -> 排名最高的规则
+        self._type_index: Dict[str, int] = {}
+        # 关键词规则: [(排名, 小写关键词, 限定的 error_type)]
+        keyword_rules: List[Tuple[int, str, Optional[str]]] = []
+        for rank, config in enumerate(ranked):
+            if config.keyword:
+                keyword_rules.append((rank, config.keyword.lower(), config.error_type or None))
+            elif config.error_type:
+                self._type_index.setdefault(config.error_type, rank)
+
+        # 未限定类型的关键词规则，以及按 error_type 分组的候选列表（均按排名排序）
+        self._any_type_rules = [(rank, keyword) for rank, keyword, error_type in keyword_rules if not error_type]
+        self._typed_rules: Dict[str, List[Tuple[int, str]]] = {}
+        for error_type in {error_type for _, _, error_type in keyword_rules if error_type}:
+            self._typed_rules[error_type] = [
+                (rank, keyword) for rank, keyword, rule_type in keyword_rules
+                if not rule_type or rule_type == error_type
+            ]
+
+    def match(self, error_type: str, error_text: str) -> Optional[Dict]:
+        if not self.enabled or not self._results:
+            return None
+
+        best = self._type_index.get(error_type, len(self._results))
+        text = (error_text or "").lower()
+        for rank, keyword in self._typed_rules.get(error_type, self._any_type_rules):
+            if rank >= best:
+                break
+            if keyword in text:
+                best = rank
+                break
+
+        return self._results[best] if best < len(self._results) else None
+
+
+# 当前生效的匹配器（None 表示尚未加载）
+_matcher: Optional[ErrorMessageMatcher] = None
+
+
+async def reload_custom_error_messages(db: AsyncSession) -> None:
+    """从数据库重新加载开关和启用的规则并编译（规则或开关变更后调用）"""
+    global _matcher
+    enabled = await is_custom_error_messages_enabled(db)
+    result = await db.execute(
+        select(ErrorMessageConfig).where(ErrorMessageConfig.is_active == True)
+    )
+    configs = result.scalars().all()
+    _matcher = ErrorMessageMatcher(enabled, configs)
+    print(f"[ErrorMessage] 已编译自定义错误消息规则: {len(configs)} 条, 功能{'开启' if enabled else '关闭'}", flush=True)
+
+
+def match_custom_error_message(error_type: str, error_text: str) -> Optional[Dict]:
+    """纯内存匹配（不访问数据库），尚未加载时返回 None"""
+    if _matcher is None:
+        return None
+    return _matcher.match(error_type, error_text)
+
+
 async def is_custom_error_messages_enabled(db: AsyncSession) -> bool:
     """检查自定义错误消息功能是否启用"""
     result = await db.execute(
@@ -20,56 +96,31 @@ async def is_custom_error_messages_enabled(db: AsyncSession) -> bool:
 
 
 async def get_custom_error_message(
-    db: AsyncSession, 
-    error_type: str, 
+    db: AsyncSession,
+    error_type: str,
     error_text: str
 ) -> Optional[Dict]:
     """
     根据错误类型和原始错误文本获取自定义消息
-    
+
     匹配逻辑：
     1. 优先按 priority 降序排列
     2. 关键词匹配（如果配置了 keyword）
     3. 错误类型匹配（如果配置了 error_type）
-    
+
+    只有首次调用（匹配器尚未加载）时访问数据库，之后都是内存匹配。
+
     Args:
         db: 数据库会话
         error_type: 错误类型（如 NETWORK_ERROR, RATE_LIMIT）
         error_text: 原始错误文本
-        
+
     Returns:
         匹配的配置 {"id": int, "message": str} 或 None
     """
-    # 检查功能是否启用
-    if not await is_custom_error_messages_enabled(db):
-        return None
-    
-    # 获取所有活跃的配置，按优先级排序
-    result = await db.execute(
-        select(ErrorMessageConfig)
-        .where(ErrorMessageConfig.is_active == True)
-        .order_by(ErrorMessageConfig.priority.desc())
-    )
-    configs = result.scalars().all()
-    
-    error_text_lower = (error_text or "").lower()
-    
-    for config in configs:
-        # 1. 如果配置了关键词，检查关键词匹配
-        if config.keyword:
-            if config.keyword.lower() in error_text_lower:
-                # 如果还配置了 error_type，也要匹配
-                if config.error_type:
-                    if config.error_type == error_type:
-                        return {"id": config.id, "message": config.custom_message}
-                else:
-                    return {"id": config.id, "message": config.custom_message}
-        
-        # 2. 仅配置了 error_type（没有关键词）
-        elif config.error_type and config.error_type == error_type:
-            return {"id": config.id, "message": config.custom_message}
-    
-    return None
+    if _matcher is None:
+        await reload_custom_error_messages(db)
+    return match_custom_error_message(error_type, error_text)
 
 
 async def get_custom_error_message_sync(
@@ -2,6 +2,10 @@ import httpx
 import json
 from typing import AsyncGenerator, Optional, Dict, Any
 from app.config import settings
+from app.utils.heartbeat import wait_with_heartbeat
+from app.utils.usage import extract_usage, extract_final_usage, usage_to_openai
+from app.utils.deadline import build_timeout, timeout_error, iter_lines_with_deadline
+from app.services.openai2gemini_full import convert_messages_to_contents
 
 
 class GeminiClient:
@@ -13,6 +17,7 @@ class GeminiClient:
     def __init__(self, access_token: str, project_id: str = None):
         self.access_token = access_token
         self.project_id = project_id or ""
+        self.last_usage = None  # 最近一次请求的 token 用量（见 app.utils.usage）
     
     async def generate_content(
         self,
@@ -54,15 +59,12 @@ class GeminiClient:
         print(f"[GeminiClient] 请求: model={model}, project={self.project_id}", flush=True)
         print(f"[GeminiClient] generationConfig: {generation_config}", flush=True)
         
-        # 使用更细粒度的超时配置，避免长时间生成时连接中断
-        timeout = httpx.Timeout(
-            connect=30.0,    # 连接超时
-            read=600.0,      # 读取超时（等待响应）
-            write=30.0,      # 写入超时
-            pool=30.0        # 连接池超时
-        )
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.post(url, headers=headers, json=payload)
+        # 按模型家族的超时策略（连接 / 首字节），超时后由路由切换凭证重试
+        async with httpx.AsyncClient(timeout=build_timeout(model)) as client:
+            try:
+                response = await client.post(url, headers=headers, json=payload)
+            except httpx.TimeoutException as e:
+                raise timeout_error(model, e)
             
             # 打印所有响应头（调试用）
             print(f"[GeminiClient] 响应头: {dict(response.headers)}", flush=True)
@@ -115,17 +117,21 @@ class GeminiClient:
         
         print(f"[GeminiClient] 流式请求: model={model}, project={self.project_id}", flush=True)
         
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            async with client.stream(
-                "POST", url, headers=headers, json=payload
-            ) as response:
-                if response.status_code != 200:
-                    error_text = await response.aread()
-                    print(f"[GeminiClient] ❌ 流式错误 {response.status_code}: {error_text.decode()[:500]}", flush=True)
-                    raise Exception(f"API Error {response.status_code}: {error_text.decode()}")
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        yield line[6:]
+        # 按模型家族的超时策略（连接 / 首字节 / 分块间隔），超时后由路由切换凭证重试
+        async with httpx.AsyncClient(timeout=build_timeout(model, stream=True)) as client:
+            try:
+                async with client.stream(
+                    "POST", url, headers=headers, json=payload
+                ) as response:
+                    if response.status_code != 200:
+                        error_text = await response.aread()
+                        print(f"[GeminiClient] ❌ 流式错误 {response.status_code}: {error_text.decode()[:500]}", flush=True)
+                        raise Exception(f"API Error {response.status_code}: {error_text.decode()}")
+                    async for line in iter_lines_with_deadline(response, model):
+                        if line.startswith("data: "):
+                            yield line[6:]
+            except httpx.TimeoutException as e:
+                raise timeout_error(model, e)
     
     async def fetch_quota_info(self) -> Dict[str, Any]:
         """获取配额信息 - 从 Google API 获取实时配额
@@ -206,7 +212,8 @@ class GeminiClient:
         **kwargs
     ) -> Dict[str, Any]:
         """OpenAI兼容的chat completions (非流式)"""
-        contents, system_instruction = self._convert_messages_to_contents(messages)
+        cache_scope = kwargs.pop("cache_scope", None)
+        contents, system_instruction = convert_messages_to_contents(messages, cache_scope=cache_scope)
         generation_config = self._build_generation_config(model, kwargs)
         gemini_model = self._map_model_name(model)
         
@@ -220,7 +227,8 @@ class GeminiClient:
         **kwargs
     ) -> AsyncGenerator[str, None]:
         """OpenAI兼容的chat completions (流式)"""
-        contents, system_instruction = self._convert_messages_to_contents(messages)
+        cache_scope = kwargs.pop("cache_scope", None)
+        contents, system_instruction = convert_messages_to_contents(messages, cache_scope=cache_scope)
         generation_config = self._build_generation_config(model, kwargs)
         gemini_model = self._map_model_name(model)
         
@@ -236,7 +244,8 @@ class GeminiClient:
         """假流式: 先发心跳，拿到完整响应后一次性输出"""
         import asyncio
         
-        contents, system_instruction = self._convert_messages_to_contents(messages)
+        cache_scope = kwargs.pop("cache_scope", None)
+        contents, system_instruction = convert_messages_to_contents(messages, cache_scope=cache_scope)
         generation_config = self._build_generation_config(model, kwargs)
         gemini_model = self._map_model_name(model)
         
@@ -255,7 +264,7 @@ class GeminiClient:
             self.generate_content(gemini_model, contents, generation_config, system_instruction)
         )
         
-        # 每2秒发送心跳，直到请求完成
+        # 按心跳间隔等待请求完成，上游返回后立即输出（不再轮询）
         heartbeat_chunk = {
             "id": "chatcmpl-catiecli",
             "object": "chat.completion.chunk",
@@ -263,11 +272,15 @@ class GeminiClient:
             "model": model,
             "choices": [{"index": 0, "delta": {}, "finish_reason": None}]
         }
+        heartbeat_data = f"data: {json.dumps(heartbeat_chunk)}\n\n"
         
-        while not request_task.done():
-            await asyncio.sleep(2)
+        try:
+            async for _ in wait_with_heartbeat(request_task, settings.fake_stream_heartbeat_interval):
+                yield heartbeat_data
+        finally:
+            # 客户端断开时取消上游请求，不再继续消耗凭证额度
             if not request_task.done():
-                yield f"data: {json.dumps(heartbeat_chunk)}\n\n"
+                request_task.cancel()
         
         # 获取完整响应
         try:
@@ -276,6 +289,7 @@ class GeminiClient:
             
             # 内部 API 返回格式是 {"response": {"candidates": ...}}
             response_data = result.get("response", result)
+            self.last_usage = extract_usage(response_data)
             
             if "candidates" in response_data and response_data["candidates"]:
                 candidate = response_data["candidates"][0]
@@ -349,103 +363,6 @@ class GeminiClient:
         
         return generation_config
     
-    def _convert_messages_to_contents(self, messages: list) -> tuple:
-        """将OpenAI消息格式转换为Gemini contents格式
-        
-        Returns:
-            (contents, system_instruction): contents 列表和系统指令字典
-        """
-        contents = []
-        system_instructions = []
-        
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            
-            if role == "system":
-                # system 可能是字符串或列表
-                if isinstance(content, str):
-                    system_instructions.append(content)
-                elif isinstance(content, list):
-                    for item in content:
-                        if isinstance(item, dict) and item.get("type") == "text":
-                            system_instructions.append(item.get("text", ""))
-                        elif isinstance(item, str):
-                            system_instructions.append(item)
-                continue
-            
-            gemini_role = "user" if role == "user" else "model"
-            
-            # 处理多模态内容（图片+文本）
-            parts = []
-            if isinstance(content, str):
-                # 简单文本
-                parts.append({"text": content})
-            elif isinstance(content, list):
-                # 多模态内容列表
-                for item in content:
-                    if isinstance(item, dict):
-                        # OpenAI 格式: {"type": "text", "text": "..."}
-                        if item.get("type") == "text":
-                            parts.append({"text": item.get("text", "")})
-                        elif item.get("type") == "image_url":
-                            # 处理图片
-                            image_url = item.get("image_url", {})
-                            url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
-                            if url.startswith("data:"):
-                                # Base64 编码的图片
-                                # 格式: data:image/jpeg;base64,/9j/4AAQ...
-                                try:
-                                    header, base64_data = url.split(",", 1)
-                                    mime_type = header.split(":")[1].split(";")[0]
-                                    parts.append({
-                                        "inlineData": {
-                                            "mimeType": mime_type,
-                                            "data": base64_data
-                                        }
-                                    })
-                                except Exception as e:
-                                    print(f"[GeminiClient] ⚠️ 解析图片数据失败: {e}", flush=True)
-                            else:
-                                # URL 图片
-                                parts.append({
-                                    "fileData": {
-                                        "mimeType": "image/jpeg",
-                                        "fileUri": url
-                                    }
-                                })
-                        # Gemini 原生格式: {"text": "..."} 或 {"inlineData": {...}} 或 {"fileData": {...}}
-                        elif "text" in item and "type" not in item:
-                            parts.append({"text": item["text"]})
-                        elif "inlineData" in item:
-                            parts.append({"inlineData": item["inlineData"]})
-                        elif "fileData" in item:
-                            parts.append({"fileData": item["fileData"]})
-                        else:
-                            # 未知格式，尝试作为文本处理
-                            print(f"[GeminiClient] ⚠️ 未知内容格式: {list(item.keys())}", flush=True)
-                    elif isinstance(item, str):
-                        parts.append({"text": item})
-            
-            if not parts:
-                parts.append({"text": ""})
-            
-            contents.append({
-                "role": gemini_role,
-                "parts": parts
-            })
-        
-        # 构建 systemInstruction
-        system_instruction = None
-        if system_instructions:
-            combined = "\n\n".join(system_instructions)
-            system_instruction = {"parts": [{"text": combined}]}
-        
-        # 如果 contents 为空，添加默认用户消息
-        if not contents:
-            contents.append({"role": "user", "parts": [{"text": "请根据系统指令回答。"}]})
-        
-        return contents, system_instruction
     
     def _map_model_name(self, model: str) -> str:
         """映射模型名称"""
@@ -513,6 +430,7 @@ class GeminiClient:
         
         # 内部 API 返回格式是 {"response": {"candidates": ...}}
         response_data = gemini_response.get("response", gemini_response)
+        self.last_usage = extract_usage(response_data)
         
         if "candidates" in response_data and response_data["candidates"]:
             candidate = response_data["candidates"][0]
@@ -543,11 +461,7 @@ class GeminiClient:
                 "message": message,
                 "finish_reason": "stop"
             }],
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0
-            }
+            "usage": usage_to_openai(self.last_usage)
         }
     
     def _convert_to_openai_stream(self, chunk_data: str, model: str) -> str:
@@ -560,6 +474,11 @@ class GeminiClient:
             # 内部 API 返回格式是 {"response": {"candidates": ...}}
             response_data = data.get("response", data)
             
+            # 最后一个分块（带 finishReason）携带最终用量
+            usage = extract_final_usage(response_data)
+            if usage:
+                self.last_usage = usage
+            
             if "candidates" in response_data and response_data["candidates"]:
                 candidate = response_data["candidates"][0]
                 if "content" in candidate and "parts" in candidate["content"]:
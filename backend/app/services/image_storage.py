@@ -1,77 +1,248 @@
 """
 图片本地存储服务
 用于保存 Antigravity 生成的图片并返回可访问的 URL
+
+- 解码和写盘在线程池中执行，不阻塞事件循环（4K 图片 base64 有数 MB）
+- 分块解码、边解码边写盘，内存中不会再出现一份完整的解码后图片
+- 文件名为图片内容的 SHA-256（内容寻址），相同图片只存一份；文件内容不变，可长期缓存
+- 定期清理：超过保留时间或总大小超过上限时，按修改时间从旧到新分批删除
+- 可选缩略图（需要安装 Pillow）：static/images/thumbs/<hash>.webp
 """
 
-import os
+import asyncio
 import base64
+import hashlib
+import os
+import time
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+
+from starlette.staticfiles import StaticFiles
+
+from app.config import settings
+
+# 尝试导入 Pillow（仅用于生成缩略图），失败时不生成缩略图
+Image = None
+try:
+    from PIL import Image as PILImage
+    Image = PILImage
+except ImportError:
+    pass
+
+# 图片解码/写盘线程池
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-storage")
+
+# 缩略图最长边（像素）
+THUMBNAIL_SIZE = 512
+
+# 每次解码的 base64 字符数（4 的倍数，解码后 48KB）
+DECODE_CHUNK = 64 * 1024
 
 
 class ImageStorage:
     """本地图片存储服务"""
-    
+
     # 图片存储目录（相对于 app 目录）
     # backend/app/services/image_storage.py -> backend/static/images
     STORAGE_DIR = Path(__file__).parent.parent.parent / "static" / "images"
-    
+    THUMBNAIL_DIR = STORAGE_DIR / "thumbs"
+
+    EXT_MAP = {
+        "image/png": ".png",
+        "image/jpeg": ".jpg",
+        "image/jpg": ".jpg",
+        "image/gif": ".gif",
+        "image/webp": ".webp",
+    }
+
     @classmethod
     def init_storage(cls):
         """初始化存储目录"""
         cls.STORAGE_DIR.mkdir(parents=True, exist_ok=True)
         print(f"[ImageStorage] 图片存储目录: {cls.STORAGE_DIR}", flush=True)
-    
+
+    @classmethod
+    def _save_base64_chunked(cls, base64_data: str, mime_type: str) -> Tuple[str, str]:
+        """
+        分块解码 base64 并直接写入文件（同步，调用方需在线程池中执行）
+
+        每次只解码 DECODE_CHUNK 个字符，边解码边计算哈希边写盘，
+        不会再生成一份与图片同样大小的 bytes 对象；分块之间释放 GIL，长时间解码不会卡住事件循环。
+
+        Returns:
+            (图片相对 URL, 缩略图相对 URL)，失败时为空字符串
+        """
+        cls.STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+        ext = cls.EXT_MAP.get(mime_type, ".png")
+        # 先写临时文件，得到内容哈希后再重命名，避免并发请求读到写了一半的文件
+        tmp_path = cls.STORAGE_DIR / f".{uuid.uuid4().hex}{ext}.tmp"
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(base64_data), DECODE_CHUNK):
+                    chunk = base64.b64decode(base64_data[start:start + DECODE_CHUNK])
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            digest = sha256.hexdigest()[:32]
+            filename = f"{digest}{ext}"
+            file_path = cls.STORAGE_DIR / filename
+            if file_path.exists():
+                # 相同图片已存在：只刷新修改时间（清理按修改时间判断）
+                tmp_path.unlink()
+                os.utime(file_path)
+                print(f"[ImageStorage] ♻️ 图片已存在，复用: {filename}", flush=True)
+            else:
+                os.replace(tmp_path, file_path)
+                print(f"[ImageStorage] ✅ 图片已保存: {filename} ({size} bytes)", flush=True)
+        except Exception as e:
+            tmp_path.unlink(missing_ok=True)
+            print(f"[ImageStorage] ❌ 保存图片失败: {e}", flush=True)
+            return "", ""
+
+        thumb_name = cls._write_thumbnail(file_path, digest)
+        return f"/images/{filename}", f"/images/thumbs/{thumb_name}" if thumb_name else ""
+
+    @classmethod
+    def _write_thumbnail(cls, file_path: Path, digest: str) -> Optional[str]:
+        """生成缩略图（未开启或没有 Pillow 时跳过）"""
+        if not settings.image_thumbnails or Image is None:
+            return None
+        thumb_name = f"{digest}.webp"
+        thumb_path = cls.THUMBNAIL_DIR / thumb_name
+        if thumb_path.exists():
+            return thumb_name
+        try:
+            cls.THUMBNAIL_DIR.mkdir(parents=True, exist_ok=True)
+            with Image.open(file_path) as img:
+                img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                tmp_path = thumb_path.with_suffix(f".webp.{os.getpid()}.tmp")
+                img.save(tmp_path, format="WEBP", quality=80)
+            os.replace(tmp_path, thumb_path)
+            return thumb_name
+        except Exception as e:
+            print(f"[ImageStorage] ⚠️ 生成缩略图失败: {e}", flush=True)
+            return None
+
     @classmethod
     def save_base64_image(cls, base64_data: str, mime_type: str = "image/png") -> str:
         """
-        保存 base64 图片到本地并返回相对 URL
-        
+        保存 base64 图片到本地并返回相对 URL（同步版本，会阻塞调用线程）
+
         Args:
             base64_data: base64 编码的图片数据
             mime_type: 图片 MIME 类型
-            
+
         Returns:
             图片的相对 URL 路径 (如 /images/xxx.png)
         """
-        # 确保存储目录存在
-        cls.STORAGE_DIR.mkdir(parents=True, exist_ok=True)
-        
-        # 根据 MIME 类型确定扩展名
-        ext_map = {
-            "image/png": ".png",
-            "image/jpeg": ".jpg",
-            "image/jpg": ".jpg",
-            "image/gif": ".gif",
-            "image/webp": ".webp",
-        }
-        ext = ext_map.get(mime_type, ".png")
-        
-        # 生成唯一文件名
-        timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-        unique_id = str(uuid.uuid4())[:8]
-        filename = f"{timestamp}_{unique_id}{ext}"
-        
-        # 保存文件
-        file_path = cls.STORAGE_DIR / filename
-        try:
-            image_data = base64.b64decode(base64_data)
-            with open(file_path, "wb") as f:
-                f.write(image_data)
-            print(f"[ImageStorage] ✅ 图片已保存: {filename} ({len(image_data)} bytes)", flush=True)
-            
-            # 返回相对 URL
-            return f"/images/{filename}"
-        except Exception as e:
-            print(f"[ImageStorage] ❌ 保存图片失败: {e}", flush=True)
-            return ""
-    
+        return cls._save_base64_chunked(base64_data, mime_type)[0]
+
+    @classmethod
+    async def save_base64_image_async(cls, base64_data: str, mime_type: str = "image/png") -> Tuple[str, str]:
+        """在线程池中解码并保存 base64 图片，返回 (图片相对 URL, 缩略图相对 URL)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, cls._save_base64_chunked, base64_data, mime_type)
+
+    @classmethod
+    def find_expired_images(cls, max_age_hours: int = 24, max_total_mb: int = 0) -> List[Path]:
+        """
+        找出需要清理的图片（同步，调用方需在线程池中执行），按修改时间从旧到新
+
+        Args:
+            max_age_hours: 超过此时间未写入/复用的图片删除（0=不按时间清理）
+            max_total_mb: 图片总大小上限，超出时从最旧的开始删除（0=不限制）
+        """
+        if not cls.STORAGE_DIR.exists():
+            return []
+
+        files = []
+        for entry in os.scandir(cls.STORAGE_DIR):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+        files.sort()
+
+        now = time.time()
+        total_size = sum(size for _, size, _ in files)
+        max_total = max_total_mb * 1024 * 1024
+        expired_paths = []
+        for mtime, size, path in files:
+            expired = max_age_hours > 0 and now - mtime > max_age_hours * 3600
+            oversized = max_total > 0 and total_size > max_total
+            if not expired and not oversized:
+                break
+            expired_paths.append(path)
+            total_size -= size
+        return expired_paths
+
     @classmethod
-    def cleanup_old_images(cls, max_age_hours: int = 24):
-        """清理过期图片（可选功能）"""
-        # TODO: 实现定期清理
-        pass
+    def delete_images(cls, paths: List[Path]) -> int:
+        """删除图片及其缩略图（同步），返回删除的数量"""
+        deleted = 0
+        for path in paths:
+            try:
+                path.unlink()
+                (cls.THUMBNAIL_DIR / f"{path.stem}.webp").unlink(missing_ok=True)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"[ImageStorage] ⚠️ 删除图片失败 {path.name}: {e}", flush=True)
+        return deleted
+
+    @classmethod
+    def cleanup_orphan_thumbnails(cls) -> int:
+        """清理没有对应原图的缩略图（同步）"""
+        if not cls.THUMBNAIL_DIR.exists():
+            return 0
+        originals = {Path(entry.name).stem for entry in os.scandir(cls.STORAGE_DIR) if entry.is_file()}
+        deleted = 0
+        for entry in os.scandir(cls.THUMBNAIL_DIR):
+            if entry.is_file() and Path(entry.name).stem not in originals:
+                Path(entry.path).unlink(missing_ok=True)
+                deleted += 1
+        return deleted
+
+    @classmethod
+    def cleanup_old_images(cls, max_age_hours: int = 24, max_total_mb: int = 0) -> int:
+        """
+        一次清理所有过期图片（同步，调用方需在线程池中执行）
+
+        Returns:
+            删除的图片数量
+        """
+        deleted = cls.delete_images(cls.find_expired_images(max_age_hours, max_total_mb))
+        cls.cleanup_orphan_thumbnails()
+        return deleted
+
+    @classmethod
+    async def cleanup_batches(cls, batch_size: int) -> AsyncIterator[int]:
+        """
+        按配置分批清理图片（维护任务，见 services/maintenance.py）
+        扫描和删除都在线程池中执行，每批最多删除 batch_size 个文件
+        """
+        loop = asyncio.get_running_loop()
+        paths = await loop.run_in_executor(
+            _executor, cls.find_expired_images, settings.image_retention_hours, settings.image_storage_max_mb
+        )
+        for i in range(0, len(paths), batch_size):
+            yield await loop.run_in_executor(_executor, cls.delete_images, paths[i:i + batch_size])
+        await loop.run_in_executor(_executor, cls.cleanup_orphan_thumbnails)
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """图片文件名是内容哈希，内容不会变化，允许客户端/CDN 长期缓存"""
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
 
 
 # 初始化存储目录
@@ -0,0 +1,188 @@
+"""
+多 worker 选主
+
+多个 worker（进程或容器）中只有主 worker 执行一次性的启动任务（同步管理员账号）和定时维护任务
+（清理过期日志、清理图片），其他 worker 只处理请求。
+数据库结构迁移不依赖选主：init_db 持有迁移锁执行，其他 worker 在锁上等待迁移完成后再启动
+（见 database.run_schema_migrations）。
+
+- 有 Redis 时使用 Redis 锁（SET NX EX），否则使用数据库 leader_locks 表
+- 主 worker 每 ttl/3 秒续期；续期失败（卡住、与 Redis/数据库断开）时停止维护任务
+- 其他 worker 每 ttl/3 秒尝试获取，主 worker 退出后最多 ttl 秒由其他 worker 接管
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.config import settings
+from app.database import async_session
+from app.models.user import LeaderLock
+from app.services.redis_service import redis_service
+
+# 锁名
+LOCK_NAME = "maintenance"
+
+
+class LeaderElection:
+    """主 worker 选举，以及只在主 worker 上运行的任务"""
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.is_leader = False
+        self.backend: Optional[str] = None  # redis / database
+        self.leader_since: Optional[float] = None
+        # 成为主 worker 时启动的后台任务（失去主 worker 身份时取消）
+        self._jobs: Dict[str, Callable[[], Awaitable[Any]]] = {}
+        # 本进程第一次成为主 worker 时执行一次的任务
+        self._once_jobs: Dict[str, Callable[[], Awaitable[Any]]] = {}
+        self._once_done = set()
+        self._job_tasks: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def add_job(self, name: str, job: Callable[[], Awaitable[Any]]) -> None:
+        """注册只在主 worker 上运行的后台任务（需在 start 之前注册）"""
+        self._jobs[name] = job
+
+    def add_once_job(self, name: str, job: Callable[[], Awaitable[Any]]) -> None:
+        """注册成为主 worker 后执行一次的任务（需在 start 之前注册）"""
+        self._once_jobs[name] = job
+
+    # ---------- 锁 ----------
+
+    async def _acquire_database(self, ttl: int) -> bool:
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=ttl)
+        async with async_session() as db:
+            # 自己持有时续期，锁已过期时接管
+            result = await db.execute(
+                update(LeaderLock)
+                .where(LeaderLock.name == LOCK_NAME, or_(LeaderLock.owner == self.worker_id, LeaderLock.expires_at < now))
+                .values(owner=self.worker_id, expires_at=expires_at)
+            )
+            if result.rowcount == 0:
+                if await db.scalar(select(LeaderLock.name).where(LeaderLock.name == LOCK_NAME)):
+                    await db.rollback()
+                    return False
+                db.add(LeaderLock(name=LOCK_NAME, owner=self.worker_id, expires_at=expires_at))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # 其他 worker 同时创建了锁
+                return False
+        return True
+
+    async def _try_acquire(self) -> bool:
+        ttl = settings.leader_lock_ttl
+        if redis_service.connected:
+            self.backend = "redis"
+            return await redis_service.acquire_lock(LOCK_NAME, self.worker_id, ttl)
+        self.backend = "database"
+        return await self._acquire_database(ttl)
+
+    async def _release(self) -> None:
+        if self.backend == "redis":
+            await redis_service.release_lock(LOCK_NAME, self.worker_id)
+        elif self.backend == "database":
+            async with async_session() as db:
+                await db.execute(
+                    delete(LeaderLock).where(LeaderLock.name == LOCK_NAME, LeaderLock.owner == self.worker_id)
+                )
+                await db.commit()
+
+    # ---------- 选举 ----------
+
+    async def _elect(self) -> None:
+        try:
+            held = await self._try_acquire()
+        except Exception as e:
+            print(f"[Leader] ⚠️ 获取主 worker 锁失败 ({self.backend}): {e}", flush=True)
+            held = False
+
+        if held and not self.is_leader:
+            self.is_leader = True
+            self.leader_since = time.time()
+            print(f"[Leader] 👑 本 worker 成为主 worker: {self.worker_id} ({self.backend})", flush=True)
+            await self._run_once_jobs()
+            self._start_jobs()
+        elif not held and self.is_leader:
+            self.is_leader = False
+            self.leader_since = None
+            print(f"[Leader] ⚠️ 失去主 worker 身份，停止维护任务: {self.worker_id}", flush=True)
+            await self._stop_jobs()
+
+    async def _run_once_jobs(self) -> None:
+        for name, job in self._once_jobs.items():
+            if name in self._once_done:
+                continue
+            self._once_done.add(name)
+            try:
+                await job()
+            except Exception as e:
+                print(f"[Leader] ⚠️ 任务 {name} 执行失败: {e}", flush=True)
+
+    def _start_jobs(self) -> None:
+        for name, job in self._jobs.items():
+            task = self._job_tasks.get(name)
+            if task is None or task.done():
+                self._job_tasks[name] = asyncio.create_task(job())
+
+    async def _stop_jobs(self) -> None:
+        tasks = list(self._job_tasks.values())
+        self._job_tasks.clear()
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(max(1.0, settings.leader_lock_ttl / 3))
+            await self._elect()
+
+    async def start(self) -> bool:
+        """启动时竞选一次，之后在后台定期续期/竞选，返回当前是否为主 worker"""
+        await self._elect()
+        self._task = asyncio.create_task(self._loop())
+        if not self.is_leader:
+            print(f"[Leader] 本 worker 为从 worker: {self.worker_id} ({self.backend})", flush=True)
+        return self.is_leader
+
+    async def stop(self) -> None:
+        """停止选举和维护任务，持有锁时释放（其他 worker 可立即接管）"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._stop_jobs()
+        if self.is_leader:
+            self.is_leader = False
+            try:
+                await self._release()
+            except Exception as e:
+                print(f"[Leader] ⚠️ 释放主 worker 锁失败: {e}", flush=True)
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "is_leader": self.is_leader,
+            "backend": self.backend,
+            "leader_since": datetime.utcfromtimestamp(self.leader_since).isoformat() if self.leader_since else None,
+            "jobs": sorted(name for name, task in self._job_tasks.items() if not task.done()),
+        }
+
+
+# 全局选主实例
+leader = LeaderElection()
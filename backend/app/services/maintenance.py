@@ -0,0 +1,188 @@
+"""
+维护任务调度（过期日志、生成图片、后台任务状态的定期清理）
+
+每个任务是一个按批执行的异步生成器：每处理完一批（最多 maintenance_batch_size 行 / 文件）
+yield 这一批处理的数量，调度器在两批之间暂停，让出数据库写锁和磁盘 IO：
+暂停时间 = max(maintenance_batch_pause, 本批耗时 × (1 - 占空比) / 占空比)，
+即维护任务最多占用 maintenance_duty_cycle 比例的时间，积压再多也不会造成代理请求的延迟尖刺。
+
+- leader_only 的任务（数据库、共享磁盘）只在主 worker 上运行（见 services/leader.py）
+- 其他任务（进程内状态）在每个 worker 上运行
+- 每次运行结束打印处理数量和速度，/stats/cache 中可查看各任务进度
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from app.config import settings
+
+
+class MaintenanceTask:
+    """一个定期执行的分批维护任务及其进度统计"""
+
+    def __init__(self, name: str, run: Callable[[int], AsyncIterator[int]], interval: float,
+                 leader_only: bool, batch_size: Optional[int]):
+        self.name = name
+        self.run = run
+        self.interval = interval
+        self.leader_only = leader_only
+        self.batch_size = batch_size
+        self.running = False
+        self.runs = 0
+        self.total = 0
+        self.current = 0
+        self.batches = 0
+        self.last_run_at: Optional[float] = None
+        self.last_duration = 0.0
+        self.last_rate = 0.0
+        self.last_error: Optional[str] = None
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "leader_only": self.leader_only,
+            "interval": self.interval,
+            "running": self.running,
+            "runs": self.runs,
+            "total": self.total,
+            "current": self.current,
+            "batches": self.batches,
+            "last_run_at": datetime.utcfromtimestamp(self.last_run_at).isoformat() if self.last_run_at else None,
+            "last_duration": round(self.last_duration, 2),
+            "last_rate": round(self.last_rate, 1),
+            "last_error": self.last_error,
+        }
+
+
+class MaintenanceScheduler:
+    """按批、限速执行维护任务"""
+
+    def __init__(self):
+        self._tasks: Dict[str, MaintenanceTask] = {}
+        self._local_tasks: Dict[str, asyncio.Task] = {}
+
+    def add_task(self, name: str, run: Callable[[int], AsyncIterator[int]], interval: float,
+                 leader_only: bool = True, batch_size: Optional[int] = None) -> None:
+        """
+        注册维护任务（需在 start 之前注册）
+
+        Args:
+            run: async def run(batch_size)，异步生成器，每处理完一批 yield 本批数量
+            interval: 两次运行之间的间隔（秒）
+            leader_only: 是否只在主 worker 上运行
+            batch_size: 每批数量，默认 maintenance_batch_size
+        """
+        self._tasks[name] = MaintenanceTask(name, run, interval, leader_only, batch_size)
+
+    def _pause_after(self, elapsed: float) -> float:
+        duty = min(max(settings.maintenance_duty_cycle, 0.01), 1.0)
+        return max(settings.maintenance_batch_pause, elapsed * (1 - duty) / duty)
+
+    async def run_once(self, task: MaintenanceTask) -> int:
+        """执行一次任务（所有批次），返回处理数量"""
+        batch_size = task.batch_size or settings.maintenance_batch_size
+        task.running = True
+        task.current = 0
+        task.last_error = None
+        start = time.perf_counter()
+        work_time = 0.0
+        batches = task.run(batch_size)
+        try:
+            while True:
+                batch_start = time.perf_counter()
+                try:
+                    count = await batches.__anext__()
+                except StopAsyncIteration:
+                    break
+                elapsed = time.perf_counter() - batch_start
+                work_time += elapsed
+                task.current += count
+                task.batches += 1
+                if count >= batch_size:
+                    # 还有积压：按占空比暂停后再处理下一批
+                    await asyncio.sleep(self._pause_after(elapsed))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            task.last_error = str(e)
+            print(f"[Maintenance] ⚠️ {task.name} 失败（已处理 {task.current}）: {e}", flush=True)
+        finally:
+            await batches.aclose()
+            task.running = False
+            task.runs += 1
+            task.total += task.current
+            task.last_run_at = time.time()
+            task.last_duration = time.perf_counter() - start
+            task.last_rate = task.current / work_time if work_time > 0 else 0.0
+
+        if task.current:
+            print(
+                f"[Maintenance] 🗑️ {task.name}: 清理 {task.current} 条，用时 {task.last_duration:.1f}s"
+                f"（{task.last_rate:.0f} 条/秒）",
+                flush=True,
+            )
+        return task.current
+
+    async def _run_forever(self, task: MaintenanceTask) -> None:
+        while True:
+            await self.run_once(task)
+            await asyncio.sleep(task.interval)
+
+    def start(self) -> None:
+        """启动任务：leader_only 的任务交给选主（需在 leader.start 之前调用），其他任务立即在本 worker 上运行"""
+        from app.services.leader import leader
+
+        for name, task in self._tasks.items():
+            if task.leader_only:
+                leader.add_job(name, lambda task=task: self._run_forever(task))
+            elif name not in self._local_tasks or self._local_tasks[name].done():
+                self._local_tasks[name] = asyncio.create_task(self._run_forever(task))
+
+    async def stop(self) -> None:
+        """停止本 worker 上的任务（leader_only 的任务由 leader.stop 停止）"""
+        tasks = list(self._local_tasks.values())
+        self._local_tasks.clear()
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "batch_size": settings.maintenance_batch_size,
+            "batch_pause": settings.maintenance_batch_pause,
+            "duty_cycle": settings.maintenance_duty_cycle,
+            "tasks": {name: task.get_status() for name, task in self._tasks.items()},
+        }
+
+
+async def expired_log_batches(batch_size: int) -> AsyncIterator[int]:
+    """删除超过 log_retention_days 的使用日志，每批一个小事务（通过写队列）"""
+    from sqlalchemy import delete, select
+    from app.database import db_writer
+    from app.models.user import UsageLog
+
+    retention_days = settings.log_retention_days
+    if retention_days <= 0:
+        return
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    async def delete_batch(session):
+        ids = select(UsageLog.id).where(UsageLog.created_at < cutoff).limit(batch_size).scalar_subquery()
+        result = await session.execute(
+            delete(UsageLog).where(UsageLog.id.in_(ids)).execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    while True:
+        deleted = await db_writer.run(delete_batch)
+        yield deleted
+        if deleted < batch_size:
+            return
+
+
+# 全局维护任务调度器
+maintenance = MaintenanceScheduler()
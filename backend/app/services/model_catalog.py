@@ -0,0 +1,230 @@
+"""
+GeminiCLI 模型目录缓存（/v1/models 与 /v1beta/models）
+
+原实现每次请求都要执行多次凭证计数查询，可能选取 Antigravity 凭证请求上游，
+并重新生成大量后缀变体（-maxthinking / -nothinking / -search 及前缀组合）。
+这里分两层缓存：
+- 用户权益:  (有 CLI 凭证, 可用 3.0 CLI 凭证, Antigravity 凭证池范围)，按用户缓存
+- 模型目录:  按权益只生成一次，序列化后的 JSON 和 ETag 一起缓存（LRU，有条目数上限）；
+             Antigravity 部分复用 antigravity_models 按凭证池范围缓存的列表，该列表刷新后重新生成
+失效:
+- 池模式变化: 是权益缓存的一部分；Antigravity 开关每次请求都检查
+- 凭证增删改（含批量 update/delete）: 通过 SQLAlchemy 会话事件递增版本号，权益缓存全部失效
+- 兜底: 权益缓存有 TTL（其他 worker 的改动最多延迟该时间）
+响应带 ETag，客户端携带 If-None-Match 时未变化直接返回 304。
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Request, Response
+from sqlalchemy import event, select, func, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+
+# 用户权益缓存时间（秒）
+ENTITLEMENT_TTL = 300
+# 最多缓存的模型目录数（Antigravity 凭证池范围为 user:{id} 时每个用户一份）
+MAX_CATALOGS = 1024
+
+# 影响模型目录的凭证字段（只改这些字段才使权益缓存失效，last_used_at 等高频字段不影响）
+_WATCHED_CREDENTIAL_FIELDS = ("user_id", "api_type", "model_tier", "is_public", "is_active", "project_id")
+
+
+class ModelCatalog:
+    """按用户权益缓存的模型目录"""
+
+    def __init__(self):
+        # 凭证变更版本号
+        self.version = 0
+        # user_id -> (版本号, 池模式, 过期时间, 权益)
+        self._entitlements: Dict[int, Tuple[int, str, float, Tuple[bool, bool, Optional[str]]]] = {}
+        # (类型, 权益...) -> (生成时使用的 Antigravity 列表, JSON bytes, ETag)
+        self._catalogs: "OrderedDict[tuple, Tuple[Any, bytes, str]]" = OrderedDict()
+        self._stats = {"entitlement_hits": 0, "entitlement_misses": 0, "builds": 0, "not_modified": 0}
+
+    def invalidate(self) -> None:
+        """凭证变更后调用：所有用户的权益缓存失效"""
+        self.version += 1
+
+    # ---------- 用户权益 ----------
+
+    async def get_entitlement(self, user, db: AsyncSession) -> Tuple[bool, bool, Optional[str]]:
+        """返回 (有 CLI 凭证, 可用 3.0 CLI 凭证, Antigravity 凭证池范围；没有可用的 Antigravity 凭证时为 None)"""
+        from app.models.user import Credential
+        from app.services.credential_pool import CredentialPool
+        from app.services.antigravity_models import get_pool_scope
+
+        pool_mode = settings.credential_pool_mode
+        cached = self._entitlements.get(user.id)
+        if cached and cached[0] == self.version and cached[1] == pool_mode and cached[2] > time.time():
+            self._stats["entitlement_hits"] += 1
+            return cached[3]
+
+        self._stats["entitlement_misses"] += 1
+        version = self.version
+        # 一次查询统计用户可见的 CLI / Antigravity 凭证
+        result = await db.execute(
+            select(Credential.api_type == "antigravity", func.count(Credential.id))
+            .where(Credential.is_active == True)
+            .where(or_(
+                Credential.user_id == user.id,
+                Credential.is_public == True
+            ))
+            .group_by(Credential.api_type == "antigravity")
+        )
+        counts = {bool(is_agy): count for is_agy, count in result.all()}
+        has_cli_creds = counts.get(False, 0) > 0
+        has_agy_creds = counts.get(True, 0) > 0
+        has_cli_tier3 = has_cli_creds and await CredentialPool.has_tier3_credentials(user, db, mode="geminicli")
+        agy_scope = None
+        if has_agy_creds:
+            user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id, mode="antigravity")
+            agy_scope = get_pool_scope(user.id, user_has_public)
+
+        entitlement = (has_cli_creds, has_cli_tier3, agy_scope)
+        self._entitlements[user.id] = (version, pool_mode, time.time() + ENTITLEMENT_TTL, entitlement)
+        return entitlement
+
+    # ---------- 目录生成 ----------
+
+    @staticmethod
+    def _build_openai_models(has_cli_tier3: bool) -> List[Dict[str, Any]]:
+        base_models = ["gemini-2.5-pro", "gemini-2.5-flash"]
+        tier3_models = ["gemini-3-pro-preview", "gemini-3-flash-preview"]
+        thinking_suffixes = ["-maxthinking", "-nothinking"]
+        search_suffix = "-search"
+
+        cli_base_models = base_models.copy()
+        if has_cli_tier3:
+            cli_base_models.extend(tier3_models)
+
+        models = []
+        for base in cli_base_models:
+            # 基础模型
+            models.append({"id": f"gcli-{base}", "object": "model", "owned_by": "google"})
+
+            # thinking 变体
+            for suffix in thinking_suffixes:
+                models.append({"id": f"gcli-{base}{suffix}", "object": "model", "owned_by": "google"})
+
+            # search 变体
+            models.append({"id": f"gcli-{base}{search_suffix}", "object": "model", "owned_by": "google"})
+
+            # thinking + search 组合
+            for suffix in thinking_suffixes:
+                combined = f"{suffix}{search_suffix}"
+                models.append({"id": f"gcli-{base}{combined}", "object": "model", "owned_by": "google"})
+        return models
+
+    @staticmethod
+    def _build_gemini_models(has_tier3: bool) -> List[Dict[str, Any]]:
+        base_models = ["gemini-2.5-pro", "gemini-2.5-flash"]
+        if has_tier3:
+            base_models.append("gemini-3-pro-preview")
+            base_models.append("gemini-3-flash-preview")
+
+        return [
+            {
+                "name": f"models/{base}",
+                "version": "001",
+                "displayName": base,
+                "description": f"Gemini {base} model",
+                "inputTokenLimit": 1000000,
+                "outputTokenLimit": 65536,
+                "supportedGenerationMethods": ["generateContent", "streamGenerateContent"],
+            }
+            for base in base_models
+        ]
+
+    def _get_catalog(self, key: tuple, build, source: Any = None) -> Tuple[bytes, str]:
+        """source 为生成目录所依赖的共享列表，对象变化（被刷新）时重新生成"""
+        catalog = self._catalogs.get(key)
+        if catalog is None or catalog[0] is not source:
+            self._stats["builds"] += 1
+            body = json.dumps(build(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+            catalog = self._catalogs[key] = (source, body, etag)
+            while len(self._catalogs) > MAX_CATALOGS:
+                self._catalogs.popitem(last=False)
+        self._catalogs.move_to_end(key)
+        return catalog[1], catalog[2]
+
+    async def openai_catalog(self, user, db: AsyncSession) -> Tuple[bytes, str]:
+        """/v1/models 目录"""
+        from app.services.antigravity_models import antigravity_model_cache, build_prefixed_model_list
+
+        has_cli_creds, has_cli_tier3, agy_scope = await self.get_entitlement(user, db)
+        agy_models: Optional[List[Dict[str, Any]]] = None
+        if agy_scope and settings.antigravity_enabled:
+            # Antigravity 部分复用 Antigravity 模型列表缓存（按用户可见的凭证池范围，上游获取在那里共享）
+            agy_models = await antigravity_model_cache.get_models(agy_scope, "3")
+
+        key = ("openai", has_cli_creds, has_cli_tier3, agy_scope if agy_models is not None else None)
+
+        def build():
+            models = self._build_openai_models(has_cli_tier3) if has_cli_creds else []
+            if agy_models is not None:
+                models.extend(build_prefixed_model_list(agy_models))
+            return {"object": "list", "data": models}
+
+        return self._get_catalog(key, build, agy_models)
+
+    async def gemini_catalog(self, user, db: AsyncSession) -> Tuple[bytes, str]:
+        """/v1beta/models 目录"""
+        _, has_cli_tier3, _ = await self.get_entitlement(user, db)
+        return self._get_catalog(("gemini", has_cli_tier3), lambda: {"models": self._build_gemini_models(has_cli_tier3)})
+
+    def respond(self, request: Request, catalog: Tuple[bytes, str]) -> Response:
+        """带 ETag 的响应，If-None-Match 匹配时返回 304"""
+        body, etag = catalog
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]):
+            self._stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "users": len(self._entitlements),
+            "catalogs": len(self._catalogs),
+            **self._stats,
+        }
+
+
+# 全局模型目录缓存
+model_catalog = ModelCatalog()
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_on_credential_flush(session, flush_context):
+    """ORM 方式增删改凭证（仅关注影响目录的字段）"""
+    from sqlalchemy import inspect
+    from app.models.user import Credential
+
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Credential):
+            model_catalog.invalidate()
+            return
+    for obj in session.dirty:
+        if isinstance(obj, Credential):
+            state = inspect(obj)
+            if any(state.attrs[field].history.has_changes() for field in _WATCHED_CREDENTIAL_FIELDS):
+                model_catalog.invalidate()
+                return
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _invalidate_on_credential_bulk(orm_execute_state):
+    """批量 update(Credential) / delete(Credential) 语句"""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_.__name__ == "Credential":
+        model_catalog.invalidate()
@@ -6,9 +6,13 @@ OpenAI Transfer Module - Handles conversion between OpenAI and Gemini API format
 import json
 import time
 import uuid
+import hashlib
 import logging
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional, Tuple, Union
 
+from app.services.conversation_cache import conversation_cache
+
 # 尝试导入 pypinyin，如果不存在则使用简单替代
 try:
     from pypinyin import Style, lazy_pinyin
@@ -33,39 +37,6 @@ def decode_tool_id_and_signature(encoded_id: str) -> Tuple[str, str]:
         return parts[0], parts[1]
     return encoded_id, ""
 
-# merge_system_messages 从 utils 导入 (inline 实现)
-async def merge_system_messages(request: Dict[str, Any]) -> Dict[str, Any]:
-    """合并连续的 system 消息到第一个 system 消息"""
-    messages = request.get("messages", [])
-    if not messages:
-        return request
-    
-    merged_messages = []
-    current_system = None
-    
-    for msg in messages:
-        if msg.get("role") == "system":
-            if current_system is None:
-                current_system = dict(msg)
-            else:
-                # 合并到当前 system 消息
-                existing_content = current_system.get("content", "")
-                new_content = msg.get("content", "")
-                if isinstance(existing_content, str) and isinstance(new_content, str):
-                    current_system["content"] = existing_content + "\n" + new_content
-        else:
-            if current_system is not None:
-                merged_messages.append(current_system)
-                current_system = None
-            merged_messages.append(msg)
-    
-    if current_system is not None:
-        merged_messages.append(current_system)
-    
-    request["messages"] = merged_messages
-    return request
-
-
 def _convert_usage_metadata(usage_metadata: Dict[str, Any]) -> Dict[str, int]:
     """
     将Gemini的usageMetadata转换为OpenAI格式的usage字段
@@ -646,6 +617,96 @@ def fix_tool_call_args_types(
     return fixed_args
 
 
+# ==================== Tool Declaration Cache ====================
+# Agent 类客户端每一轮都会携带同一份 tools，按 (函数定义, 模型家族) 的稳定哈希缓存清理后的
+# function declaration。缓存的声明对象在请求之间共享，下游只做序列化，不得原地修改。
+
+TOOL_DECLARATION_CACHE_SIZE = 1024  # 最多缓存的函数声明数量（LRU 淘汰）
+
+_tool_declaration_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_tool_declaration_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _tool_declaration_cache_key(function: Dict[str, Any], is_claude_model: bool) -> Optional[str]:
+    """计算函数定义的稳定哈希（键顺序无关），无法序列化时返回 None（不缓存）"""
+    try:
+        raw = json.dumps(function, sort_keys=True, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return None
+    family = "claude" if is_claude_model else "gemini"
+    return hashlib.sha1(f"{family}\0{raw}".encode("utf-8")).hexdigest()
+
+
+def get_tool_declaration_cache_stats() -> Dict[str, Any]:
+    """工具声明缓存的命中统计"""
+    hits = _tool_declaration_cache_stats["hits"]
+    misses = _tool_declaration_cache_stats["misses"]
+    total = hits + misses
+    return {
+        "size": len(_tool_declaration_cache),
+        "max_size": TOOL_DECLARATION_CACHE_SIZE,
+        "hits": hits,
+        "misses": misses,
+        "evictions": _tool_declaration_cache_stats["evictions"],
+        "hit_rate": round(hits / total, 4) if total else 0.0,
+    }
+
+
+def _build_function_declaration(function: Dict[str, Any], is_claude_model: bool) -> Dict[str, Any]:
+    """将单个 OpenAI function 定义转换为 Gemini function declaration（规范化名称 + 清理 schema）"""
+    # 获取并规范化函数名
+    original_name = function.get("name")
+    if not original_name:
+        log.warning("Tool missing 'name' field, using default")
+        original_name = "_unnamed_function"
+
+    normalized_name = _normalize_function_name(original_name)
+
+    # 如果名称被修改了，记录日志
+    if normalized_name != original_name:
+        log.debug(f"Function name normalized: '{original_name}' -> '{normalized_name}'")
+
+    # 构建 Gemini function declaration
+    declaration = {
+        "name": normalized_name,
+        "description": function.get("description", ""),
+    }
+
+    # 添加参数（如果有）- 根据模型选择不同的清理函数
+    if "parameters" in function:
+        if is_claude_model:
+            cleaned_params = _clean_schema_for_claude(function["parameters"])
+            log.debug(f"[OPENAI2GEMINI] Using Claude schema cleaning for tool: {normalized_name}")
+        else:
+            cleaned_params = _clean_schema_for_gemini(function["parameters"])
+
+        if cleaned_params:
+            declaration["parameters"] = cleaned_params
+
+    return declaration
+
+
+def _get_function_declaration(function: Dict[str, Any], is_claude_model: bool) -> Dict[str, Any]:
+    """带 LRU 缓存的 _build_function_declaration"""
+    key = _tool_declaration_cache_key(function, is_claude_model)
+    if key is None:
+        return _build_function_declaration(function, is_claude_model)
+
+    cached = _tool_declaration_cache.get(key)
+    if cached is not None:
+        _tool_declaration_cache.move_to_end(key)
+        _tool_declaration_cache_stats["hits"] += 1
+        return cached
+
+    _tool_declaration_cache_stats["misses"] += 1
+    declaration = _build_function_declaration(function, is_claude_model)
+    _tool_declaration_cache[key] = declaration
+    if len(_tool_declaration_cache) > TOOL_DECLARATION_CACHE_SIZE:
+        _tool_declaration_cache.popitem(last=False)
+        _tool_declaration_cache_stats["evictions"] += 1
+    return declaration
+
+
 def convert_openai_tools_to_gemini(openai_tools: List, model: str = "") -> List[Dict[str, Any]]:
     """
     将 OpenAI tools 格式转换为 Gemini functionDeclarations 格式
@@ -675,35 +736,8 @@ def convert_openai_tools_to_gemini(openai_tools: List, model: str = "") -> List[
             log.warning("Tool missing 'function' field")
             continue
 
-        # 获取并规范化函数名
-        original_name = function.get("name")
-        if not original_name:
-            log.warning("Tool missing 'name' field, using default")
-            original_name = "_unnamed_function"
-
-        normalized_name = _normalize_function_name(original_name)
-
-        # 如果名称被修改了，记录日志
-        if normalized_name != original_name:
-            log.debug(f"Function name normalized: '{original_name}' -> '{normalized_name}'")
-
-        # 构建 Gemini function declaration
-        declaration = {
-            "name": normalized_name,
-            "description": function.get("description", ""),
-        }
-
-        # 添加参数（如果有）- 根据模型选择不同的清理函数
-        if "parameters" in function:
-            if is_claude_model:
-                cleaned_params = _clean_schema_for_claude(function["parameters"])
-                log.debug(f"[OPENAI2GEMINI] Using Claude schema cleaning for tool: {normalized_name}")
-            else:
-                cleaned_params = _clean_schema_for_gemini(function["parameters"])
-
-            if cleaned_params:
-                declaration["parameters"] = cleaned_params
-
+        # 规范化名称、清理 schema（相同定义命中缓存）
+        declaration = _get_function_declaration(function, is_claude_model)
         function_declarations.append(declaration)
 
     if not function_declarations:
@@ -957,7 +991,220 @@ def extract_images_from_content(content: Any) -> Dict[str, Any]:
 
     return result
 
-async def convert_openai_to_gemini_request(openai_request: Dict[str, Any]) -> Dict[str, Any]:
+def _convert_image_url(image_url: Any) -> Optional[Dict[str, Any]]:
+    """image_url -> inlineData（data URL）或 fileData（普通 URL），无法解析返回 None"""
+    url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
+    if not url or not isinstance(url, str):
+        return None
+    if not url.startswith("data:"):
+        return {"fileData": {"mimeType": "image/jpeg", "fileUri": url}}
+    # 格式: data:image/jpeg;base64,/9j/4AAQ...（只切分一次，不复制 base64 数据之外的内容）
+    header, sep, base64_data = url.partition(",")
+    if not sep:
+        log.warning("Invalid image data URL: missing ',' separator")
+        return None
+    mime_type = header[5:].split(";", 1)[0] or "image/jpeg"
+    return {"inlineData": {"mimeType": mime_type, "data": base64_data}}
+
+
+def _convert_content_parts(content: Any) -> List[Dict[str, Any]]:
+    """转换 content（字符串或多模态列表）为 Gemini parts"""
+    if isinstance(content, str):
+        return [{"text": content}] if content else []
+    if not isinstance(content, list):
+        return []
+
+    parts = []
+    for item in content:
+        if isinstance(item, str):
+            parts.append({"text": item})
+            continue
+        if not isinstance(item, dict):
+            continue
+        item_type = item.get("type")
+        # OpenAI 格式: {"type": "text", "text": "..."} / {"type": "image_url", "image_url": {...}}
+        if item_type == "text":
+            parts.append({"text": item.get("text", "")})
+        elif item_type == "image_url":
+            part = _convert_image_url(item.get("image_url", {}))
+            if part:
+                parts.append(part)
+        # Gemini 原生格式: {"text": "..."} 或 {"inlineData": {...}} 或 {"fileData": {...}}
+        elif "text" in item and "type" not in item:
+            parts.append({"text": item["text"]})
+        elif "inlineData" in item:
+            parts.append({"inlineData": item["inlineData"]})
+        elif "fileData" in item:
+            parts.append({"fileData": item["fileData"]})
+        else:
+            log.warning(f"Unknown content part format: {list(item.keys())}")
+    return parts
+
+
+def _system_texts(content: Any) -> Tuple[str, ...]:
+    """提取 system 消息中的文本"""
+    if isinstance(content, str):
+        return (content,)
+    if isinstance(content, list):
+        return tuple(
+            item if isinstance(item, str) else item.get("text", "")
+            for item in content
+            if isinstance(item, str) or (isinstance(item, dict) and item.get("type") == "text")
+        )
+    return ()
+
+
+class _MessageConverter:
+    """逐条转换 OpenAI 消息（单趟：system 文本、工具调用/结果、图片在同一次遍历中处理）
+
+    convert 的结果为 (system_texts, contents) 两个元组，可被对话转换缓存共享。
+    """
+
+    def __init__(self, messages: List[Dict[str, Any]], tool_schemas: Dict[str, Any]):
+        self.messages = messages
+        self.tool_schemas = tool_schemas
+        self._tool_call_names: Optional[Dict[str, str]] = None
+
+    def _tool_call_name(self, encoded_id: str) -> str:
+        """tool_call_id -> 函数名；遇到第一条 tool 消息时才建立映射"""
+        if self._tool_call_names is None:
+            self._tool_call_names = {}
+            for msg in self.messages:
+                if msg.get("role") == "assistant" and msg.get("tool_calls"):
+                    for tc in msg["tool_calls"]:
+                        if tc.get("id"):
+                            self._tool_call_names[tc["id"]] = (tc.get("function") or {}).get("name") or ""
+        return self._tool_call_names.get(encoded_id, "")
+
+    def _convert_tool_result(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        tool_call_id = message.get("tool_call_id", "") or ""
+        # 优先使用对应工具调用的函数名，其次是消息自带的 name
+        func_name = self._tool_call_name(tool_call_id) or message.get("name")
+        if not func_name:
+            func_name = "unknown_function"
+            log.warning(f"Tool message missing function name for tool_call_id={tool_call_id}, using default: {func_name}")
+
+        # 使用原始 ID（不带签名）
+        original_id, _ = decode_tool_id_and_signature(tool_call_id)
+
+        content = message.get("content", "")
+        try:
+            response_data = json.loads(content) if isinstance(content, str) else content
+        except (json.JSONDecodeError, TypeError):
+            response_data = {"result": str(content)}
+        # Gemini API 要求 response 必须是对象
+        if not isinstance(response_data, dict):
+            response_data = {"result": response_data}
+
+        return {
+            "role": "user",
+            "parts": [{
+                "functionResponse": {
+                    "id": original_id,
+                    "name": func_name,
+                    "response": response_data
+                }
+            }]
+        }
+
+    def _convert_tool_call(self, tool_call: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            function = tool_call["function"]
+            func_name = function["name"]
+            arguments = function["arguments"]
+            args = json.loads(arguments) if isinstance(arguments, str) else arguments
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            log.error(f"Failed to parse tool call: {e}")
+            return None
+
+        # 根据工具的 schema 修正参数类型
+        if func_name in self.tool_schemas:
+            args = fix_tool_call_args_types(args, self.tool_schemas[func_name])
+
+        # 解码工具ID和thoughtSignature，没有签名时使用占位符以满足 Gemini API 要求
+        original_id, signature = decode_tool_id_and_signature(tool_call.get("id", "") or "")
+        return {
+            "functionCall": {
+                "id": original_id,
+                "name": func_name,
+                "args": args
+            },
+            "thoughtSignature": signature or "skip_thought_signature_validator"
+        }
+
+    def convert(self, message: Dict[str, Any]) -> Tuple[Tuple[str, ...], Tuple[Dict[str, Any], ...]]:
+        role = message.get("role", "user")
+
+        # system / developer 消息并入 systemInstruction
+        if role in ("system", "developer"):
+            return _system_texts(message.get("content", "")), ()
+
+        if role == "tool":
+            return (), (self._convert_tool_result(message),)
+
+        gemini_role = "user" if role == "user" else "model"
+        parts = _convert_content_parts(message.get("content", ""))
+
+        tool_calls = message.get("tool_calls")
+        if tool_calls:
+            for tool_call in tool_calls:
+                part = self._convert_tool_call(tool_call)
+                if part:
+                    parts.append(part)
+
+        if not parts:
+            return (), ()
+        return (), ({"role": gemini_role, "parts": parts},)
+
+
+def convert_messages_to_contents(
+    messages: List[Dict[str, Any]],
+    tool_schemas: Optional[Dict[str, Any]] = None,
+    cache_scope: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    将 OpenAI messages 转换为 Gemini contents 和 systemInstruction（GeminiCLI / Antigravity 共用）
+
+    Args:
+        messages: OpenAI 格式的消息列表
+        tool_schemas: 工具名 -> 参数 schema，用于修正工具调用参数的类型
+        cache_scope: 对话转换缓存的作用域（如 "user:1"），为空则不使用缓存
+
+    Returns:
+        (contents, system_instruction): 所有 system 消息以空行连接为一个 part
+    """
+    tool_schemas = tool_schemas or {}
+    converter = _MessageConverter(messages, tool_schemas)
+
+    contents = []
+    system_texts = []
+    if cache_scope:
+        # 历史消息的转换结果按前缀缓存，只转换新增的尾部消息；
+        # 缓存条目是共享的，外层 dict 复制一份，避免下游（如插入思考块）修改到缓存。
+        # 工具 schema 影响工具调用参数的类型修正，作为缓存上下文参与匹配
+        for texts, message_contents in conversation_cache.convert(cache_scope, messages, converter.convert, tool_schemas):
+            system_texts.extend(texts)
+            contents.extend(dict(content) for content in message_contents)
+    else:
+        for message in messages:
+            texts, message_contents = converter.convert(message)
+            system_texts.extend(texts)
+            contents.extend(message_contents)
+
+    # 如果 contents 为空，添加默认用户消息
+    if not contents:
+        contents.append({"role": "user", "parts": [{"text": "请根据系统指令回答。"}]})
+
+    system_instruction = None
+    if system_texts:
+        system_instruction = {"parts": [{"text": "\n\n".join(system_texts)}]}
+    return contents, system_instruction
+
+
+async def convert_openai_to_gemini_request(
+    openai_request: Dict[str, Any],
+    cache_scope: Optional[str] = None
+) -> Dict[str, Any]:
     """
     将 OpenAI 格式请求体转换为 Gemini 格式请求体
 
@@ -970,6 +1217,7 @@ async def convert_openai_to_gemini_request(openai_request: Dict[str, Any]) -> Di
             - temperature, top_p, max_tokens, stop 等生成参数
             - tools, tool_choice (可选)
             - response_format (可选)
+        cache_scope: 对话转换缓存的作用域（如 "user:1"），为空则不使用缓存
 
     Returns:
         Gemini 格式的请求体字典,包含:
@@ -978,26 +1226,6 @@ async def convert_openai_to_gemini_request(openai_request: Dict[str, Any]) -> Di
             - systemInstruction: 系统指令 (如果有)
             - tools, toolConfig (如果有)
     """
-    # 处理连续的system消息（兼容性模式）
-    openai_request = await merge_system_messages(openai_request)
-
-    contents = []
-
-    # 提取消息列表
-    messages = openai_request.get("messages", [])
-    
-    # 构建 tool_call_id -> (name, original_id, signature) 的映射
-    tool_call_mapping = {}
-    for msg in messages:
-        if msg.get("role") == "assistant" and msg.get("tool_calls"):
-            for tc in msg["tool_calls"]:
-                encoded_id = tc.get("id", "")
-                func_name = tc.get("function", {}).get("name") or ""
-                if encoded_id:
-                    # 解码获取原始ID和签名
-                    original_id, signature = decode_tool_id_and_signature(encoded_id)
-                    tool_call_mapping[encoded_id] = (func_name, original_id, signature)
-    
     # 构建工具名称到参数 schema 的映射（用于类型修正）
     tool_schemas = {}
     if "tools" in openai_request and openai_request["tools"]:
@@ -1008,145 +1236,9 @@ async def convert_openai_to_gemini_request(openai_request: Dict[str, Any]) -> Di
                 if func_name:
                     tool_schemas[func_name] = function.get("parameters", {})
 
-    for message in messages:
-        role = message.get("role", "user")
-        content = message.get("content", "")
-
-        # 处理工具消息（tool role）
-        if role == "tool":
-            tool_call_id = message.get("tool_call_id", "")
-            func_name = message.get("name")
-
-            # 使用映射表查找
-            if tool_call_id in tool_call_mapping:
-                func_name, original_id, _ = tool_call_mapping[tool_call_id]
-            else:
-                # 如果没有name,尝试从消息列表中查找
-                if not func_name and tool_call_id:
-                    for msg in messages:
-                        if msg.get("role") == "assistant" and msg.get("tool_calls"):
-                            for tc in msg["tool_calls"]:
-                                if tc.get("id") == tool_call_id:
-                                    func_name = tc.get("function", {}).get("name")
-                                    break
-                            if func_name:
-                                break
-
-                # 解码 tool_call_id 获取原始 ID
-                original_id, _ = decode_tool_id_and_signature(tool_call_id)
-
-            # 最终兜底：确保 func_name 不为空
-            if not func_name:
-                func_name = "unknown_function"
-                log.warning(f"Tool message missing function name for tool_call_id={tool_call_id}, using default: {func_name}")
-
-            # 解析响应数据
-            try:
-                response_data = json.loads(content) if isinstance(content, str) else content
-            except (json.JSONDecodeError, TypeError):
-                response_data = {"result": str(content)}
-
-            # 确保 response_data 是字典类型（Gemini API 要求 response 必须是对象）
-            if not isinstance(response_data, dict):
-                response_data = {"result": response_data}
-
-            # 使用原始 ID（不带签名）
-            contents.append({
-                "role": "user",
-                "parts": [{
-                    "functionResponse": {
-                        "id": original_id,
-                        "name": func_name,
-                        "response": response_data
-                    }
-                }]
-            })
-            continue
-
-        # system 消息已经由 merge_system_messages 处理，这里跳过
-        if role == "system":
-            continue
-
-        # 将OpenAI角色映射到Gemini角色
-        if role == "assistant":
-            role = "model"
-
-        # 检查是否有tool_calls
-        tool_calls = message.get("tool_calls")
-        if tool_calls:
-            parts = []
-
-            # 如果有文本内容,先添加文本
-            if content:
-                parts.append({"text": content})
-
-            # 添加每个工具调用
-            for tool_call in tool_calls:
-                try:
-                    args = (
-                        json.loads(tool_call["function"]["arguments"])
-                        if isinstance(tool_call["function"]["arguments"], str)
-                        else tool_call["function"]["arguments"]
-                    )
-                    
-                    # 根据工具的 schema 修正参数类型
-                    func_name = tool_call["function"]["name"]
-                    if func_name in tool_schemas:
-                        args = fix_tool_call_args_types(args, tool_schemas[func_name])
-
-                    # 解码工具ID和thoughtSignature
-                    encoded_id = tool_call.get("id", "")
-                    original_id, signature = decode_tool_id_and_signature(encoded_id)
-
-                    # 构建functionCall part
-                    function_call_part = {
-                        "functionCall": {
-                            "id": original_id,
-                            "name": func_name,
-                            "args": args
-                        }
-                    }
-
-                    # 如果有thoughtSignature则添加，否则使用占位符以满足 Gemini API 要求
-                    if signature:
-                        function_call_part["thoughtSignature"] = signature
-                    else:
-                        function_call_part["thoughtSignature"] = "skip_thought_signature_validator"
-
-                    parts.append(function_call_part)
-                except (json.JSONDecodeError, KeyError) as e:
-                    log.error(f"Failed to parse tool call: {e}")
-                    continue
-
-            if parts:
-                contents.append({"role": role, "parts": parts})
-            continue
-
-        # 处理普通内容
-        if isinstance(content, list):
-            parts = []
-            for part in content:
-                if part.get("type") == "text":
-                    parts.append({"text": part.get("text", "")})
-                elif part.get("type") == "image_url":
-                    image_url = part.get("image_url", {}).get("url")
-                    if image_url:
-                        try:
-                            mime_type, base64_data = image_url.split(";")
-                            _, mime_type = mime_type.split(":")
-                            _, base64_data = base64_data.split(",")
-                            parts.append({
-                                "inlineData": {
-                                    "mimeType": mime_type,
-                                    "data": base64_data,
-                                }
-                            })
-                        except ValueError:
-                            continue
-            if parts:
-                contents.append({"role": role, "parts": parts})
-        elif content:
-            contents.append({"role": role, "parts": [{"text": content}]})
+    contents, system_instruction = convert_messages_to_contents(
+        openai_request.get("messages", []), tool_schemas, cache_scope
+    )
 
     # 构建生成配置
     generation_config = {}
@@ -1194,19 +1286,14 @@ async def convert_openai_to_gemini_request(openai_request: Dict[str, Any]) -> Di
             # Text 模式
             generation_config["responseMimeType"] = "text/plain"
             
-    # 如果contents为空,添加默认用户消息
-    if not contents:
-        contents.append({"role": "user", "parts": [{"text": "请根据系统指令回答。"}]})
-
     # 构建基础请求
     gemini_request = {
         "contents": contents,
         "generationConfig": generation_config
     }
 
-    # 如果 merge_system_messages 已经添加了 systemInstruction，使用它
-    if "systemInstruction" in openai_request:
-        gemini_request["systemInstruction"] = openai_request["systemInstruction"]
+    if system_instruction:
+        gemini_request["systemInstruction"] = system_instruction
 
     # 处理工具 - 传递 model 参数以便根据模型类型选择清理策略
     model = openai_request.get("model", "")
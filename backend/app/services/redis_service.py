@@ -1,12 +1,13 @@
-from typing import Optional, Any
+from typing import Optional, Any, Callable, Dict, List
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import time
+from collections import deque
 from app.config import settings
 
 # 尝试导入 redis，如果失败则使用内存缓存作为备选
 redis = None
 try:
-    import redis as redis_module
+    import redis.asyncio as redis_module
     redis = redis_module
     print("✅ 成功导入 redis 模块")
 except ImportError as e:
@@ -14,13 +15,60 @@ except ImportError as e:
     print("   将使用内存缓存作为备选")
 
 
+async def _aclose(obj) -> None:
+    """关闭 redis.asyncio 对象（新版本为 aclose，旧版本为 close）"""
+    close = getattr(obj, "aclose", None) or getattr(obj, "close")
+    await close()
+
+
+class _CommandStats:
+    """单个命令的耗时统计（最近 512 次用于计算分位数）"""
+    __slots__ = ("count", "errors", "total_ms", "max_ms", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.samples = deque(maxlen=512)
+
+    def record(self, elapsed_ms: float, ok: bool) -> None:
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+        self.samples.append(elapsed_ms)
+
+    def to_dict(self) -> Dict[str, Any]:
+        samples = sorted(self.samples)
+
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 3)
+
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
 class RedisService:
     """
     Redis服务封装类
     支持配置驱动，可通过环境变量控制是否启用
     如果Redis不可用，自动降级为内存缓存
+
+    使用 redis.asyncio 原生异步客户端（连接池大小 redis_max_connections），
+    命令直接在事件循环中执行，不再经过线程池。
     """
-    
+
     def __init__(self):
         # 基本配置
         self.enabled = settings.redis_enabled and redis is not None
@@ -28,28 +76,52 @@ class RedisService:
         self.redis_password = settings.redis_password
         self.redis_db = settings.redis_db
         self.key_prefix = settings.redis_key_prefix
-        
+        self.max_connections = settings.redis_max_connections
+
         # Redis 集群配置
         self.redis_cluster = settings.redis_cluster
         self.redis_cluster_nodes = settings.redis_cluster_nodes
-        
+
         # Redis客户端和连接状态
         self.client = None
         self.connected = False
-        
-        # 线程池，用于执行同步Redis操作
-        self.executor = ThreadPoolExecutor(max_workers=4)
-        
+        # 订阅用的客户端（集群模式下连接第一个节点，PUBLISH 会广播到集群所有节点）
+        self.pubsub_client = None
+
         # 内存缓存作为备选
         self.memory_cache = {}
         self.memory_expires = {}
-    
+        self._memory_sweep_at = 1024
+
+        # 发布/订阅：订阅任务在关闭时退出
+        self._closing = False
+        self._subscriber_tasks: List[asyncio.Task] = []
+
+        # 命令耗时统计
+        self._command_stats: Dict[str, _CommandStats] = {}
+
     def _get_key(self, key: str) -> str:
         """
         获取带前缀的完整键名
         """
         return f"{self.key_prefix}{key}"
-    
+
+    def _from_url(self, url: str):
+        """
+        创建单机客户端
+        使用阻塞式连接池：连接用完时等待空闲连接（最多 redis_pool_timeout 秒），而不是直接报错
+        """
+        pool = redis.BlockingConnectionPool.from_url(
+            url,
+            password=self.redis_password or None,
+            db=self.redis_db,
+            encoding="utf-8",
+            decode_responses=True,
+            max_connections=self.max_connections,
+            timeout=settings.redis_pool_timeout,
+        )
+        return redis.Redis(connection_pool=pool)
+
     async def init_redis(self):
         """
         初始化Redis连接
@@ -60,89 +132,70 @@ class RedisService:
         print(f"   数据库: {self.redis_db}")
         print(f"   集群模式: {self.redis_cluster}")
         print(f"   集群节点: {self.redis_cluster_nodes}")
-        
+        print(f"   连接池大小: {self.max_connections}")
+
         if not self.enabled:
             print("⏭️ Redis已禁用，将使用内存缓存")
             self.connected = False
             return False
-        
+
         try:
             print("   正在连接Redis...")
-            
+
             if self.redis_cluster:
                 # Redis集群模式
                 print("   正在创建Redis集群客户端...")
-                
+
                 try:
-                    from redis.cluster import RedisCluster
-                    
+                    from redis.asyncio.cluster import RedisCluster
+                    import urllib.parse
+
                     # 从URL解析集群节点
                     if not self.redis_cluster_nodes:
                         # 从主节点URL创建基本节点列表
-                        import urllib.parse
                         parsed_url = urllib.parse.urlparse(self.redis_url)
                         self.redis_cluster_nodes = [
                             f"redis://{parsed_url.hostname}:{parsed_url.port or 6379}"
                         ]
                         print(f"   自动生成集群节点: {self.redis_cluster_nodes}")
-                    
+
                     # 解析第一个节点的主机和端口
-                    import urllib.parse
                     parsed_node = urllib.parse.urlparse(self.redis_cluster_nodes[0])
                     host = parsed_node.hostname
                     port = parsed_node.port or 6379
-                    
-                    # 创建Redis集群客户端（使用更兼容的方式）
+
                     self.client = RedisCluster(
                         host=host,
                         port=port,
-                        password=self.redis_password,
+                        password=self.redis_password or None,
                         encoding="utf-8",
                         decode_responses=True,
-                        skip_full_coverage_check=True  # 跳过完整覆盖检查，适合一主多从模式
+                        max_connections=self.max_connections,
+                        require_full_coverage=False  # 跳过完整覆盖检查，适合一主多从模式
                     )
-                    print("   ✅ 成功创建RedisCluster客户端")
-                except AttributeError as e:
-                    # 如果from_urls方法不存在，回退到单节点模式
-                    print(f"   ⚠️ RedisCluster.from_urls方法不存在，回退到单节点模式: {e}")
-                    # 创建单节点客户端作为备选
-                    self.client = redis.from_url(
-                        self.redis_url,
-                        password=self.redis_password,
-                        db=self.redis_db,
+                    self.pubsub_client = redis.Redis(
+                        host=host,
+                        port=port,
+                        password=self.redis_password or None,
                         encoding="utf-8",
-                        decode_responses=True
+                        decode_responses=True,
                     )
+                    print("   ✅ 成功创建RedisCluster客户端")
                 except Exception as e:
-                    # 其他错误，回退到单节点模式
+                    # 回退到单节点模式
                     print(f"   ⚠️ 创建RedisCluster客户端失败，回退到单节点模式: {e}")
-                    # 创建单节点客户端作为备选
-                    self.client = redis.from_url(
-                        self.redis_url,
-                        password=self.redis_password,
-                        db=self.redis_db,
-                        encoding="utf-8",
-                        decode_responses=True
-                    )
+                    self.client = self._from_url(self.redis_url)
+                    self.pubsub_client = self.client
             else:
                 # 单机Redis模式
                 print("   正在创建Redis单机客户端...")
-                # 创建Redis客户端
-                self.client = redis.from_url(
-                    self.redis_url,
-                    password=self.redis_password,
-                    db=self.redis_db,
-                    encoding="utf-8",
-                    decode_responses=True
-                )
-            
+                self.client = self._from_url(self.redis_url)
+                self.pubsub_client = self.client
+
             # 测试连接
             print("   正在测试连接...")
-            # 使用线程池执行同步ping操作
-            pong = await asyncio.get_event_loop().run_in_executor(
-                self.executor, self.client.ping
-            )
-            
+            pong = await self.client.ping()
+
             if pong:
                 self.connected = True
                 print(f"✅ Redis连接成功! PONG: {pong}")
@@ -158,106 +211,159 @@ class RedisService:
             traceback.print_exc()
             self.connected = False
             return False
-    
+
     async def close_redis(self):
         """
         关闭Redis连接
         """
-        if self.client and self.connected:
+        self._closing = True
+        for task in self._subscriber_tasks:
+            task.cancel()
+        for task in self._subscriber_tasks:
             try:
-                await asyncio.get_event_loop().run_in_executor(
-                    self.executor, self.client.close
-                )
-                print("✅ Redis连接已关闭")
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._subscriber_tasks.clear()
+
+        if self.client is not None:
+            try:
+                if self.pubsub_client is not None and self.pubsub_client is not self.client:
+                    await _aclose(self.pubsub_client)
+                await _aclose(self.client)
+                pool = getattr(self.client, "connection_pool", None)
+                if pool is not None:
+                    await pool.disconnect()
+                if self.connected:
+                    print("✅ Redis连接已关闭")
             except Exception as e:
                 print(f"⚠️ 关闭Redis连接失败: {e}")
-        
-        # 关闭线程池
-        self.executor.shutdown(wait=True)
-    
+        self.connected = False
+
+    # ---------------------------
+    # 命令耗时统计
+    # ---------------------------
+
+    async def _call(self, command: str, coro):
+        """执行一个 Redis 命令并记录耗时（异常原样抛出，由调用方降级）"""
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await coro
+            ok = True
+            return result
+        finally:
+            stats = self._command_stats.get(command)
+            if stats is None:
+                stats = self._command_stats[command] = _CommandStats()
+            stats.record((time.perf_counter() - start) * 1000, ok)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """连接状态、连接池和各命令耗时统计"""
+        pool = getattr(self.client, "connection_pool", None)
+        return {
+            "backend": "redis" if self.connected else "memory",
+            "cluster": bool(self.redis_cluster and self.connected),
+            "max_connections": self.max_connections,
+            "pool_in_use": len(getattr(pool, "_in_use_connections", ()) or ()) if pool else None,
+            "pool_idle": len(getattr(pool, "_available_connections", ()) or ()) if pool else None,
+            "subscriptions": sum(1 for task in self._subscriber_tasks if not task.done()),
+            "memory_keys": len(self.memory_cache),
+            "commands": {name: stats.to_dict() for name, stats in sorted(self._command_stats.items())},
+        }
+
     # ---------------------------
-    # Redis操作方法 - 支持异步调用
+    # 内存缓存（Redis 不可用时）
     # ---------------------------
-    
+
+    def _memory_get(self, full_key: str) -> Optional[str]:
+        if full_key in self.memory_expires and time.time() > self.memory_expires[full_key]:
+            # 缓存已过期
+            self.memory_cache.pop(full_key, None)
+            del self.memory_expires[full_key]
+            return None
+        return self.memory_cache.get(full_key)
+
+    def _memory_set(self, full_key: str, value: str, expire: Optional[int]) -> None:
+        self.memory_cache[full_key] = value
+        if expire:
+            self.memory_expires[full_key] = time.time() + expire
+        else:
+            self.memory_expires.pop(full_key, None)
+        # 不再被读取的 key（如缓存换代后的旧 key）只能靠定期清扫释放
+        if len(self.memory_cache) > self._memory_sweep_at:
+            self._sweep_memory()
+
+    def _sweep_memory(self) -> None:
+        """清除已过期的内存缓存"""
+        now = time.time()
+        for full_key in [k for k, expires in self.memory_expires.items() if now > expires]:
+            self._memory_delete(full_key)
+        self._memory_sweep_at = max(1024, len(self.memory_cache) * 2)
+
+    def _memory_delete(self, full_key: str) -> None:
+        self.memory_cache.pop(full_key, None)
+        self.memory_expires.pop(full_key, None)
+
+    # ---------------------------
+    # Redis操作方法
+    # ---------------------------
+
     async def get(self, key: str) -> Optional[str]:
         """
         获取Redis缓存值
         如果Redis不可用，使用内存缓存
         """
         full_key = self._get_key(key)
-        
+
         # 如果Redis可用，尝试从Redis获取
         if self.connected:
             try:
-                return await asyncio.get_event_loop().run_in_executor(
-                    self.executor, self.client.get, full_key
-                )
+                return await self._call("get", self.client.get(full_key))
             except Exception as e:
                 print(f"⚠️ Redis get 失败: {e}")
-        
+
         # Redis不可用，使用内存缓存
-        import time
-        current_time = time.time()
-        if full_key in self.memory_expires and current_time > self.memory_expires[full_key]:
-            # 缓存已过期
-            del self.memory_cache[full_key]
-            del self.memory_expires[full_key]
-            return None
-        return self.memory_cache.get(full_key)
-    
+        return self._memory_get(full_key)
+
     async def set(self, key: str, value: str, expire: Optional[int] = None) -> bool:
         """
         设置Redis缓存值
         如果Redis不可用，使用内存缓存
         """
         full_key = self._get_key(key)
-        
+
         # 如果Redis可用，尝试设置到Redis
         if self.connected:
             try:
-                if expire:
-                    await asyncio.get_event_loop().run_in_executor(
-                        self.executor, self.client.setex, full_key, expire, value
-                    )
-                else:
-                    await asyncio.get_event_loop().run_in_executor(
-                        self.executor, self.client.set, full_key, value
-                    )
+                await self._call("set", self.client.set(full_key, value, ex=expire or None))
                 return True
             except Exception as e:
                 print(f"⚠️ Redis set 失败: {e}")
-        
+
         # Redis不可用，使用内存缓存
-        import time
-        self.memory_cache[full_key] = value
-        if expire:
-            self.memory_expires[full_key] = time.time() + expire
+        self._memory_set(full_key, value, expire)
         return True
-    
+
     async def delete(self, key: str) -> bool:
         """
         删除Redis缓存值
         如果Redis不可用，删除内存缓存
         """
         full_key = self._get_key(key)
-        
+
         # 如果Redis可用，尝试从Redis删除
         if self.connected:
             try:
-                await asyncio.get_event_loop().run_in_executor(
-                    self.executor, self.client.delete, full_key
-                )
+                await self._call("delete", self.client.delete(full_key))
                 return True
             except Exception as e:
                 print(f"⚠️ Redis delete 失败: {e}")
-        
+
         # Redis不可用，删除内存缓存
-        if full_key in self.memory_cache:
-            del self.memory_cache[full_key]
-        if full_key in self.memory_expires:
-            del self.memory_expires[full_key]
+        self._memory_delete(full_key)
         return True
-    
+
     async def get_json(self, key: str) -> Optional[Any]:
         """
         获取JSON格式的Redis缓存
@@ -270,7 +376,7 @@ class RedisService:
             except json.JSONDecodeError:
                 return None
         return None
-    
+
     async def set_json(self, key: str, value: Any, expire: Optional[int] = None) -> bool:
         """
         设置JSON格式的Redis缓存
@@ -278,31 +384,189 @@ class RedisService:
         import json
         json_value = json.dumps(value, ensure_ascii=False)
         return await self.set(key, json_value, expire)
-    
+
     async def exists(self, key: str) -> bool:
         """
         检查键是否存在
         """
         full_key = self._get_key(key)
-        
+
         # 如果Redis可用，尝试从Redis检查
         if self.connected:
             try:
-                return await asyncio.get_event_loop().run_in_executor(
-                    self.executor, self.client.exists, full_key
-                ) > 0
+                return await self._call("exists", self.client.exists(full_key)) > 0
             except Exception as e:
                 print(f"⚠️ Redis exists 失败: {e}")
-        
+
         # Redis不可用，检查内存缓存
-        import time
-        current_time = time.time()
-        if full_key in self.memory_expires and current_time > self.memory_expires[full_key]:
-            # 缓存已过期
-            del self.memory_cache[full_key]
-            del self.memory_expires[full_key]
+        return self._memory_get(full_key) is not None
+
+    async def incr(self, key: str) -> int:
+        """
+        计数器加 1（原子操作），返回加 1 后的值
+        如果Redis不可用，使用内存计数
+        """
+        full_key = self._get_key(key)
+
+        if self.connected:
+            try:
+                return int(await self._call("incr", self.client.incr(full_key)))
+            except Exception as e:
+                print(f"⚠️ Redis incr 失败: {e}")
+
+        value = int(self._memory_get(full_key) or 0) + 1
+        self._memory_set(full_key, str(value), None)
+        return value
+
+    # ---------------------------
+    # 批量操作（一次往返）
+    # ---------------------------
+
+    async def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        """
+        批量获取（MGET），返回值与 keys 一一对应，不存在为 None
+        集群模式下按槽位拆分（mget_nonatomic）
+        """
+        if not keys:
+            return []
+        full_keys = [self._get_key(key) for key in keys]
+
+        if self.connected:
+            try:
+                if self.redis_cluster and hasattr(self.client, "mget_nonatomic"):
+                    return await self._call("mget", self.client.mget_nonatomic(full_keys))
+                return await self._call("mget", self.client.mget(full_keys))
+            except Exception as e:
+                print(f"⚠️ Redis mget 失败: {e}")
+
+        return [self._memory_get(full_key) for full_key in full_keys]
+
+    async def set_many(self, mapping: Dict[str, str], expire: Optional[int] = None) -> bool:
+        """批量设置（pipeline，一次往返），expire 对所有键生效"""
+        if not mapping:
+            return True
+
+        if self.connected:
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for key, value in mapping.items():
+                    pipe.set(self._get_key(key), value, ex=expire or None)
+                await self._call("pipeline", pipe.execute())
+                return True
+            except Exception as e:
+                print(f"⚠️ Redis pipeline set 失败: {e}")
+
+        for key, value in mapping.items():
+            self._memory_set(self._get_key(key), value, expire)
+        return True
+
+    async def delete_many(self, keys: List[str]) -> bool:
+        """批量删除（pipeline，一次往返；集群模式下各键可能在不同槽位，不用多键 DEL）"""
+        if not keys:
+            return True
+
+        if self.connected:
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.delete(self._get_key(key))
+                await self._call("pipeline", pipe.execute())
+                return True
+            except Exception as e:
+                print(f"⚠️ Redis pipeline delete 失败: {e}")
+
+        for key in keys:
+            self._memory_delete(self._get_key(key))
+        return True
+
+    # ---------------------------
+    # 分布式锁（多 worker 选主）
+    # ---------------------------
+
+    # 只有持有者才能续期/释放
+    _RENEW_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end"
+    _RELEASE_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    async def acquire_lock(self, name: str, owner: str, ttl: int) -> bool:
+        """
+        获取或续期锁（已持有时续期），返回是否持有
+        Redis 不可用时抛出异常，由调用方改用其他方式
+        """
+        key = self._get_key(f"lock:{name}")
+        if await self._call("set", self.client.set(key, owner, nx=True, ex=ttl)):
+            return True
+        return bool(await self._call("eval", self.client.eval(self._RENEW_LOCK_SCRIPT, 1, key, owner, ttl)))
+
+    async def release_lock(self, name: str, owner: str) -> bool:
+        """释放锁（只释放自己持有的）"""
+        if not self.connected:
             return False
-        return full_key in self.memory_cache
+        try:
+            return bool(await self._call(
+                "eval", self.client.eval(self._RELEASE_LOCK_SCRIPT, 1, self._get_key(f"lock:{name}"), owner)
+            ))
+        except Exception as e:
+            print(f"⚠️ Redis 释放锁失败: {e}")
+            return False
+
+    # ---------------------------
+    # 发布/订阅（多 worker 之间广播事件）
+    # ---------------------------
+
+    async def publish(self, channel: str, message: str) -> bool:
+        """
+        发布消息到频道
+        Redis 不可用时返回 False，由调用方在本进程内处理
+        """
+        if not self.connected:
+            return False
+        try:
+            await self._call("publish", self.client.publish(self._get_key(channel), message))
+            return True
+        except Exception as e:
+            print(f"⚠️ Redis publish 失败: {e}")
+            return False
+
+    async def _listen(self, channel: str, callback: Callable[[str], None]) -> None:
+        """订阅任务：收到消息后调用 callback(消息)，连接断开时 3 秒后重连"""
+        full_channel = self._get_key(channel)
+        while not self._closing:
+            pubsub = None
+            try:
+                pubsub = self.pubsub_client.pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(full_channel)
+                while not self._closing:
+                    # 带超时读取，以便关闭时及时退出
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message and message.get("type") == "message":
+                        try:
+                            callback(message["data"])
+                        except Exception as e:
+                            print(f"⚠️ Redis 订阅 {channel} 处理消息失败: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._closing:
+                    break
+                print(f"⚠️ Redis 订阅 {channel} 断开，3 秒后重连: {e}")
+                await asyncio.sleep(3)
+            finally:
+                if pubsub is not None:
+                    try:
+                        await _aclose(pubsub)
+                    except Exception:
+                        pass
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> bool:
+        """
+        订阅频道：在后台任务中读取，收到消息后在事件循环中调用 callback(消息)
+        连接断开时自动重连；Redis 不可用时返回 False
+        """
+        if not self.connected:
+            return False
+        self._subscriber_tasks.append(asyncio.create_task(self._listen(channel, callback)))
+        print(f"✅ 已订阅 Redis 频道: {self._get_key(channel)}")
+        return True
 
 
 # 创建全局Redis服务实例
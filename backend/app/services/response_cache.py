@@ -0,0 +1,321 @@
+"""
+响应缓存（可选开启）
+
+评测、分类等批量任务常以 temperature=0 重复发送完全相同的请求，每次都会占用凭证和上游配额。
+开启后，相同请求直接返回缓存的结果：
+- 开启方式: API Key 的 response_cache 开关（只缓存确定性请求：temperature=0 且只生成一个候选），
+            或请求头 X-Response-Cache: on（单次明确开启，不看 temperature；off 可单次关闭）
+- 多候选（n / candidateCount > 1）的请求不缓存
+- 缓存键:   用户 + 接口类型 + 模型 + 转换后的请求（contents / generationConfig / systemInstruction / tools）的规范化哈希
+- 存储:     Redis 已连接时存 Redis（多 worker 共享），否则存进程内存（LRU + 条目数上限）；均有 TTL
+- 命中:     非流式直接返回 JSON，流式以合成的 SSE 回放；不选取凭证、不触发 CD，日志标记 cache_hit，
+            cache_hit 的日志不计入 RPM 和每日配额
+只缓存正常结束（finish_reason=stop / tool_calls）的结果，流式和非流式一致；截断、报错的结果不缓存。
+"""
+import hashlib
+import json
+import time
+from datetime import datetime
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.services.redis_service import redis_service
+from app.utils.usage import extract_usage, usage_to_log_tokens
+
+RESPONSE_CACHE_HEADER = "X-Response-Cache"
+
+# 可缓存的结束原因（流式和非流式共用）
+CACHEABLE_FINISH_REASONS = ("stop", "tool_calls")
+
+# API Key 开关的进程内缓存时间（秒），避免每个请求都查一次数据库
+KEY_FLAG_TTL = 60
+
+
+class ResponseCache:
+    """响应缓存存储：Redis 优先，不可用时使用有界的内存 LRU"""
+
+    def __init__(self):
+        # key -> (过期时间, JSON 字符串)
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # api_key -> (是否开启, 过期时间)
+        self._key_flags: Dict[str, Tuple[bool, float]] = {}
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "skipped_large": 0, "evictions": 0}
+
+    # ---------- 开启判断 ----------
+
+    async def is_enabled(self, request: Request, db: AsyncSession,
+                         temperature: Any = None, candidates: Any = None) -> bool:
+        """
+        请求头优先，其次是 API Key 的开关
+
+        Args:
+            temperature: 请求的 temperature（未指定时按上游默认值，视为非确定性）
+            candidates: 请求的候选数（OpenAI n / Gemini candidateCount）
+        """
+        try:
+            if candidates is not None and int(candidates) > 1:
+                return False
+        except (TypeError, ValueError):
+            return False
+
+        header = request.headers.get(RESPONSE_CACHE_HEADER, "").strip().lower()
+        if header in ("1", "true", "on", "yes"):
+            return True
+        if header in ("0", "false", "off", "no"):
+            return False
+
+        # API Key 开关只对确定性请求生效：采样的结果每次不同，缓存会让客户端反复拿到同一个回答
+        try:
+            if temperature is None or float(temperature) != 0:
+                return False
+        except (TypeError, ValueError):
+            return False
+
+        api_key = getattr(request.state, "api_key", None)
+        if not api_key:
+            return False
+
+        now = time.time()
+        cached = self._key_flags.get(api_key)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        from app.models.user import APIKey
+        result = await db.execute(select(APIKey.response_cache).where(APIKey.key == api_key))
+        enabled = bool(result.scalar_one_or_none())
+        self._key_flags[api_key] = (enabled, now + KEY_FLAG_TTL)
+        return enabled
+
+    def invalidate_key_flag(self, api_key: str) -> None:
+        """API Key 开关变更后调用（其他 worker 最多延迟 KEY_FLAG_TTL 秒生效）"""
+        self._key_flags.pop(api_key, None)
+
+    # ---------- 缓存键 ----------
+
+    @staticmethod
+    def make_key(user_id: int, api_type: str, model: str, request_body: Dict[str, Any]) -> str:
+        """规范化（键排序、紧凑分隔符）后的请求哈希"""
+        raw = json.dumps(
+            {"user": user_id, "api": api_type, "model": model, "request": request_body},
+            sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def chat_key(self, user_id: int, api_type: str, body: Dict[str, Any]) -> str:
+        """OpenAI 格式请求的缓存键：基于转换后的 Gemini 请求，与客户端格式差异（键顺序、system 合并等）无关"""
+        from app.services.openai2gemini_full import convert_openai_to_gemini_request
+
+        openai_request = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+        gemini_request = await convert_openai_to_gemini_request(openai_request, cache_scope=f"user:{user_id}")
+        return self.make_key(user_id, api_type, body.get("model", ""), gemini_request)
+
+    # ---------- 读写 ----------
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = None
+        if redis_service.connected:
+            value = await redis_service.get(f"resp:{key}")
+        else:
+            entry = self._memory.get(key)
+            if entry:
+                if entry[0] > time.time():
+                    self._memory.move_to_end(key)
+                    value = entry[1]
+                else:
+                    del self._memory[key]
+
+        if value is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        return json.loads(value)
+
+    async def set(self, key: str, response: Dict[str, Any]) -> None:
+        value = json.dumps(response, ensure_ascii=False)
+        if len(value) > settings.response_cache_max_entry_kb * 1024:
+            self._stats["skipped_large"] += 1
+            return
+
+        self._stats["stores"] += 1
+        if redis_service.connected:
+            await redis_service.set(f"resp:{key}", value, expire=settings.response_cache_ttl)
+            return
+
+        self._memory[key] = (time.time() + settings.response_cache_ttl, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > settings.response_cache_max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self._stats["hits"] + self._stats["misses"]
+        return {
+            "backend": "redis" if redis_service.connected else "memory",
+            "memory_size": len(self._memory),
+            "max_entries": settings.response_cache_max_entries,
+            "ttl": settings.response_cache_ttl,
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / total, 4) if total else 0.0,
+        }
+
+
+response_cache = ResponseCache()
+
+
+# ---------- OpenAI 格式结果的判定、收集与回放 ----------
+
+def is_cacheable_openai_response(response: Dict[str, Any]) -> bool:
+    """只缓存正常结束的结果"""
+    choices = response.get("choices") or []
+    return bool(choices) and choices[0].get("finish_reason") in CACHEABLE_FINISH_REASONS
+
+
+def openai_usage_tokens(response: Dict[str, Any]) -> Tuple[int, int]:
+    """缓存结果中的 token 用量（写入命中日志，便于统计）"""
+    usage = response.get("usage") or {}
+    return usage.get("prompt_tokens", 0) or 0, usage.get("completion_tokens", 0) or 0
+
+
+class OpenAIStreamCollector:
+    """收集 OpenAI SSE 分块，流结束后组装为非流式响应用于缓存"""
+
+    def __init__(self):
+        self.content_parts = []
+        self.reasoning_parts = []
+        self.tool_calls = []
+        self.finish_reason = None
+        self.usage = None
+        self.model = None
+        self.cacheable = True
+
+    def feed(self, chunk: str) -> None:
+        if not self.cacheable:
+            return
+        for line in chunk.split("\n"):
+            if not line.startswith("data: ") or line == "data: [DONE]":
+                continue
+            try:
+                data = json.loads(line[6:])
+            except json.JSONDecodeError:
+                continue
+            if "error" in data:
+                self.cacheable = False
+                return
+            self.model = data.get("model", self.model)
+            if data.get("usage"):
+                self.usage = data["usage"]
+            for choice in data.get("choices") or []:
+                delta = choice.get("delta") or {}
+                for tool_call in delta.get("tool_calls") or []:
+                    self._feed_tool_call(tool_call)
+                if delta.get("content"):
+                    self.content_parts.append(delta["content"])
+                if delta.get("reasoning_content"):
+                    self.reasoning_parts.append(delta["reasoning_content"])
+                if choice.get("finish_reason"):
+                    self.finish_reason = choice["finish_reason"]
+
+    def _feed_tool_call(self, tool_call: Dict[str, Any]) -> None:
+        """带 id 的分块是一个新的工具调用，不带 id 的分块是上一个调用的参数续传"""
+        function = tool_call.get("function") or {}
+        if tool_call.get("id") or not self.tool_calls:
+            self.tool_calls.append({
+                "id": tool_call.get("id"),
+                "type": tool_call.get("type", "function"),
+                "function": {"name": function.get("name", ""), "arguments": function.get("arguments") or ""},
+            })
+        else:
+            self.tool_calls[-1]["function"]["arguments"] += function.get("arguments") or ""
+
+    def build(self) -> Optional[Dict[str, Any]]:
+        if not self.cacheable or self.finish_reason not in CACHEABLE_FINISH_REASONS:
+            return None
+        content = "".join(self.content_parts)
+        message = {"role": "assistant", "content": content}
+        if self.tool_calls:
+            message["tool_calls"] = self.tool_calls
+            message["content"] = content or None
+        if self.reasoning_parts:
+            message["reasoning_content"] = "".join(self.reasoning_parts)
+        response = {
+            "id": "chatcmpl-cache",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [{"index": 0, "message": message, "finish_reason": self.finish_reason}],
+        }
+        if self.usage:
+            response["usage"] = self.usage
+        return response
+
+
+async def _replay_openai_stream(response: Dict[str, Any]) -> AsyncGenerator[str, None]:
+    """把缓存的非流式响应回放为 SSE：一个内容分块 + 一个结束分块"""
+    choice = (response.get("choices") or [{}])[0]
+    message = choice.get("message") or {}
+    base = {
+        "id": response.get("id", "chatcmpl-cache"),
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": response.get("model"),
+    }
+
+    delta = {"role": "assistant"}
+    if message.get("reasoning_content"):
+        delta["reasoning_content"] = message["reasoning_content"]
+    if message.get("content"):
+        delta["content"] = message["content"]
+    if message.get("tool_calls"):
+        delta["tool_calls"] = [dict(tc, index=i) for i, tc in enumerate(message["tool_calls"])]
+    yield f"data: {json.dumps({**base, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}, ensure_ascii=False)}\n\n"
+
+    final = {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": choice.get("finish_reason", "stop")}]}
+    if response.get("usage"):
+        final["usage"] = response["usage"]
+    yield f"data: {json.dumps(final, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def replay_openai_response(response: Dict[str, Any], stream: bool):
+    """命中时的响应：非流式 JSON / 流式合成 SSE"""
+    headers = {RESPONSE_CACHE_HEADER: "HIT"}
+    if not stream:
+        return JSONResponse(content=response, headers=headers)
+    return StreamingResponse(
+        _replay_openai_stream(response),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Connection": "keep-alive", **headers}
+    )
+
+
+async def record_cache_hit(db: AsyncSession, log, username: str, model: str, latency: float, response: Dict[str, Any]) -> None:
+    """命中日志：状态 200、无凭证、标记 cache_hit，并推送实时通知"""
+    from app.services.websocket import notify_log_update, notify_stats_update
+
+    log.status_code = 200
+    log.latency_ms = latency
+    log.cache_hit = True
+    if "choices" in response:
+        log.tokens_input, log.tokens_output = openai_usage_tokens(response)
+    else:
+        log.tokens_input, log.tokens_output = usage_to_log_tokens(extract_usage(response))
+    if log.id is None:
+        db.add(log)
+    await db.commit()
+
+    print(f"[ResponseCache] 🎯 命中: user={username}, model={model}, latency={latency:.0f}ms", flush=True)
+    await notify_log_update({
+        "username": username,
+        "model": model,
+        "status_code": 200,
+        "cache_hit": True,
+        "latency_ms": round(latency, 0),
+        "created_at": datetime.utcnow().isoformat()
+    })
+    await notify_stats_update()
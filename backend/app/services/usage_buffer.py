@@ -0,0 +1,128 @@
+"""
+使用计数写缓冲（write-behind）
+
+每次请求都会更新 api_keys.last_used_at 和 credentials.total_requests / last_used_at，
+这些小写入原本各自一次 UPDATE + 提交，占了大部分的提交次数。
+现在先在内存中按 API Key / 凭证累加，每 usage_flush_interval 秒通过写队列（db_writer）
+批量写入：每张表一条 executemany UPDATE，同一个事务提交。关闭时写入剩余计数。
+
+- 计数是增量（total_requests = total_requests + n），多个 worker 各自累加再写入不会互相覆盖
+- 写入失败时计数放回缓冲，下次再写
+- 最多延迟 usage_flush_interval 秒可见（列表、统计里的使用次数稍晚更新）
+"""
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import bindparam, func, update
+
+from app.config import settings
+from app.database import db_writer
+from app.models.user import APIKey, Credential
+
+
+class UsageBuffer:
+    """API Key / 凭证使用计数的内存缓冲，定时批量写入数据库"""
+
+    def __init__(self):
+        # API Key id -> 最后使用时间
+        self._api_keys: Dict[int, datetime] = {}
+        # 凭证 id -> (新增请求数, 最后使用时间)
+        self._credentials: Dict[int, Tuple[int, datetime]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.stats = {"flushes": 0, "api_key_rows": 0, "credential_rows": 0, "requests": 0, "failed": 0, "last_flush_ms": 0.0}
+
+    def touch_api_key(self, key_id: int) -> None:
+        """记录 API Key 被使用"""
+        self._api_keys[key_id] = datetime.utcnow()
+
+    def add_credential_use(self, cred_id: int, count: int = 1) -> None:
+        """记录凭证完成一次请求"""
+        pending = self._credentials.get(cred_id)
+        self._credentials[cred_id] = ((pending[0] if pending else 0) + count, datetime.utcnow())
+
+    async def flush(self) -> None:
+        """把缓冲中的计数写入数据库（写失败时放回缓冲）"""
+        async with self._flush_lock:
+            if not self._api_keys and not self._credentials:
+                return
+            api_keys, self._api_keys = self._api_keys, {}
+            credentials, self._credentials = self._credentials, {}
+            start = time.perf_counter()
+
+            async def write(session):
+                if api_keys:
+                    await session.execute(
+                        update(APIKey.__table__)
+                        .where(APIKey.__table__.c.id == bindparam("b_id"))
+                        .values(last_used_at=bindparam("b_used_at")),
+                        [{"b_id": key_id, "b_used_at": used_at} for key_id, used_at in api_keys.items()],
+                    )
+                if credentials:
+                    table = Credential.__table__
+                    await session.execute(
+                        update(table)
+                        .where(table.c.id == bindparam("b_id"))
+                        .values(
+                            total_requests=func.coalesce(table.c.total_requests, 0) + bindparam("b_count"),
+                            last_used_at=bindparam("b_used_at"),
+                        ),
+                        [
+                            {"b_id": cred_id, "b_count": count, "b_used_at": used_at}
+                            for cred_id, (count, used_at) in credentials.items()
+                        ],
+                    )
+
+            try:
+                await db_writer.run(write)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"[UsageBuffer] ⚠️ 写入使用计数失败，下次重试: {e}", flush=True)
+                for key_id, used_at in api_keys.items():
+                    self._api_keys.setdefault(key_id, used_at)
+                for cred_id, (count, used_at) in credentials.items():
+                    pending = self._credentials.get(cred_id)
+                    self._credentials[cred_id] = (count + (pending[0] if pending else 0), pending[1] if pending else used_at)
+                return
+
+            self.stats["flushes"] += 1
+            self.stats["api_key_rows"] += len(api_keys)
+            self.stats["credential_rows"] += len(credentials)
+            self.stats["requests"] += sum(count for count, _ in credentials.values())
+            self.stats["last_flush_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.usage_flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[UsageBuffer] ⚠️ 定时写入失败: {e}", flush=True)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        """停止定时任务并写入剩余计数"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def get_stats(self) -> dict:
+        return {
+            "pending_api_keys": len(self._api_keys),
+            "pending_credentials": len(self._credentials),
+            **self.stats,
+        }
+
+
+# 全局使用计数缓冲
+usage_buffer = UsageBuffer()
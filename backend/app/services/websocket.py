@@ -1,55 +1,258 @@
+"""
+WebSocket 实时推送
+
+多 worker 时每个进程只持有连接到自己的 WebSocket，日志/统计/凭证事件通过 Redis 发布订阅在 worker 之间广播：
+- 发布端: 每个 worker 把窗口内产生的事件合并为一条消息发布（每个 worker 每个窗口最多发布一次）
+- 订阅端: 每个 worker 订阅频道，把所有 worker 的事件再合并一次后推送给本进程的管理员连接
+  （每个管理员每个窗口最多收到一条 log_batch + 每种通知一条，与请求量、worker 数无关）
+Redis 不可用时退化为进程内推送。
+"""
 from fastapi import WebSocket
-from typing import Dict, Set
+from typing import Any, Deque, Dict, List, Optional, Set
+from collections import deque
 import json
 import asyncio
+import uuid
+
+from app.services.redis_service import redis_service
+
+# 每个连接的发送队列上限，满了丢弃最旧的消息（慢客户端不影响其他连接和请求处理）
+SEND_QUEUE_SIZE = 256
+# 事件合并窗口（秒）
+BATCH_WINDOW = 0.25
+# 每条 log_batch 最多携带的日志数（管理后台只展示最近 100 条），超出时丢弃最旧的
+MAX_BATCH_LOGS = 100
+# Redis 频道
+EVENTS_CHANNEL = "ws:events"
+
+# 只推送一次、内容固定的通知
+_EVENT_MESSAGES = {
+    "stats_update": "统计数据已更新",
+    "credential_update": "凭证列表已更新",
+    "user_update": "用户列表已更新",
+}
+
+
+def _serialize(message: dict) -> str:
+    # 与 WebSocket.send_json 的序列化方式一致
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class _Connection:
+    """单个 WebSocket 连接：有界发送队列 + 独立的发送任务"""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: Deque[str] = deque(maxlen=SEND_QUEUE_SIZE)
+        self.ready = asyncio.Event()
+        self.alive = True
+        self.dropped = 0
+        self.task = asyncio.create_task(self._writer())
+
+    def enqueue(self, text: str) -> None:
+        if not self.alive:
+            return
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(text)
+        self.ready.set()
+
+    async def _writer(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue:
+                    await self.websocket.send_text(self.queue.popleft())
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # 发送失败（连接已断开）：关闭连接，接收循环随之退出
+            self.alive = False
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+
+    def close(self):
+        self.alive = False
+        self.task.cancel()
+
 
 class ConnectionManager:
-    """WebSocket 连接管理器"""
-    
+    """WebSocket 连接管理器
+
+    发送只是把序列化好的消息放进每个连接的队列，由各连接的发送任务异步写出；
+    调用方（请求处理、日志记录）不会被慢的浏览器拖住。
+    """
+
     def __init__(self):
         # 存储活跃连接 {user_id: set(websocket)}
         self.active_connections: Dict[int, Set[WebSocket]] = {}
         # 管理员连接（接收所有更新）
         self.admin_connections: Set[WebSocket] = set()
-    
+        # websocket -> 发送队列
+        self._connections: Dict[WebSocket, _Connection] = {}
+        # 本 worker 产生、待发布的事件
+        self._outgoing_logs: Deque[dict] = deque(maxlen=MAX_BATCH_LOGS)
+        self._outgoing_events: Set[str] = set()
+        self._outgoing_dropped = 0
+        self._publish_task: Optional[asyncio.Task] = None
+        # 收到的（所有 worker 的）事件，待推送给本进程的管理员
+        self._pending_logs: Deque[dict] = deque(maxlen=MAX_BATCH_LOGS)
+        self._pending_events: Set[str] = set()
+        self._pending_dropped = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        self.worker_id = uuid.uuid4().hex[:8]
+        # 是否已订阅 Redis 频道（未订阅时事件只在本进程内推送）
+        self.subscribed = False
+        self._stats = {"published": 0, "received": 0, "flushed": 0}
+
     async def connect(self, websocket: WebSocket, user_id: int, is_admin: bool = False):
         await websocket.accept()
+        self._connections[websocket] = _Connection(websocket)
         if user_id not in self.active_connections:
             self.active_connections[user_id] = set()
         self.active_connections[user_id].add(websocket)
         if is_admin:
             self.admin_connections.add(websocket)
-    
+
     def disconnect(self, websocket: WebSocket, user_id: int):
         if user_id in self.active_connections:
             self.active_connections[user_id].discard(websocket)
+            if not self.active_connections[user_id]:
+                del self.active_connections[user_id]
         self.admin_connections.discard(websocket)
-    
+        connection = self._connections.pop(websocket, None)
+        if connection:
+            connection.close()
+
+    def is_alive(self, websocket: WebSocket) -> bool:
+        connection = self._connections.get(websocket)
+        return connection is not None and connection.alive
+
+    def _enqueue(self, websockets, message: dict):
+        """序列化一次，放入每个连接的队列"""
+        text = None
+        for websocket in list(websockets):
+            connection = self._connections.get(websocket)
+            if connection is None:
+                continue
+            if text is None:
+                text = _serialize(message)
+            connection.enqueue(text)
+
+    async def send_to_socket(self, websocket: WebSocket, message: dict):
+        """发送给单个连接（与广播消息走同一个队列，保证同一连接不会并发写）"""
+        self._enqueue([websocket], message)
+
     async def send_personal(self, user_id: int, message: dict):
         """发送给特定用户"""
         if user_id in self.active_connections:
-            for connection in self.active_connections[user_id].copy():
-                try:
-                    await connection.send_json(message)
-                except:
-                    self.active_connections[user_id].discard(connection)
-    
+            self._enqueue(self.active_connections[user_id], message)
+
     async def send_to_admins(self, message: dict):
         """发送给所有管理员"""
-        for connection in self.admin_connections.copy():
-            try:
-                await connection.send_json(message)
-            except:
-                self.admin_connections.discard(connection)
-    
+        self._enqueue(self.admin_connections, message)
+
     async def broadcast(self, message: dict):
         """广播给所有连接"""
-        for connections in self.active_connections.values():
-            for connection in connections.copy():
-                try:
-                    await connection.send_json(message)
-                except:
-                    connections.discard(connection)
+        self._enqueue(self._connections.keys(), message)
+
+    # ---------- 合并发送（发布端） ----------
+
+    def start_pubsub(self) -> bool:
+        """订阅 Redis 事件频道（启动时调用）"""
+        self.subscribed = redis_service.subscribe(EVENTS_CHANNEL, self._on_message)
+        return self.subscribed
+
+    def queue_log(self, log_data: dict):
+        if not self.subscribed and not self.admin_connections:
+            return
+        if len(self._outgoing_logs) == MAX_BATCH_LOGS:
+            self._outgoing_dropped += 1
+        self._outgoing_logs.append(log_data)
+        self._schedule_publish()
+
+    def queue_event(self, event_type: str):
+        if not self.subscribed and not self.admin_connections:
+            return
+        self._outgoing_events.add(event_type)
+        self._schedule_publish()
+
+    def _schedule_publish(self):
+        if self._publish_task is None or self._publish_task.done():
+            self._publish_task = asyncio.create_task(self._publish_later())
+
+    async def _publish_later(self):
+        await asyncio.sleep(BATCH_WINDOW)
+        payload = {
+            "origin": self.worker_id,
+            "logs": list(self._outgoing_logs),
+            "events": sorted(self._outgoing_events),
+            "dropped": self._outgoing_dropped,
+        }
+        self._outgoing_logs.clear()
+        self._outgoing_events.clear()
+        self._outgoing_dropped = 0
+
+        if self.subscribed and await redis_service.publish(EVENTS_CHANNEL, json.dumps(payload, ensure_ascii=False)):
+            self._stats["published"] += 1
+            return
+        # 未订阅或发布失败：直接推送给本进程的连接
+        self._receive(payload)
+
+    # ---------- 合并推送（订阅端） ----------
+
+    def _on_message(self, data: str):
+        """Redis 订阅任务（redis_service._listen，运行在事件循环中）收到消息后直接调用，不能阻塞"""
+        try:
+            payload = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        self._stats["received"] += 1
+        self._receive(payload)
+
+    def _receive(self, payload: dict):
+        if not self.admin_connections:
+            return
+        for log_data in payload.get("logs") or []:
+            if len(self._pending_logs) == MAX_BATCH_LOGS:
+                self._pending_dropped += 1
+            self._pending_logs.append(log_data)
+        self._pending_dropped += payload.get("dropped") or 0
+        self._pending_events.update(e for e in payload.get("events") or [] if e in _EVENT_MESSAGES)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(BATCH_WINDOW)
+        logs = list(self._pending_logs)
+        events = sorted(self._pending_events)
+        dropped = self._pending_dropped
+        self._pending_logs.clear()
+        self._pending_events.clear()
+        self._pending_dropped = 0
+        self._stats["flushed"] += 1
+        if logs:
+            # 窗口内的所有新日志合并为一条消息（按时间顺序）
+            message = {"type": "log_batch", "data": logs}
+            if dropped:
+                message["dropped"] = dropped
+            self._enqueue(self.admin_connections, message)
+        for event_type in events:
+            self._enqueue(self.admin_connections, {"type": event_type, "message": _EVENT_MESSAGES[event_type]})
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "connections": len(self._connections),
+            "admins": len(self.admin_connections),
+            "queued": sum(len(c.queue) for c in self._connections.values()),
+            "dropped": sum(c.dropped for c in self._connections.values()),
+            "worker_id": self.worker_id,
+            "pubsub": self.subscribed,
+            **self._stats,
+        }
 
 
 # 全局连接管理器
@@ -57,32 +260,20 @@ manager = ConnectionManager()
 
 
 async def notify_stats_update():
-    """通知统计数据更新"""
-    await manager.send_to_admins({
-        "type": "stats_update",
-        "message": "统计数据已更新"
-    })
+    """通知统计数据更新（窗口内多次合并为一条）"""
+    manager.queue_event("stats_update")
 
 
 async def notify_credential_update():
     """通知凭证更新"""
-    await manager.send_to_admins({
-        "type": "credential_update",
-        "message": "凭证列表已更新"
-    })
+    manager.queue_event("credential_update")
 
 
 async def notify_user_update():
     """通知用户列表更新"""
-    await manager.send_to_admins({
-        "type": "user_update",
-        "message": "用户列表已更新"
-    })
+    manager.queue_event("user_update")
 
 
 async def notify_log_update(log_data: dict):
-    """通知新日志"""
-    await manager.send_to_admins({
-        "type": "log_update",
-        "data": log_data
-    })
+    """通知新日志（窗口内的日志合并为一条 log_batch 消息）"""
+    manager.queue_log(log_data)
@@ -0,0 +1,81 @@
+"""
+上游超时策略
+
+按模型家族（flash / pro / 30 / image / claude）区分三类超时：
+- connect:    建立连接
+- first_byte: 发出请求到收到第一个数据（非流式即整个响应）
+- idle:       流式分块之间的最大间隔
+
+超时统一抛出带 "API Error 504 ... timeout" 的异常，
+路由中现有的“切换凭证重试”逻辑据此识别并换凭证重试。
+"""
+import asyncio
+import re
+from typing import AsyncGenerator, Dict
+
+import httpx
+
+from app.config import settings, DEFAULT_UPSTREAM_DEADLINES
+
+# gemini-3 系列（gemini-3-pro、gemini-3.1-pro 等），不匹配 gemini-30 之类
+_GEMINI_3_RE = re.compile(r"gemini-3(?![0-9])")
+
+
+def get_model_family(model: str) -> str:
+    """根据模型名确定模型家族（超时策略用）"""
+    model_lower = (model or "").lower()
+    if "claude" in model_lower:
+        return "claude"
+    if "image" in model_lower:
+        return "image"
+    if _GEMINI_3_RE.search(model_lower):
+        return "30"
+    if "pro" in model_lower:
+        return "pro"
+    return "flash"
+
+
+def get_deadline(model: str) -> Dict[str, float]:
+    """获取模型的超时配置，未配置的项回退到该家族的默认值"""
+    family = get_model_family(model)
+    defaults = DEFAULT_UPSTREAM_DEADLINES.get(family, DEFAULT_UPSTREAM_DEADLINES["flash"])
+    deadline = settings.upstream_deadlines.get(family, {})
+    return {
+        key: float(deadline.get(key, defaults[key]))
+        for key in ("connect", "first_byte", "idle")
+    }
+
+
+def build_timeout(model: str, stream: bool = False) -> httpx.Timeout:
+    """构建 httpx 超时：非流式的读取超时即首字节超时；流式由 iter_lines_with_deadline 控制"""
+    deadline = get_deadline(model)
+    read = max(deadline["first_byte"], deadline["idle"]) if stream else deadline["first_byte"]
+    return httpx.Timeout(connect=deadline["connect"], read=read, write=30.0, pool=30.0)
+
+
+def timeout_error(model: str, e: httpx.TimeoutException) -> Exception:
+    """把 httpx 超时转换为可被重试逻辑识别的异常"""
+    kind = "connect" if isinstance(e, httpx.ConnectTimeout) else "first_byte"
+    return Exception(f"API Error 504: upstream {kind} timeout ({get_deadline(model)[kind]:.0f}s, model={model})")
+
+
+async def iter_lines_with_deadline(response: httpx.Response, model: str) -> AsyncGenerator[str, None]:
+    """逐行读取流式响应：第一行受首字节超时约束，之后每行受分块间隔超时约束"""
+    deadline = get_deadline(model)
+    lines = response.aiter_lines()
+    timeout = deadline["first_byte"]
+    kind = "first_byte"
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(lines.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise Exception(f"API Error 504: upstream {kind} timeout ({timeout:.0f}s, model={model})")
+            if kind == "first_byte" and line:
+                timeout = deadline["idle"]
+                kind = "idle"
+            yield line
+    finally:
+        await lines.aclose()
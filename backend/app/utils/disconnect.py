@@ -0,0 +1,45 @@
+"""
+客户端断开处理
+
+客户端在流式响应中途断开时，Starlette 会取消正在运行的响应任务，
+CancelledError 会在生成器当前等待的位置抛出（上游 httpx 流随 async with 一起关闭）。
+如果生成器恰好停在 yield 处，则要等到被关闭/回收时才会收到 GeneratorExit。
+
+这里包装流式生成器，两种情况都会：
+- 立即关闭内部生成器，释放上游连接和挂起的任务
+- 在独立任务中执行断开回调（记录日志、释放凭证），避免再次被已取消的作用域打断
+"""
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable
+
+# 客户端主动断开（沿用 nginx 的 499 状态码）
+CLIENT_CLOSED_REQUEST = 499
+
+# 持有清理任务的引用，防止任务在完成前被回收
+_cleanup_tasks = set()
+
+
+async def _cleanup(source: AsyncIterator, on_disconnect: Callable[[], Awaitable[None]]) -> None:
+    try:
+        await source.aclose()
+    except Exception:
+        pass
+    try:
+        await on_disconnect()
+    except Exception as e:
+        print(f"[Disconnect] ⚠️ 断开回调执行失败: {e}", flush=True)
+
+
+async def cancel_on_disconnect(
+    source: AsyncIterator,
+    on_disconnect: Callable[[], Awaitable[None]]
+) -> AsyncGenerator:
+    """转发 source 的数据；客户端断开时关闭 source 并调用 on_disconnect"""
+    try:
+        async for chunk in source:
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        task = asyncio.create_task(_cleanup(source, on_disconnect))
+        _cleanup_tasks.add(task)
+        task.add_done_callback(_cleanup_tasks.discard)
+        raise
@@ -0,0 +1,23 @@
+"""
+心跳等待工具
+
+假流式 / 假非流模式需要在等待上游时定期发送心跳保持连接。
+原先的做法是 `asyncio.sleep(2)` 轮询任务状态，上游完成后客户端平均还要多等 1 秒。
+这里改为直接等待任务，以心跳间隔作为超时：
+- 超时 → 产出一次心跳
+- 完成 → 立即返回，不再额外等待
+"""
+import asyncio
+from typing import AsyncGenerator
+
+
+async def wait_with_heartbeat(task: asyncio.Future, interval: float) -> AsyncGenerator[None, None]:
+    """等待任务完成，每隔 interval 秒产出一次 None（调用方据此发送心跳）
+
+    任务完成后生成器立即结束，结果由调用方自行 `await task` 获取。
+    """
+    while not task.done():
+        done, _ = await asyncio.wait({task}, timeout=interval)
+        if not done:
+            yield None
+
@@ -0,0 +1,56 @@
+"""
+Token 用量提取
+
+上游 Gemini 响应的 usageMetadata 字段：
+- promptTokenCount         输入（含缓存命中部分）
+- candidatesTokenCount     输出
+- thoughtsTokenCount       思考
+- cachedContentTokenCount  缓存命中
+
+流式响应中只有最后一个分块（带 finishReason）携带最终用量，
+因此流式只检查带 finishReason 的分块，且复用调用方已解析的数据，不额外解析 JSON。
+"""
+from typing import Optional, Dict, Tuple
+
+
+def extract_usage(response_data: dict) -> Optional[Dict[str, int]]:
+    """从 Gemini 响应（已解包 response 字段）中提取 token 用量，没有则返回 None"""
+    usage_metadata = response_data.get("usageMetadata")
+    if not usage_metadata:
+        return None
+    return {
+        "prompt": usage_metadata.get("promptTokenCount", 0) or 0,
+        "candidates": usage_metadata.get("candidatesTokenCount", 0) or 0,
+        "thoughts": usage_metadata.get("thoughtsTokenCount", 0) or 0,
+        "cached": usage_metadata.get("cachedContentTokenCount", 0) or 0,
+    }
+
+
+def extract_final_usage(response_data: dict) -> Optional[Dict[str, int]]:
+    """流式分块：只有带 finishReason 的分块才提取用量"""
+    candidates = response_data.get("candidates")
+    if not candidates or not candidates[0].get("finishReason"):
+        return None
+    return extract_usage(response_data)
+
+
+def usage_to_log_tokens(usage: Optional[Dict[str, int]]) -> Tuple[int, int]:
+    """转换为 UsageLog 的 (tokens_input, tokens_output)，输出包含思考 token"""
+    if not usage:
+        return 0, 0
+    return usage["prompt"], usage["candidates"] + usage["thoughts"]
+
+
+def usage_to_openai(usage: Optional[Dict[str, int]]) -> dict:
+    """转换为 OpenAI 格式的 usage 字段"""
+    prompt_tokens, completion_tokens = usage_to_log_tokens(usage)
+    result = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    if usage and usage["cached"]:
+        result["prompt_tokens_details"] = {"cached_tokens": usage["cached"]}
+    if usage and usage["thoughts"]:
+        result["completion_tokens_details"] = {"reasoning_tokens": usage["thoughts"]}
+    return result
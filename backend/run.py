@@ -10,9 +10,20 @@ if __name__ == "__main__":
     # 生产环境检测：有 PORT 环境变量时禁用 reload
     is_production = "PORT" in os.environ
     
+    # 多 worker：WORKERS 环境变量或 .env 中的 workers（热重载只支持单进程）
+    workers = max(1, settings.workers)
+    if workers > 1:
+        # 配置和自定义错误消息规则通过配置版本号在 worker 间同步，以下状态仍是每个进程各自一份
+        print(f"[Startup] ⚠️ 多 worker 模式（{workers} 个）：熔断器状态按进程统计，"
+              f"每个 worker 各自累计失败次数、各自放行半开探测请求，上游故障时最多需要 {workers} 倍的失败才会全部熔断", flush=True)
+        if not settings.redis_enabled:
+            print("[Startup] ⚠️ 多 worker 模式未启用 Redis：用户/统计缓存将被禁用（内存缓存无法跨 worker 失效），"
+                  "响应缓存不在 worker 间共享，建议配置 REDIS_URL", flush=True)
+    
     uvicorn.run(
         "app.main:app",
         host=settings.host,
         port=port,
-        reload=not is_production  # 仅开发环境启用热重载
+        reload=not is_production and workers == 1,  # 仅开发环境启用热重载
+        workers=workers,
     )
@@ -0,0 +1,14 @@
+"""
+测试公共配置
+
+在导入 app 之前设置环境变量：使用临时 SQLite 数据库、不连接 Redis，测试不读写 data/ 目录。
+"""
+import os
+import sys
+import tempfile
+
+_test_dir = tempfile.mkdtemp(prefix="catiecli-test-")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{_test_dir}/test.db")
+os.environ.setdefault("REDIS_ENABLED", "false")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,66 @@
+"""熔断器半开状态（app/services/circuit_breaker.py）：只有真正的成功才关闭，凭证/请求错误只归还探测名额"""
+from types import SimpleNamespace
+
+from app.config import settings
+from app.services.circuit_breaker import (
+    CLOSED, HALF_OPEN, OPEN, PROBES_SCOPE_KEY, CircuitBreakerRegistry,
+)
+
+UPSTREAM = "https://upstream.test"
+MODEL = "gemini-2.5-pro"
+
+
+def _half_open_registry(monkeypatch) -> CircuitBreakerRegistry:
+    monkeypatch.setattr(settings, "circuit_breaker_enabled", True)
+    monkeypatch.setattr(settings, "circuit_breaker_half_open_probes", 1)
+    registry = CircuitBreakerRegistry()
+    breaker = registry._get(UPSTREAM, MODEL)
+    breaker.state = OPEN
+    breaker.opened_at = 0
+    breaker.open_seconds = 1
+    return registry
+
+
+def _request():
+    return SimpleNamespace(scope={PROBES_SCOPE_KEY: []})
+
+
+def test_client_error_while_probing_keeps_state_and_releases_slot(monkeypatch):
+    registry = _half_open_registry(monkeypatch)
+    breaker = registry._get(UPSTREAM, MODEL)
+
+    probe = _request()
+    assert registry.acquire(UPSTREAM, MODEL, probe) == 0
+    assert breaker.state == HALF_OPEN
+    # 名额已满，其他请求被拒绝
+    assert registry.acquire(UPSTREAM, MODEL, _request()) > 0
+
+    assert registry.record_failure(UPSTREAM, MODEL, "API Error 401: invalid credentials", request=probe) is False
+    assert breaker.state == HALF_OPEN
+    assert not breaker.probes
+    assert probe.scope[PROBES_SCOPE_KEY] == []
+
+    # 名额归还后下一个请求可以继续探测，成功才关闭
+    assert registry.acquire(UPSTREAM, MODEL, _request()) == 0
+    registry.record_success(UPSTREAM, MODEL)
+    assert breaker.state == CLOSED
+
+
+def test_upstream_failure_while_probing_reopens(monkeypatch):
+    registry = _half_open_registry(monkeypatch)
+    breaker = registry._get(UPSTREAM, MODEL)
+
+    probe = _request()
+    assert registry.acquire(UPSTREAM, MODEL, probe) == 0
+    assert registry.record_failure(UPSTREAM, MODEL, "API Error 503: unavailable", request=probe) is True
+    assert breaker.state == OPEN
+    assert breaker.open_seconds == 2
+
+
+def test_client_error_when_closed_counts_as_success(monkeypatch):
+    monkeypatch.setattr(settings, "circuit_breaker_enabled", True)
+    registry = CircuitBreakerRegistry()
+    assert registry.record_failure(UPSTREAM, MODEL, "API Error 400: bad request") is False
+    breaker = registry._get(UPSTREAM, MODEL)
+    assert breaker.state == CLOSED
+    assert [failed for _, failed in breaker.events] == [False]
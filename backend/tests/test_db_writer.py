@@ -0,0 +1,231 @@
+"""单写队列（app/database.py DatabaseWriter）：200 个并发流式请求的写入负载，以及与逐会话提交的吞吐对比"""
+import asyncio
+import random
+import time
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+import app.database as database
+from app.config import settings
+from app.database import async_session, db_writer, engine, init_db, sqlite_pooled, writer_engine
+from app.models.user import UsageLog, User
+
+# 并发流式请求数
+STREAMS = 200
+# 每隔多少个请求有一个失败的写操作（只回滚它自己的 SAVEPOINT）
+FAILING_EVERY = 50
+# 写入负载下单次读查询的最长耗时（秒）
+READ_LATENCY_BUDGET = 1.0
+# 吞吐对比的并发流式请求数
+THROUGHPUT_STREAMS = 200
+
+
+class JobFailed(Exception):
+    pass
+
+
+async def _simulate_stream(index: int, user_id: int, read_latencies: list) -> int:
+    """一个流式请求的数据库操作：插入占位日志 -> 读 -> 更新结果（失败的请求额外执行一个会回滚的写操作）"""
+    async def insert_placeholder(session):
+        log = UsageLog(user_id=user_id, model="gemini-2.5-flash", endpoint="/v1/chat/completions", status_code=0)
+        session.add(log)
+        await session.flush()
+        return log.id
+
+    log_id = await db_writer.run(insert_placeholder)
+    await asyncio.sleep(random.uniform(0, 0.02))
+
+    start = time.perf_counter()
+    async with async_session() as session:
+        await session.scalar(select(func.count(UsageLog.id)))
+    read_latencies.append(time.perf_counter() - start)
+
+    if index % FAILING_EVERY == 0:
+        async def failing_job(session):
+            session.add(UsageLog(user_id=user_id, model="rolled-back", status_code=500))
+            await session.flush()
+            raise JobFailed()
+
+        try:
+            await db_writer.run(failing_job)
+        except JobFailed:
+            pass
+
+    async def finish(session):
+        await session.execute(
+            update(UsageLog).where(UsageLog.id == log_id).values(status_code=200, latency_ms=1.0, tokens_output=index)
+        )
+
+    await db_writer.run(finish)
+    return log_id
+
+
+def test_concurrent_stream_writes():
+    async def main():
+        await init_db()
+        try:
+            async with async_session() as session:
+                user = User(username=f"writer-load-{time.time_ns()}", hashed_password="x")
+                session.add(user)
+                await session.commit()
+                user_id = user.id
+
+            stats_before = dict(db_writer.stats)
+            read_latencies = []
+            log_ids = await asyncio.gather(*[
+                _simulate_stream(i, user_id, read_latencies) for i in range(STREAMS)
+            ])
+
+            async with async_session() as session:
+                rows = (await session.execute(
+                    select(UsageLog.status_code, UsageLog.tokens_output, UsageLog.model).where(UsageLog.user_id == user_id)
+                )).all()
+
+            assert len(set(log_ids)) == STREAMS
+            assert len(rows) == STREAMS
+            assert all(status == 200 for status, _, _ in rows)
+            assert sorted(tokens for _, tokens, _ in rows) == list(range(STREAMS))
+            assert not any(model == "rolled-back" for _, _, model in rows)
+            assert max(read_latencies) < READ_LATENCY_BUDGET
+
+            jobs = db_writer.stats["jobs"] - stats_before["jobs"]
+            transactions = db_writer.stats["transactions"] - stats_before["transactions"]
+            failing = len(range(0, STREAMS, FAILING_EVERY))
+            print(f"\n[bench] {STREAMS} 个并发流: {jobs} 个写操作合并为 {transactions} 个事务, "
+                  f"读查询最长 {max(read_latencies) * 1000:.1f}ms")
+            if sqlite_pooled:
+                assert jobs == STREAMS * 2 + failing
+                assert db_writer.stats["failed"] - stats_before["failed"] == failing
+                # 积压的写操作合并提交
+                assert transactions < jobs
+        finally:
+            # 连接池和写队列绑定在本事件循环上，结束前释放
+            await engine.dispose()
+            if writer_engine is not None:
+                await writer_engine.dispose()
+
+    asyncio.run(main())
+
+
+async def _create_user(prefix: str) -> int:
+    async with async_session() as session:
+        user = User(username=f"{prefix}-{time.time_ns()}", hashed_password="x")
+        session.add(user)
+        await session.commit()
+        return user.id
+
+
+async def _legacy_stream(session_factory, user_id: int):
+    """旧的 NullPool 模式：每个写操作新开连接、单独提交，并发写入在 SQLite 的忙等待中排队"""
+    async with session_factory() as session:
+        log = UsageLog(user_id=user_id, model="legacy", endpoint="/v1/chat/completions", status_code=0)
+        session.add(log)
+        await session.commit()
+        log_id = log.id
+    async with session_factory() as session:
+        await session.scalar(select(func.count(UsageLog.id)))
+    async with session_factory() as session:
+        await session.execute(update(UsageLog).where(UsageLog.id == log_id).values(status_code=200, latency_ms=1.0))
+        await session.commit()
+
+
+async def _queued_stream(user_id: int):
+    """连接池 + 写队列模式：同样的插入 -> 读 -> 更新"""
+    async def insert_placeholder(session):
+        log = UsageLog(user_id=user_id, model="queued", endpoint="/v1/chat/completions", status_code=0)
+        session.add(log)
+        await session.flush()
+        return log.id
+
+    log_id = await db_writer.run(insert_placeholder)
+    async with async_session() as session:
+        await session.scalar(select(func.count(UsageLog.id)))
+
+    async def finish(session):
+        await session.execute(update(UsageLog).where(UsageLog.id == log_id).values(status_code=200, latency_ms=1.0))
+
+    await db_writer.run(finish)
+
+
+def test_queue_throughput_vs_legacy_commits():
+    """与旧的 NullPool 逐会话提交对比吞吐（同一个数据库文件、同样的写入负载）"""
+    if not sqlite_pooled:
+        return
+
+    async def main():
+        await init_db()
+        legacy_engine = create_async_engine(
+            settings.database_url,
+            connect_args={"timeout": database.WRITE_LOCK_TIMEOUT, "check_same_thread": False},
+            poolclass=NullPool,
+        )
+        try:
+            user_id = await _create_user("writer-throughput")
+            legacy_session = async_sessionmaker(legacy_engine, expire_on_commit=False)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[_legacy_stream(legacy_session, user_id) for _ in range(THROUGHPUT_STREAMS)])
+            legacy_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            await asyncio.gather(*[_queued_stream(user_id) for _ in range(THROUGHPUT_STREAMS)])
+            queued_elapsed = time.perf_counter() - start
+
+            async with async_session() as session:
+                counts = dict((await session.execute(
+                    select(UsageLog.model, func.count(UsageLog.id))
+                    .where(UsageLog.user_id == user_id, UsageLog.status_code == 200)
+                    .group_by(UsageLog.model)
+                )).all())
+
+            print(f"\n[bench] {THROUGHPUT_STREAMS} 个并发流: NullPool 逐会话提交 {THROUGHPUT_STREAMS / legacy_elapsed:.0f} 个/秒, "
+                  f"连接池 + 写队列 {THROUGHPUT_STREAMS / queued_elapsed:.0f} 个/秒")
+            assert counts == {"legacy": THROUGHPUT_STREAMS, "queued": THROUGHPUT_STREAMS}
+            assert queued_elapsed < legacy_elapsed
+        finally:
+            await legacy_engine.dispose()
+            await engine.dispose()
+            if writer_engine is not None:
+                await writer_engine.dispose()
+
+    asyncio.run(main())
+
+
+async def _queued_insert(user_id: int):
+    async def insert(session):
+        session.add(UsageLog(user_id=user_id, model="queued", status_code=200))
+
+    await db_writer.run(insert)
+
+
+def test_write_lock_timeout_fails_batch(monkeypatch):
+    """写锁一直被占用时，整批写操作在 WRITE_LOCK_TIMEOUT 后失败，而不是无限等待"""
+    if not sqlite_pooled:
+        return
+    monkeypatch.setattr(database, "WRITE_LOCK_TIMEOUT", 0.05)
+    # asyncio.Lock 有等待者时会绑定到当时的事件循环，每个测试用新的锁
+    monkeypatch.setattr(database, "_write_lock", asyncio.Lock())
+
+    async def main():
+        await init_db()
+        try:
+            user_id = await _create_user("writer-lock-timeout")
+            await database._write_lock.acquire()
+            try:
+                results = await asyncio.gather(
+                    *[_queued_insert(user_id) for _ in range(3)], return_exceptions=True
+                )
+            finally:
+                database._write_lock.release()
+
+            assert all(isinstance(r, RuntimeError) and "database is locked" in str(r) for r in results)
+            # 写锁释放后写队列恢复
+            await _queued_insert(user_id)
+        finally:
+            await engine.dispose()
+            if writer_engine is not None:
+                await writer_engine.dispose()
+
+    asyncio.run(main())
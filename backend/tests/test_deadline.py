@@ -0,0 +1,18 @@
+"""上游超时策略（app/utils/deadline.py）：模型家族识别和默认值隔离"""
+from app.config import DEFAULT_UPSTREAM_DEADLINES, Settings
+from app.utils.deadline import get_model_family
+
+
+def test_gemini_3_family_matches_point_releases():
+    assert get_model_family("gemini-3-pro-preview") == "30"
+    assert get_model_family("gemini-3.1-pro") == "30"
+    assert get_model_family("假流式/gemini-3.1-flash") == "30"
+    assert get_model_family("gemini-2.5-pro") == "pro"
+    assert get_model_family("gemini-2.5-flash") == "flash"
+
+
+def test_default_deadlines_are_not_shared():
+    settings = Settings()
+    settings.upstream_deadlines["pro"]["idle"] = 1
+    assert DEFAULT_UPSTREAM_DEADLINES["pro"]["idle"] == 60
+    assert Settings().upstream_deadlines["pro"]["idle"] == 60
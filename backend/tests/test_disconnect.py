@@ -0,0 +1,95 @@
+"""客户端断开处理（app/utils/disconnect.py）：断开后立即取消上游并执行断开回调"""
+import asyncio
+import time
+
+from app.utils.disconnect import cancel_on_disconnect
+
+# 断开到上游被取消、回调执行完成的时间上限（秒）
+DISCONNECT_BUDGET = 0.05
+
+
+class SlowUpstream:
+    """模拟上游流：先输出一个分块，然后长时间等待下一个分块"""
+
+    def __init__(self):
+        self.closed_at = None
+        self.cancelled = False
+
+    async def stream(self):
+        try:
+            yield "data: first\n\n"
+            await asyncio.sleep(30)
+            yield "data: never\n\n"
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        finally:
+            self.closed_at = time.perf_counter()
+
+
+def test_cancel_while_waiting_for_upstream():
+    """生成器停在等待上游处时断开（Starlette 取消响应任务）"""
+    async def main():
+        upstream = SlowUpstream()
+        disconnected = asyncio.Event()
+        callback_at = []
+
+        async def on_disconnect():
+            callback_at.append(time.perf_counter())
+            disconnected.set()
+
+        async def consume():
+            async for _ in cancel_on_disconnect(upstream.stream(), on_disconnect):
+                pass
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        cancelled_at = time.perf_counter()
+        task.cancel()
+        await asyncio.wait_for(disconnected.wait(), timeout=1)
+
+        assert upstream.cancelled
+        assert upstream.closed_at - cancelled_at < DISCONNECT_BUDGET
+        assert callback_at[0] - cancelled_at < DISCONNECT_BUDGET
+
+    asyncio.run(main())
+
+
+def test_close_while_suspended_at_yield():
+    """生成器停在 yield 处时断开（响应被关闭，收到 GeneratorExit）"""
+    async def main():
+        upstream = SlowUpstream()
+        disconnected = asyncio.Event()
+
+        async def on_disconnect():
+            disconnected.set()
+
+        wrapped = cancel_on_disconnect(upstream.stream(), on_disconnect)
+        assert await wrapped.__anext__() == "data: first\n\n"
+        closed_at = time.perf_counter()
+        await wrapped.aclose()
+        await asyncio.wait_for(disconnected.wait(), timeout=1)
+
+        assert upstream.closed_at is not None
+        assert time.perf_counter() - closed_at < DISCONNECT_BUDGET
+
+    asyncio.run(main())
+
+
+def test_no_callback_when_stream_completes():
+    async def main():
+        calls = []
+
+        async def source():
+            yield "a"
+            yield "b"
+
+        async def on_disconnect():
+            calls.append(1)
+
+        chunks = [chunk async for chunk in cancel_on_disconnect(source(), on_disconnect)]
+        await asyncio.sleep(0)
+        assert chunks == ["a", "b"]
+        assert calls == []
+
+    asyncio.run(main())
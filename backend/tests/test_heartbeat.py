@@ -0,0 +1,80 @@
+"""心跳等待（app/utils/heartbeat.py）：上游返回后假流式立即输出，不等到下一个心跳间隔"""
+import asyncio
+import json
+import time
+
+from app.config import settings
+from app.services.gemini_client import GeminiClient
+from app.utils.heartbeat import wait_with_heartbeat
+
+# 上游返回到结果输出的时间上限（秒）
+FLUSH_BUDGET = 0.05
+# 模拟上游耗时（秒）
+UPSTREAM_DELAY = 0.2
+
+
+async def _mock_upstream(result, finished_at: list):
+    await asyncio.sleep(UPSTREAM_DELAY)
+    finished_at.append(time.perf_counter())
+    return result
+
+
+def test_returns_as_soon_as_upstream_finishes():
+    async def main():
+        finished_at = []
+        task = asyncio.create_task(_mock_upstream("ok", finished_at))
+        heartbeats = 0
+        async for _ in wait_with_heartbeat(task, interval=10):
+            heartbeats += 1
+        returned_at = time.perf_counter()
+
+        assert heartbeats == 0
+        assert await task == "ok"
+        assert returned_at - finished_at[0] < FLUSH_BUDGET
+
+    asyncio.run(main())
+
+
+def test_heartbeats_while_waiting():
+    async def main():
+        finished_at = []
+        task = asyncio.create_task(_mock_upstream("ok", finished_at))
+        heartbeats = 0
+        async for _ in wait_with_heartbeat(task, interval=0.03):
+            heartbeats += 1
+        returned_at = time.perf_counter()
+
+        assert heartbeats >= 3
+        assert returned_at - finished_at[0] < FLUSH_BUDGET
+
+    asyncio.run(main())
+
+
+def test_fake_stream_flushes_completion_within_budget(monkeypatch):
+    """GeminiClient 假流式：上游（mock）返回后，内容分块在预算内输出"""
+    monkeypatch.setattr(settings, "fake_stream_heartbeat_interval", 2.0)
+    finished_at = []
+    response = {"response": {"candidates": [{"content": {"parts": [{"text": "hello"}]}, "finishReason": "STOP"}]}}
+
+    async def generate_content(*args, **kwargs):
+        return await _mock_upstream(response, finished_at)
+
+    async def main():
+        client = GeminiClient("token", "project")
+        client.generate_content = generate_content
+        content_at = None
+        chunks = []
+        async for chunk in client.chat_completions_fake_stream("gemini-2.5-flash", [{"role": "user", "content": "hi"}]):
+            chunks.append(chunk)
+            if content_at is None and '"content"' in chunk:
+                content_at = time.perf_counter()
+
+        assert content_at - finished_at[0] < FLUSH_BUDGET
+        contents = [
+            json.loads(chunk[6:])["choices"][0]["delta"].get("content")
+            for chunk in chunks if chunk.startswith("data: {")
+        ]
+        assert "hello" in contents
+        assert chunks[-1] == "data: [DONE]\n\n"
+
+    asyncio.run(main())
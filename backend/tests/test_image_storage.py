@@ -0,0 +1,51 @@
+"""图片存储（app/services/image_storage.py）：分块解码写盘的峰值内存"""
+import base64
+import hashlib
+import os
+import tracemalloc
+
+import pytest
+
+from app.config import settings
+from app.services.image_storage import DECODE_CHUNK, ImageStorage
+
+# 8 MB 的图片（base64 约 10.7 MB，与 4K 图片同一量级）
+IMAGE_SIZE = 8 * 1024 * 1024
+# 保存过程中允许的峰值内存：与图片大小无关，只取决于分块大小
+PEAK_BUDGET = 16 * DECODE_CHUNK
+
+
+@pytest.fixture
+def storage_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ImageStorage, "STORAGE_DIR", tmp_path)
+    monkeypatch.setattr(ImageStorage, "THUMBNAIL_DIR", tmp_path / "thumbs")
+    monkeypatch.setattr(settings, "image_thumbnails", False)
+    return tmp_path
+
+
+def test_save_base64_chunked_peak_memory(storage_dir):
+    image = os.urandom(IMAGE_SIZE)
+    base64_data = base64.b64encode(image).decode()
+
+    tracemalloc.start()
+    try:
+        url, thumb_url = ImageStorage._save_base64_chunked(base64_data, "image/png")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    print(f"\n[bench] 保存 {IMAGE_SIZE // 1024} KB 图片，峰值内存 {peak / 1024:.0f} KB")
+    assert peak < PEAK_BUDGET
+
+    digest = hashlib.sha256(image).hexdigest()[:32]
+    assert url == f"/images/{digest}.png"
+    assert thumb_url == ""
+    assert (storage_dir / f"{digest}.png").read_bytes() == image
+
+
+def test_save_same_image_twice_reuses_file(storage_dir):
+    base64_data = base64.b64encode(b"\x89PNG" + os.urandom(1024)).decode()
+    first, _ = ImageStorage._save_base64_chunked(base64_data, "image/png")
+    second, _ = ImageStorage._save_base64_chunked(base64_data, "image/png")
+    assert first == second
+    assert [p.name for p in storage_dir.iterdir()] == [first.rsplit("/", 1)[1]]
@@ -0,0 +1,144 @@
+"""OpenAI messages -> Gemini contents 转换（openai2gemini_full.convert_messages_to_contents）的固定输出测试和微基准"""
+import time
+
+from app.services.conversation_cache import ConversationCache
+from app.services.openai2gemini_full import convert_messages_to_contents
+
+WEATHER_SCHEMAS = {
+    "get_weather": {
+        "type": "object",
+        "properties": {"city": {"type": "string"}, "days": {"type": "integer"}},
+    }
+}
+
+
+def test_system_and_developer_messages_merge_into_system_instruction():
+    contents, system_instruction = convert_messages_to_contents([
+        {"role": "system", "content": "A"},
+        {"role": "developer", "content": "B"},
+        {"role": "user", "content": "hi"},
+    ])
+    assert contents == [{"role": "user", "parts": [{"text": "hi"}]}]
+    assert system_instruction == {"parts": [{"text": "A\n\nB"}]}
+
+
+def test_multipart_content_with_images_and_plain_strings():
+    contents, system_instruction = convert_messages_to_contents([
+        {"role": "user", "content": [
+            {"type": "text", "text": "look"},
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+            "plain",
+            {"type": "image_url", "image_url": {"url": "https://x/y.jpg"}},
+        ]},
+    ])
+    assert contents == [{"role": "user", "parts": [
+        {"text": "look"},
+        {"inlineData": {"mimeType": "image/png", "data": "AAAA"}},
+        {"text": "plain"},
+        {"fileData": {"mimeType": "image/jpeg", "fileUri": "https://x/y.jpg"}},
+    ]}]
+    assert system_instruction is None
+
+
+def test_tool_call_round_trip_fixes_argument_types():
+    contents, _ = convert_messages_to_contents([
+        {"role": "user", "content": "weather?"},
+        {"role": "assistant", "content": None, "tool_calls": [{
+            "id": "call_1", "type": "function",
+            "function": {"name": "get_weather", "arguments": '{"city":"Paris","days":"3"}'},
+        }]},
+        {"role": "tool", "tool_call_id": "call_1", "content": "sunny"},
+    ], WEATHER_SCHEMAS)
+    assert contents == [
+        {"role": "user", "parts": [{"text": "weather?"}]},
+        {"role": "model", "parts": [{
+            "functionCall": {"id": "call_1", "name": "get_weather", "args": {"city": "Paris", "days": 3}},
+            "thoughtSignature": "skip_thought_signature_validator",
+        }]},
+        {"role": "user", "parts": [{
+            "functionResponse": {"id": "call_1", "name": "get_weather", "response": {"result": "sunny"}},
+        }]},
+    ]
+
+
+def test_empty_message_is_skipped():
+    contents, _ = convert_messages_to_contents([
+        {"role": "user", "content": ""},
+        {"role": "assistant", "content": "ok"},
+    ])
+    assert contents == [{"role": "model", "parts": [{"text": "ok"}]}]
+
+
+def test_system_only_request_gets_default_user_message():
+    contents, system_instruction = convert_messages_to_contents([{"role": "system", "content": "S"}])
+    assert contents == [{"role": "user", "parts": [{"text": "请根据系统指令回答。"}]}]
+    assert system_instruction == {"parts": [{"text": "S"}]}
+
+
+def _conversation(turns: int) -> list:
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": [
+            {"type": "text", "text": f"question {i} " * 20},
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * 256}},
+        ]})
+        messages.append({"role": "assistant", "content": f"answer {i} " * 40})
+    return messages
+
+
+def test_cached_conversion_matches_uncached():
+    messages = _conversation(20)
+    expected = convert_messages_to_contents(messages)
+    assert convert_messages_to_contents(messages, cache_scope="test:golden") == expected
+    # 追加新消息后命中前缀缓存，结果仍与完整转换一致
+    messages = messages + [{"role": "user", "content": "one more"}]
+    assert convert_messages_to_contents(messages, cache_scope="test:golden") == convert_messages_to_contents(messages)
+
+
+def _image_message(size: int) -> dict:
+    return {"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * size}},
+    ]}
+
+
+def test_conversation_cache_byte_budget():
+    cache = ConversationCache(max_bytes=10_000, max_entry_bytes=4_000)
+    convert = lambda message: message["role"]
+
+    # 超过单条上限的前缀（大图片）不缓存
+    cache.convert("user:1", [_image_message(5_000)], convert)
+    assert cache.get_stats()["size"] == 0
+    assert cache.get_stats()["oversized"] == 1
+
+    # 总字节数超过预算时按作用域 LRU 淘汰
+    for i in range(4):
+        cache.convert(f"user:{i}", [_image_message(3_000)], convert)
+    stats = cache.get_stats()
+    assert stats["bytes"] <= 10_000
+    assert stats["size"] == 3
+    assert stats["scopes"] == 3
+
+
+def _best_of(runs: int, func) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def test_conversion_microbenchmark():
+    """长对话：完整转换 vs 命中前缀缓存只转换新增消息（打印耗时，-s 查看）"""
+    messages = _conversation(200)
+    full = _best_of(5, lambda: convert_messages_to_contents(messages))
+
+    scope = "test:bench"
+    convert_messages_to_contents(messages, cache_scope=scope)
+    turn = messages + [{"role": "user", "content": "next question"}]
+    incremental = _best_of(5, lambda: convert_messages_to_contents(turn, cache_scope=scope))
+
+    per_message_us = full / len(messages) * 1e6
+    print(f"\n[bench] {len(messages)} 条消息: 完整转换 {full * 1000:.2f}ms ({per_message_us:.1f}µs/条), "
+          f"命中缓存 {incremental * 1000:.2f}ms")
+    assert incremental < full
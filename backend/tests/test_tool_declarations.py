@@ -0,0 +1,84 @@
+"""工具声明缓存（openai2gemini_full._get_function_declaration）的固定输出测试和 40 个工具的微基准"""
+import time
+
+from app.services.openai2gemini_full import (
+    _build_function_declaration,
+    _tool_declaration_cache_key,
+    convert_openai_tools_to_gemini,
+)
+
+# 一次请求携带的工具数（Agent 类客户端常见规模）
+TOOLS = 40
+
+
+def _tool(index: int) -> dict:
+    return {"type": "function", "function": {
+        "name": f"tool.{index}",
+        "description": f"Tool number {index} " * 10,
+        "parameters": {
+            "$schema": "http://json-schema.org/draft-07/schema#",
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {
+                "path": {"type": "string", "description": "file path", "minLength": 1},
+                "options": {
+                    "type": "object",
+                    "properties": {
+                        "recursive": {"type": ["boolean", "null"], "default": False},
+                        "depth": {"type": "integer", "minimum": 0, "maximum": 10},
+                        "filters": {"type": "array", "items": {"type": "string", "format": "glob"}},
+                    },
+                },
+                "mode": {"anyOf": [{"type": "string", "enum": ["read", "write"]}, {"type": "null"}]},
+            },
+            "required": ["path"],
+        },
+    }}
+
+
+def _payload() -> list:
+    return [_tool(i) for i in range(TOOLS)]
+
+
+def test_cached_declarations_match_uncached():
+    tools = _payload()
+    for model in ("gemini-2.5-pro", "claude-sonnet-4-5"):
+        expected = [{"functionDeclarations": [
+            _build_function_declaration(tool["function"], "claude" in model) for tool in tools
+        ]}]
+        assert convert_openai_tools_to_gemini(tools, model) == expected
+        # 第二次命中缓存，结果不变
+        assert convert_openai_tools_to_gemini(tools, model) == expected
+
+
+def test_cache_key_ignores_key_order_and_separates_model_families():
+    function = _tool(0)["function"]
+    reordered = dict(reversed(list(function.items())))
+    assert _tool_declaration_cache_key(function, False) == _tool_declaration_cache_key(reordered, False)
+    assert _tool_declaration_cache_key(function, False) != _tool_declaration_cache_key(function, True)
+    assert _tool_declaration_cache_key(function, False) != _tool_declaration_cache_key(_tool(1)["function"], False)
+
+
+def _best_of(runs: int, func) -> float:
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def test_tool_declaration_microbenchmark():
+    """40 个工具：每次清理 schema vs 命中声明缓存（打印耗时，-s 查看）"""
+    # 每轮请求都会重新解析 JSON body，工具定义是新的对象
+    payloads = [_payload() for _ in range(5)]
+
+    uncached = _best_of(5, lambda: [
+        _build_function_declaration(tool["function"], False) for tool in payloads[0]
+    ])
+    convert_openai_tools_to_gemini(payloads[0], "gemini-2.5-pro")
+    rounds = iter(payloads)
+    cached = _best_of(5, lambda: convert_openai_tools_to_gemini(next(rounds), "gemini-2.5-pro"))
+
+    print(f"\n[bench] {TOOLS} 个工具: 清理 schema {uncached * 1000:.2f}ms, 命中缓存 {cached * 1000:.2f}ms")
+    assert cached < uncached
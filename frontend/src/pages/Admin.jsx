@@ -166,6 +166,9 @@ export default function Admin() {
     } else if (data.type === "log_update" && data.data) {
       // 实时插入新日志
       setLogs((prev) => [data.data, ...prev].slice(0, 100));
+    } else if (data.type === "log_batch" && data.data) {
+      // 合并推送的多条新日志（按时间顺序）
+      setLogs((prev) => [...data.data.slice().reverse(), ...prev].slice(0, 100));
     }
   }, []);
 
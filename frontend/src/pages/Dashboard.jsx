@@ -113,7 +113,7 @@ export default function Dashboard() {
 
   // WebSocket 实时更新
   const handleWsMessage = useCallback((data) => {
-    if (data.type === "stats_update" || data.type === "log_update") {
+    if (data.type === "stats_update" || data.type === "log_update" || data.type === "log_batch") {
       api
         .get("/api/auth/me")
         .then((res) => setUserInfo(res.data))
@@ -177,7 +177,7 @@ export default function Dashboard() {
         const createRes = await api.post("/api/auth/api-keys", {
           name: "default",
         });
-        setMyKey({ key: createRes.data.key, name: "default" });
+        setMyKey(createRes.data);
       }
     } catch (err) {
       console.error("获取Key失败", err);
@@ -220,6 +220,22 @@ export default function Dashboard() {
     }
   };
 
+  const [cacheSaving, setCacheSaving] = useState(false);
+  const toggleResponseCache = async (enabled) => {
+    if (!myKey?.id) return;
+    setCacheSaving(true);
+    try {
+      const res = await api.put(`/api/auth/api-keys/${myKey.id}/response-cache`, {
+        enabled,
+      });
+      setMyKey({ ...myKey, response_cache: res.data.response_cache });
+    } catch (err) {
+      alert("设置失败: " + (err.response?.data?.detail || err.message));
+    } finally {
+      setCacheSaving(false);
+    }
+  };
+
   // 凭证管理函数
   const fetchMyCredentials = async () => {
     setCredLoading(true);
@@ -1002,6 +1018,24 @@ export default function Dashboard() {
                         更改
                       </button>
                     </div>
+                    <div className="flex justify-between items-center gap-4 pt-1">
+                      <div>
+                        <div className="font-medium text-gray-200">响应缓存</div>
+                        <div className="text-gray-400 text-sm">
+                          temperature=0 的相同请求直接返回缓存结果，不占用凭证，不计入速率和配额
+                        </div>
+                      </div>
+                      <label className="relative inline-flex items-center cursor-pointer shrink-0">
+                        <input
+                          type="checkbox"
+                          checked={myKey.response_cache || false}
+                          disabled={!myKey.id || cacheSaving}
+                          onChange={(e) => toggleResponseCache(e.target.checked)}
+                          className="sr-only peer"
+                        />
+                        <div className="w-11 h-6 bg-gray-600 peer-focus:outline-none rounded-full peer peer-checked:after:translate-x-full peer-checked:after:border-white after:content-[''] after:absolute after:top-[2px] after:left-[2px] after:bg-white after:rounded-full after:h-5 after:w-5 after:transition-all peer-checked:bg-purple-600 peer-disabled:opacity-50"></div>
+                      </label>
+                    </div>
                   </div>
                 </div>
 